@@ -1,16 +1,18 @@
-from flask import Flask
 from config import config
-from flask_restplus import Api
-
-api = Api()
 
 
 # app factory
 def create_api_app(config_name):
+    # the web stack is imported here (rather than at module level), so that the factories, which are imported from
+    # subpackages of api, can be loaded without it (e.g., by the fork server of the worker processes, see workers.py)
+    from flask import Flask
+    from flask_restplus import Api
+
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
 
+    api = Api()
     api.init_app(app)
 
     # APIs
@@ -20,9 +22,14 @@ def create_api_app(config_name):
     app.register_blueprint(tasks_blueprint, url_prefix='/tasks')
 
     # specific versions
-    from api.v1 import blueprint as api_v1_blueprint
+    from api.v1.routes import blueprint as api_v1_blueprint
     app.register_blueprint(api_v1_blueprint, url_prefix='/v1')
-    # from api.vX import blueprint as api_vX_blueprint
+    # from api.vX.routes import blueprint as api_vX_blueprint
     # app.register_blueprint(api_vX_blueprint, url_prefix='/vX')
 
+    # set up the factories for works before the first request (see works.factory.warm_up)
+    if app.config.get('WARM_UP_FACTORIES', True):
+        from api.v1.works.factory import warm_up as warm_up_works
+        warm_up_works()
+
     return app
@@ -0,0 +1,626 @@
+"""
+Containers for the results of asynchronous tasks. Results are serialized exactly once (when the task finishes) and
+are served from their serialized form afterwards, so that clients polling or querying a result do not cause the
+complete result to be re-encoded. Serialized results are kept in a single compressed copy (see CompressedBuffer).
+"""
+
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+import copy
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import uuid
+import weakref
+import zlib
+from werkzeug.exceptions import abort
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import FileWrapper, wrap_file
+
+
+class TaskResult:
+    """
+    Base class for task results that build their own response from the request by which they are queried
+    (see tasks.GetTaskStatus).
+    """
+
+    def make_response(self, request) -> Response:
+        raise NotImplementedError
+
+    def get_stats(self) -> dict:
+        """Gets some key figures about the result (e.g., for completion notices, see webhooks.py)."""
+        return {}
+
+    def get_size(self) -> int:
+        """Gets the (approximate) number of bytes of memory occupied by the result (see hold_result)."""
+        return 0
+
+    def get_disk_size(self) -> int:
+        """Gets the number of bytes occupied by the result in files (see hold_result)."""
+        return 0
+
+    def discard(self):
+        """Removes the files of the result, once it is not held anymore (see release_result). Responses that are
+        still being sent from the result are not affected."""
+        pass
+
+
+# results that are kept for later requests, by key (such as ('task', task_id) or ('work', wid)), in order of their last
+# use, so that the least recently used results come first; a result may be held under several keys (e.g., a work's
+# result by its task and as the work's current result), but it is accounted for only once, and it is released once
+# it is not held under any key anymore
+held_results = OrderedDict()  # key -> (result, function to call with key if the result is evicted, or None)
+result_holds = {}  # id(result) -> [number of keys, size, disk size]
+held_results_lock = threading.Lock()
+
+# maximum number of bytes occupied by all held results together, in memory and in files (for results that have been
+# spilled, see CompressedBuffer.spill); least recently used results are evicted first (see evict_results)
+results_budget = 512 * 1024 * 1024
+files_budget = 4 * 1024 * 1024 * 1024
+
+# eviction metrics (see tasks.TaskMetrics)
+result_metrics = {'results': 0,  # number of distinct held results
+                  'results_bytes': 0,  # bytes occupied by all held results
+                  'files_bytes': 0,  # bytes occupied by the files of spilled results
+                  'evicted_by_size': 0,
+                  'evicted_bytes': 0}
+
+
+def hold_result(key, result: TaskResult, on_evict=None):
+    """
+    Holds a result under key (replacing any result held under key so far), and evicts the least recently used
+    results as long as all results together exceed results_budget or files_budget (see evict_results).
+    :param on_evict: a function that is called with key if the result is evicted (e.g., for removing its task)
+    """
+    with held_results_lock:
+        release(key, False)
+        held_results[key] = (result, on_evict)
+        hold = result_holds.get(id(result))
+        if hold is None:
+            hold = result_holds[id(result)] = [0, result.get_size(), result.get_disk_size()]
+            result_metrics['results'] += 1
+            result_metrics['results_bytes'] += hold[1]
+            result_metrics['files_bytes'] += hold[2]
+        hold[0] += 1
+    evict_results()
+
+
+def get_held_result(key):
+    """Gets the result held under key (if any), and marks it as recently used."""
+    with held_results_lock:
+        held = held_results.get(key)
+        if held is None:
+            return None
+        held_results.move_to_end(key)
+        return held[0]
+
+
+def touch_result(key):
+    """Marks the result held under key (if any) as recently used."""
+    get_held_result(key)
+
+
+def release_result(key, evicted: bool = False):
+    """Releases the result held under key, if any. The result is freed once it is not held under any other key.
+    :param evicted: whether the result is released because it has been evicted (which is reported in result_metrics)
+    """
+    with held_results_lock:
+        release(key, evicted)
+
+
+def release(key, evicted: bool) -> bool:
+    """Releases the result held under key (must be called while holding held_results_lock).
+    :return: True if there was a result
+    """
+    held = held_results.pop(key, None)
+    if held is None:
+        return False
+    result = held[0]
+    hold = result_holds[id(result)]
+    hold[0] -= 1
+    if hold[0] == 0:
+        del result_holds[id(result)]
+        result_metrics['results'] -= 1
+        result_metrics['results_bytes'] -= hold[1]
+        result_metrics['files_bytes'] -= hold[2]
+        if evicted:
+            result_metrics['evicted_bytes'] += hold[1] + hold[2]
+        result.discard()
+    return True
+
+
+def is_over_budget() -> bool:
+    return result_metrics['results_bytes'] > results_budget or result_metrics['files_bytes'] > files_budget
+
+
+def evict_results():
+    """Evicts the least recently used results as long as all held results together occupy more than results_budget
+    bytes in memory or files_budget bytes in files."""
+    evicted = []
+    with held_results_lock:
+        while is_over_budget() and held_results:
+            key, (result, on_evict) = next(iter(held_results.items()))
+            release(key, True)
+            result_metrics['evicted_by_size'] += 1
+            evicted.append((key, on_evict))
+    # (outside the lock, since callbacks might acquire the locks of other registries)
+    for key, on_evict in evicted:
+        if on_evict is not None:
+            on_evict(key)
+
+
+# compression level of results: results are compressed once, but served many times
+gzip_level = 6
+# results are compressed in blocks of (at least) this many bytes, each of which can be decompressed on its own, so
+# that single items can be read without decompressing the complete result (see CompressedBuffer)
+block_size = 64 * 1024
+
+# results that grow larger than this (in bytes, compressed) while they are built are spilled to files, which are served
+# by the WSGI server (see CompressedBuffer.spill)
+spill_threshold = 4 * 1024 * 1024
+# directory for spilled results; None: the system's temporary directory
+spill_path = None
+
+# the header of the gzip streams of results (without file name and modification time)
+gzip_header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def crc32_combine(crc1: int, crc2: int, length2: int) -> int:
+    """Gets the CRC-32 of the concatenation of two byte strings from their CRCs and the length of the second one
+    (the CRC is affine in its initial value, which, for the second string, is crc1 rather than 0)."""
+    zeros = bytes(length2)
+    return zlib.crc32(zeros, crc1) ^ zlib.crc32(zeros) ^ crc2
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class CompressedBuffer:
+    """
+    A byte string that is kept as a single gzip stream, which is served as it is to clients that accept gzip. The
+    stream is compressed in blocks: after each block, the compressor is flushed with Z_FULL_FLUSH, so that no block
+    refers back to the data of its predecessors. Any range of the uncompressed data can thus be read by decompressing
+    only the blocks that contain it (see read). Data is appended with write() and end_block(), and the buffer must be
+    closed before it can be read. Once the compressed stream exceeds spill_threshold, it is written to a file rather
+    than kept in memory (see spill).
+    """
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.stream = io.BytesIO()  # the gzip stream while it is being built (a file once it has been spilled)
+        self.stream.write(gzip_header)
+        self.data = None  # the complete gzip stream (bytes, or a memory map of its file if it has been spilled)
+        self.path = None  # the file of the gzip stream, if it has been spilled
+        self.remove_file = None  # removes the file (once), see discard
+        self.pending = bytearray()  # the uncompressed data of the current block
+        self.length = 0  # the number of uncompressed bytes (not including pending)
+        self.crc = 0
+        self.block_starts = array('Q')  # the position of each block in the uncompressed data
+        self.block_offsets = array('Q')  # the position of each block in the gzip stream, and the end of the last one
+        self.block_crcs = array('I')  # the CRC-32 of the uncompressed data of each block (see copy_block)
+        self.cached_block = (-1, b'')  # the most recently decompressed block: (index, data)
+
+    def tell(self) -> int:
+        """Gets the number of uncompressed bytes written so far."""
+        return self.length + len(self.pending)
+
+    def write(self, data: bytes):
+        self.pending += data
+
+    def end_block(self, force: bool = False):
+        """Compresses the data written since the last block as a block of its own, if there is at least block_size of
+        it (or any, if force is True). Callers decide where blocks may end, e.g. only between items."""
+        if len(self.pending) < block_size and not (force and self.pending):
+            return
+        self.block_starts.append(self.length)
+        self.block_offsets.append(self.stream.tell())
+        self.stream.write(self.compressor.compress(self.pending))
+        self.stream.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        self.crc = zlib.crc32(self.pending, self.crc)
+        self.block_crcs.append(zlib.crc32(self.pending))
+        self.length += len(self.pending)
+        self.pending = bytearray()
+        if self.path is None and self.stream.tell() > spill_threshold:
+            self.spill()
+
+    def copy_block(self, source, index: int):
+        """Appends block index of another (closed) buffer as it is, i.e. without decompressing and compressing it
+        again; must be called at the end of a block (e.g., after end_block(force=True))."""
+        assert not self.pending
+        length = source.get_block_end(index) - source.block_starts[index]
+        self.block_starts.append(self.length)
+        self.block_offsets.append(self.stream.tell())
+        self.stream.write(source.data[source.block_offsets[index]:source.block_offsets[index + 1]])
+        self.crc = crc32_combine(self.crc, source.block_crcs[index], length)
+        self.block_crcs.append(source.block_crcs[index])
+        self.length += length
+        if self.path is None and self.stream.tell() > spill_threshold:
+            self.spill()
+
+    def close(self):
+        """Finishes the gzip stream."""
+        self.end_block(force=True)
+        self.block_offsets.append(self.stream.tell())
+        self.stream.write(self.compressor.flush(zlib.Z_FINISH))
+        self.stream.write(struct.pack('<II', self.crc, self.length & 0xffffffff))
+        if self.path is None:
+            self.data = self.stream.getvalue()
+        else:
+            # a read-only memory map of the file, so that the stream occupies (reclaimable) page cache rather than
+            # Python memory
+            self.stream.flush()
+            self.data = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
+            self.stream.close()
+        self.stream = None
+        self.compressor = None
+
+    def spill(self):
+        """
+        Moves the gzip stream built so far to a file, to which the remaining blocks are written directly, so that
+        large results never have to be held in memory completely. The file is removed by discard() or, at the latest,
+        when the buffer is garbage-collected.
+        """
+        fd, self.path = tempfile.mkstemp(prefix='result-', suffix='.json.gz', dir=spill_path)
+        self.remove_file = weakref.finalize(self, remove_files, [self.path])
+        stream = os.fdopen(fd, 'w+b')
+        stream.write(self.stream.getbuffer())
+        self.stream = stream
+
+    def discard(self):
+        """Removes the file of a spilled buffer. Its memory map remains valid as long as it is referenced (e.g., by
+        responses that are still being sent), so that the buffer can still be read."""
+        if self.remove_file is not None:
+            self.remove_file()
+
+    def get_compressed_size(self) -> int:
+        return len(self.data)
+
+    def get_block_end(self, index: int) -> int:
+        """Gets the end of block index in the uncompressed data."""
+        return self.block_starts[index + 1] if index + 1 < len(self.block_starts) else self.length
+
+    def get_block(self, index: int) -> bytes:
+        cached_index, block = self.cached_block
+        if cached_index != index:
+            block = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+                self.data[self.block_offsets[index]:self.block_offsets[index + 1]])
+            self.cached_block = (index, block)
+        return block
+
+    def read(self, start: int, end: int) -> bytes:
+        """Reads the uncompressed bytes from start to end (exclusive)."""
+        end = min(end, self.length)
+        parts = []
+        index = bisect_right(self.block_starts, start) - 1
+        while start < end:
+            block_start = self.block_starts[index]
+            part = self.get_block(index)[start - block_start:end - block_start]
+            parts.append(part)
+            start += len(part)
+            index += 1
+        return parts[0] if len(parts) == 1 else b''.join(parts)  # (no copy for reads within a single block)
+
+
+class CompressedBufferReader(io.RawIOBase):
+    """A seekable, file-like view of the uncompressed data of a CompressedBuffer (e.g., for serving byte ranges)."""
+
+    def __init__(self, buffer: CompressedBuffer):
+        self.buffer = buffer
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.buffer.length
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, b) -> int:
+        data = self.buffer.read(self.position, self.position + len(b))
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def encode_json(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False).encode('UTF-8')
+
+
+def encode_item(item: dict):
+    """Serializes a flat dict.
+    :return: a tuple (the serialized item, the end of each '"field": value' pair relative to the start of the item)
+    """
+    item_bytes = bytearray(b'{')
+    field_ends = []
+    for i, (field, value) in enumerate(item.items()):
+        if i > 0:
+            item_bytes += b', '
+        item_bytes += encode_json(field) + b': ' + encode_json(value)
+        field_ends.append(len(item_bytes))
+    item_bytes += b'}'
+    return item_bytes, field_ends
+
+
+class JSONResult(TaskResult):
+    """
+    A JSON object of the form {..., items_key: [item, item, ...]}, serialized into a single compressed buffer (see
+    CompressedBuffer). Alongside the buffer, an offset index is kept for every item and for every field of an item,
+    so that slices and field projections of the item list can be served without decoding or re-encoding the complete
+    result (blocks of the buffer end between items only, so that each item is read from a single block).
+    """
+
+    def __init__(self, data: dict, items_key: str, ref_key: str = '@id'):
+        """
+        :param data: the result object; data[items_key] must be a list of flat dicts
+        :param items_key: the key of the list of items that can be paginated and projected
+        :param ref_key: the field by which single items are referenced (e.g., in citetrail ranges)
+        """
+        self.items_key = items_key
+        self.ref_key = ref_key
+        # the offset index: start and end of each item within the uncompressed buffer, and for each item the end of
+        # each '"field": value' pair relative to the start of the item (items that have the same fields, in the same
+        # order, share a layout, which maps each field to its number)
+        self.item_bounds = array('Q')  # start, end, start, end, ...
+        self.field_ends = array('I')
+        self.field_bases = array('Q')  # for each item: the index of its first field in field_ends
+        self.item_layouts = array('I')  # for each item: the index of its layout in self.layouts
+        self.layouts = []  # {field: number of the field}
+        self.layout_ids = {}  # tuple of fields -> index of the layout
+        self.refs = {}  # ref -> position of the item
+        self.buffer = CompressedBuffer()
+        self.buffer.write(b'{')
+        for i, (key, value) in enumerate(data.items()):
+            if i > 0:
+                self.buffer.write(b', ')
+            self.buffer.write(encode_json(key) + b': ')
+            if key == items_key:
+                self.buffer.write(b'[')
+                for position, item in enumerate(value):
+                    if position > 0:
+                        self.buffer.write(b', ')
+                    self.append_item(item)
+                    self.buffer.end_block()
+                    if item.get(ref_key) is not None:
+                        self.refs[item[ref_key]] = position
+                self.buffer.write(b']')
+            else:
+                self.buffer.write(encode_json(value))
+        self.buffer.write(b'}')
+        self.buffer.close()
+        self.layout_ids = None
+        self.index_size = sum(a.itemsize * len(a) for a in (self.item_bounds, self.field_ends, self.field_bases,
+                                                            self.item_layouts)) \
+                          + sys.getsizeof(self.refs) + sum(sys.getsizeof(ref) for ref in self.refs)
+        # identifies the serialized result in conditional and range requests
+        self.etag = uuid.uuid4().hex
+
+    def load(self) -> dict:
+        """Decodes the complete result."""
+        return json.loads(self.buffer.read(0, self.buffer.length))
+
+    def append_item(self, item: dict):
+        fields = tuple(item)
+        layout_id = self.layout_ids.get(fields)
+        if layout_id is None:
+            layout_id = self.layout_ids[fields] = len(self.layouts)
+            self.layouts.append({field: i for i, field in enumerate(fields)})
+        self.item_layouts.append(layout_id)
+        self.field_bases.append(len(self.field_ends))
+        item_bytes, field_ends = encode_item(item)
+        self.field_ends.extend(field_ends)
+        item_start = self.buffer.tell()
+        self.buffer.write(item_bytes)
+        self.item_bounds.append(item_start)
+        self.item_bounds.append(item_start + len(item_bytes))
+
+    def patch_items(self, items: dict):
+        """
+        Makes a copy of the result in which some items are replaced, e.g. for updating a few passages of a work
+        result. Only the blocks of the buffer that contain replaced items are compressed anew; all other blocks are
+        copied as they are (see CompressedBuffer.copy_block), and the offset index is shifted accordingly.
+        :param items: {position: new item}; each new item must have the same fields, in the same order, as the item
+        that it replaces
+        :return: the patched copy (with a new etag), which shares the refs and layouts of the result
+        """
+        patched = copy.copy(self)
+        patched.buffer = CompressedBuffer()
+        patched.item_bounds = array('Q')
+        patched.field_ends = array('I', self.field_ends)
+        source = self.buffer
+        count = self.get_item_count()
+        position = 0
+        for index in range(len(source.block_starts)):
+            block_start, block_end = source.block_starts[index], source.get_block_end(index)
+            first = position
+            while position < count and self.item_bounds[2 * position] < block_end:
+                position += 1
+            shift = patched.buffer.tell() - block_start
+            if not any(p in items for p in range(first, position)):
+                patched.buffer.copy_block(source, index)
+                for p in range(first, position):
+                    patched.item_bounds.append(self.item_bounds[2 * p] + shift)
+                    patched.item_bounds.append(self.item_bounds[2 * p + 1] + shift)
+                continue
+            block = source.get_block(index)
+            cursor = block_start
+            for p in range(first, position):
+                start, end = self.item_bounds[2 * p], self.item_bounds[2 * p + 1]
+                patched.buffer.write(block[cursor - block_start:start - block_start])
+                item_start = patched.buffer.tell()
+                if p in items:
+                    if tuple(items[p]) != tuple(self.layouts[self.item_layouts[p]]):
+                        raise ValueError('Item ' + str(p) + ' must keep its fields')
+                    item_bytes, field_ends = encode_item(items[p])
+                    base = self.field_bases[p]
+                    patched.field_ends[base:base + len(field_ends)] = array('I', field_ends)
+                    patched.buffer.write(item_bytes)
+                else:
+                    patched.buffer.write(block[start - block_start:end - block_start])
+                patched.item_bounds.append(item_start)
+                patched.item_bounds.append(patched.buffer.tell())
+                cursor = end
+            patched.buffer.write(block[cursor - block_start:block_end - block_start])
+            patched.buffer.end_block(force=True)
+        patched.buffer.close()
+        patched.etag = uuid.uuid4().hex
+        return patched
+
+    def get_field_bounds(self, position: int, field: str):
+        """Gets the start and end of the '"field": value' pair of the item at position, relative to the start of the
+        item, or None if the item does not have that field."""
+        i = self.layouts[self.item_layouts[position]].get(field)
+        if i is None:
+            return None
+        base = self.field_bases[position]
+        # pairs are separated by ', ', and the first one follows the '{' of the item
+        return self.field_ends[base + i - 1] + 2 if i > 0 else 1, self.field_ends[base + i]
+
+    def get_size(self) -> int:
+        if self.buffer.path:
+            return self.index_size
+        return self.buffer.get_compressed_size() + self.index_size
+
+    def get_disk_size(self) -> int:
+        return self.buffer.get_compressed_size() if self.buffer.path else 0
+
+    def discard(self):
+        self.buffer.discard()
+
+    def get_stats(self) -> dict:
+        return {'items': self.get_item_count(), 'bytes': self.buffer.length,
+                'compressed_bytes': self.buffer.get_compressed_size()}
+
+    def get_item_count(self) -> int:
+        return len(self.item_bounds) // 2
+
+    def get_item_bytes(self, position: int, fields=None) -> bytes:
+        """
+        Gets the serialized item at position. If fields is given, the item is projected onto the ref field and the
+        requested fields (fields that the item does not have are omitted).
+        """
+        item_bytes = self.buffer.read(self.item_bounds[2 * position], self.item_bounds[2 * position + 1])
+        if fields is None:
+            return item_bytes
+        pairs = []
+        for field in [self.ref_key] + [f for f in fields if f != self.ref_key]:
+            bounds = self.get_field_bounds(position, field)
+            if bounds is not None:
+                pairs.append(item_bytes[bounds[0]:bounds[1]])
+        return b'{' + b', '.join(pairs) + b'}'
+
+    def get_item_value(self, position: int, field: str):
+        """Decodes a single field of the item at position, or returns None if the item does not have that field."""
+        bounds = self.get_field_bounds(position, field)
+        if bounds is None:
+            return None
+        start, end = bounds
+        item_start = self.item_bounds[2 * position]
+        # skip the '"field": ' part of the pair
+        return json.loads(self.buffer.read(item_start + start + len(encode_json(field)) + 2, item_start + end))
+
+    def make_complete_response(self, request) -> Response:
+        """
+        Serves the complete result: as it is stored, i.e. gzip-compressed, to clients that accept gzip, otherwise
+        decompressed on the fly. Byte ranges (of either representation) may be requested.
+        """
+        if request.accept_encodings.best_match(['gzip']):
+            file = self.open_file()
+            if file is not None:
+                # spilled results are passed to the WSGI server's file wrapper (so that they can be sent by the kernel)
+                response = Response(wrap_file(request.environ, file), direct_passthrough=True)
+            else:
+                response = Response(self.buffer.data)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(self.etag + '-gzip')
+            length = self.buffer.get_compressed_size()
+        else:
+            response = Response(FileWrapper(CompressedBufferReader(self.buffer)), direct_passthrough=True)
+            response.set_etag(self.etag)
+            length = self.buffer.length
+        response.mimetype = 'application/json'
+        response.content_length = length
+        response.vary.add('Accept-Encoding')
+        return response.make_conditional(request, accept_ranges=True, complete_length=length)
+
+    def open_file(self):
+        """Opens the file of a spilled result, or returns None if the result has not been spilled or if its file has
+        been removed meanwhile (see discard; the result is then served from its memory map)."""
+        if not self.buffer.path:
+            return None
+        try:
+            return open(self.buffer.path, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def make_response(self, request) -> Response:
+        """
+        Serves the complete result or, if any of the query parameters 'offset', 'limit', 'start', 'end' (refs
+        delimiting an inclusive range of items), or 'fields' (comma-separated list of item fields) are given, a
+        page of items (see make_complete_response for the complete result).
+        """
+        if not any(param in request.args for param in ('offset', 'limit', 'start', 'end', 'fields')):
+            return self.make_complete_response(request)
+
+        # 1.) determine the range of items
+        first = 0
+        last = self.get_item_count() - 1
+        if request.args.get('start'):
+            first = self.get_ref_position(request.args['start'])
+        if request.args.get('end'):
+            last = self.get_ref_position(request.args['end'])
+        total = max(last - first + 1, 0)
+        offset = get_int_arg(request, 'offset', 0)
+        limit = get_int_arg(request, 'limit', total)
+        positions = range(first + offset, first + min(offset + limit, total))
+
+        # 2.) determine the fields
+        fields = None
+        if request.args.get('fields'):
+            fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+
+        def generate():
+            yield b'{"totalItems": ' + encode_json(total) + b', "offset": ' + encode_json(offset) \
+                  + b', "limit": ' + encode_json(limit) + b', ' + encode_json(self.items_key) + b': ['
+            for i, position in enumerate(positions):
+                if i > 0:
+                    yield b', '
+                yield self.get_item_bytes(position, fields)
+            yield b']}'
+
+        return Response(generate(), mimetype='application/json')
+
+    def get_ref_position(self, ref: str) -> int:
+        position = self.refs.get(ref)
+        if position is None:
+            abort(404, 'Unknown reference: ' + ref)
+        return position
+
+
+def get_int_arg(request, name: str, default: int) -> int:
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    if not value.isdigit():
+        abort(400, 'Query parameter ' + name + ' must be a non-negative integer')
+    return int(value)
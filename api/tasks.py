@@ -1,4 +1,7 @@
+from collections import OrderedDict
 from functools import wraps
+import json
+import logging
 import threading
 import time
 import uuid
@@ -6,10 +9,17 @@ from datetime import datetime
 from flask_restplus import Resource
 from flask_restplus import Api
 
-from flask import Blueprint, abort, jsonify, current_app, request#, url_for
-from werkzeug.exceptions import HTTPException, InternalServerError
+from flask import Blueprint, abort, jsonify, current_app, request, Response#, url_for
+from werkzeug.exceptions import HTTPException, InternalServerError, GatewayTimeout
 
-from api.utils import timestamp, url_for
+from api.utils import url_for
+from api.results import TaskResult, get_int_arg, hold_result, touch_result, release_result, result_metrics
+from api import results
+from api.webhooks import is_valid_callback, send_notice
+from api.workers import current_task, TaskAborted
+
+
+logger = logging.getLogger(__name__)
 
 
 # ++++ BLUEPRINT ++++
@@ -17,7 +27,30 @@ from api.utils import timestamp, url_for
 tasks_bp = Blueprint('tasks', __name__)
 tasks_api = Api(tasks_bp)
 
-tasks = {}
+# all tasks by task id, in order of their last access (completion or status request), so that the least recently used
+# tasks come first; running tasks are never evicted (see evict_tasks)
+tasks = OrderedDict()
+# (when both are needed, tasks_lock is acquired before results.held_results_lock)
+tasks_lock = threading.Lock()
+
+# the results of finished tasks are held in the shared result store (see results.hold_result), which evicts the least
+# recently used results of tasks, works and docs alike once they exceed results.results_budget or results.files_budget;
+# a task whose result is evicted is removed
+# number of seconds after which finished tasks are evicted if their results have not been requested meanwhile
+task_max_age = 5 * 60
+# interval (in seconds) in which tasks are checked for their age
+eviction_interval = 60
+
+# eviction metrics, see TaskMetrics (and results.result_metrics)
+task_metrics = {'evicted_by_age': 0}
+
+# maximum number of seconds that a status request may wait for a task to finish (see GetTaskStatus)
+max_wait = 60
+# interval (in seconds) of keepalive comments in event streams (see GetTaskEvents)
+keepalive_interval = 15
+# default (and maximum) number of seconds that a task may run before it is aborted; clients may set a shorter
+# deadline with ?deadline=N
+task_deadline = 3600
 
 
 @tasks_bp.before_app_first_request
@@ -25,21 +58,55 @@ def before_first_request():
     """Start a background thread that cleans up old tasks."""
     def clean_old_tasks():
         """ Cleans up old tasks from our in-memory data structure. """
-        global tasks
         while True:
-            # Only keep tasks that are running or that finished less than 5 minutes ago.
-            five_min_ago = timestamp() - 5 * 60
-            tasks = {id: task for id, task in tasks.items()
-                     if 't' not in task or task['t'] > five_min_ago}
-            time.sleep(60)
+            evict_tasks()
+            time.sleep(eviction_interval)
 
     # if not current_app.config['TESTING']:
     #    thread = threading.Thread(target=clean_old_tasks)
     #    thread.start()
-    thread = threading.Thread(target=clean_old_tasks)
+    thread = threading.Thread(target=clean_old_tasks, daemon=True)
     thread.start()
 
 
+def get_task(task_id: str):
+    """Gets a task and marks it as recently used."""
+    with tasks_lock:
+        task = tasks.get(task_id)
+        if task is not None:
+            tasks.move_to_end(task_id)
+            task['access_timestamp'] = time.time()
+            touch_result(('task', task_id))
+        return task
+
+
+def remove_task(task_id: str):
+    """Removes a task from the registry (must be called while holding tasks_lock).
+    :return: the task, or None if there is no such task
+    """
+    task = tasks.pop(task_id, None)
+    if task is not None:
+        release_result(('task', task_id))
+    return task
+
+
+def remove_evicted_task(key: tuple):
+    """Removes a task whose result has been evicted from the result store (see results.evict_results)."""
+    with tasks_lock:
+        tasks.pop(key[1], None)
+
+
+def evict_tasks():
+    """Evicts finished tasks that have not been used for task_max_age seconds. (Tasks whose results are evicted from
+    the result store for its budget are removed by remove_evicted_task.)"""
+    now = time.time()
+    with tasks_lock:
+        for task_id, task in list(tasks.items()):
+            if 'access_timestamp' in task and now - task['access_timestamp'] > task_max_age:
+                task_metrics['evicted_by_age'] += 1
+                remove_task(task_id)
+
+
 # ++++ DECORATORS ++++
 
 def async_api(wrapped_function):
@@ -48,38 +115,102 @@ def async_api(wrapped_function):
         def task_call(flask_app, environ):
             # Create a request context similar to that of the original request
             # so that the task can have access to flask.g, flask.request, etc.
+            current_task.task = task
             with flask_app.request_context(environ):
                 try:
-                    tasks[task_id]['return_value'] = wrapped_function(*args, **kwargs)
+                    task['return_value'] = wrapped_function(*args, **kwargs)
                 except HTTPException as e:
-                    tasks[task_id]['return_value'] = current_app.handle_http_exception(e)
+                    task['return_value'] = current_app.handle_http_exception(e)
+                except TaskAborted as e:
+                    logger.info('Task %s aborted: %s', task_id, e)
+                    task['return_value'] = GatewayTimeout(str(e))
                 except Exception as e:
                     # The function raised an exception, so we set a 500 error
-                    tasks[task_id]['return_value'] = InternalServerError()
+                    task['return_value'] = InternalServerError()
                     if current_app.debug:
                         # We want to find out if something happened so reraise
                         raise
                 finally:
-                    # We record the time of the response, to help in garbage collecting old tasks
-                    tasks[task_id]['completion_timestamp'] = datetime.timestamp(datetime.utcnow())
+                    # We record the time of the response, to help in garbage collecting old tasks, and wake up
+                    # clients waiting for the task
+                    with task['changed']:
+                        task['access_timestamp'] = time.time()
+                        task['completion_timestamp'] = datetime.timestamp(datetime.utcnow())
+                        task['changed'].notify_all()
+                    current_task.task = None
+                    # hold the result in the result store (which makes room for it if necessary), unless the task
+                    # has been removed meanwhile (e.g., cancelled), in which case the result is released again
+                    result = task.get('return_value')
+                    if isinstance(result, TaskResult):
+                        hold_result(('task', task_id), result, remove_evicted_task)
+                    with tasks_lock:
+                        if tasks.get(task_id) is task:
+                            tasks.move_to_end(task_id)
+                        elif isinstance(result, TaskResult):
+                            release_result(('task', task_id))
+                    if callback:
+                        task['webhook'] = send_notice(callback, make_completion_notice(task_id, task))
+
+        # clients may pass a URL to be notified when the task has finished, e.g. POST /v1/texts/W0004?callback=...
+        callback = request.args.get('callback')
+        if callback and not is_valid_callback(callback):
+            abort(400, 'Query parameter callback must be an http(s) URL of a public host')
+        deadline = min(get_int_arg(request, 'deadline', task_deadline), task_deadline)
 
         # Assign an id to the asynchronous task
         task_id = uuid.uuid4().hex
 
-        # Record the task, and then launch it
-        tasks[task_id] = {'task_thread': threading.Thread(
-            target=task_call, args=(current_app._get_current_object(),
-                               request.environ))}
-        tasks[task_id]['task_thread'].start()
+        # Record the task, and then launch it; waiting status requests and event streams are notified of progress
+        # and completion through the task's condition
+        task = {'task_thread': threading.Thread(target=task_call, args=(current_app._get_current_object(),
+                                                                        request.environ)),
+                'location': url_for('tasks.GetTaskStatus', task_id=task_id),
+                'start_timestamp': datetime.timestamp(datetime.utcnow()),
+                'deadline': time.time() + deadline,
+                'cancelled': threading.Event(),
+                'progress': [],
+                'changed': threading.Condition()}
+        if callback:
+            task['external_location'] = url_for('tasks.GetTaskStatus', task_id=task_id, _external=True)
+        with tasks_lock:
+            tasks[task_id] = task
+        task['task_thread'].start()
 
         # Return a 202 response, with a link that the client can use to obtain task status
-        print(url_for('tasks.GetTaskStatus', task_id=task_id))
-        return 'accepted', 202, {'Location': url_for('tasks.GetTaskStatus', task_id=task_id)}
+        return 'accepted', 202, {'Location': task['location']}
         #print(url_for('tasks.get_status', task_id=task_id))
         #return 'accepted', 202, {'Location': url_for('tasks.get_status', task_id=task_id)}
     return wrapped
 
 
+def is_finished(task: dict) -> bool:
+    return 'completion_timestamp' in task
+
+
+def is_failed(task: dict) -> bool:
+    return isinstance(task.get('return_value'), HTTPException)
+
+
+def get_status(task: dict) -> str:
+    if task['cancelled'].is_set():
+        return 'cancelled'
+    return 'failed' if is_failed(task) else 'finished'
+
+
+def make_completion_notice(task_id: str, task: dict) -> dict:
+    stats = {'elapsed': round(task['completion_timestamp'] - task['start_timestamp'], 3)}
+    if isinstance(task.get('return_value'), TaskResult):
+        stats.update(task['return_value'].get_stats())
+    return {'task_id': task_id,
+            'status': get_status(task),
+            'location': task['external_location'],
+            'stats': stats}
+
+
+def make_event(event: str, data: dict) -> str:
+    return 'event: ' + event + '\ndata: ' + json.dumps(data) + '\n\n'
+
+
 # ++++ ROUTES ++++
 
 # task locations are generic (/tasks/{task_id}), not bound to specific api versions
@@ -92,14 +223,83 @@ def async_api(wrapped_function):
 @tasks_api.route('/<task_id>') # restplus
 class GetTaskStatus(Resource):
     def get(self, task_id):
-        task = tasks.get(task_id)
+        task = get_task(task_id)
         if task is None:
             abort(404)
+        # long polling: with ?wait=N, wait up to N seconds (at most max_wait) for the task to finish
+        wait = min(get_int_arg(request, 'wait', 0), max_wait)
+        if wait and not is_finished(task):
+            with task['changed']:
+                task['changed'].wait_for(lambda: is_finished(task), timeout=wait)
         if 'return_value' not in task:
-            print(str(threading.active_count()))
-            return 'still_processing', 202, {'Location': url_for('tasks.GetTaskStatus', task_id=task_id)}
+            return 'still_processing', 202, {'Location': task['location']}
+        if isinstance(task['return_value'], TaskResult):
+            # results may be queried in parts, e.g. /tasks/{task_id}?offset=0&limit=100&fields=html
+            return task['return_value'].make_response(request)
+        if isinstance(task['return_value'], HTTPException):
+            # errors (such as aborted tasks) are answered with their status code
+            return task['return_value'].get_response()
         return task['return_value']
 
+    def delete(self, task_id):
+        """Cancels a task and removes it (and its result, if any). A running task stops at its next abort check
+        (see workers.check_abort), and its worker processes are terminated."""
+        with tasks_lock:
+            task = remove_task(task_id)
+        if task is None:
+            abort(404)
+        task['cancelled'].set()
+        return '', 204
+
+
+@tasks_bp.route('/<task_id>/events') # async_api
+@tasks_api.route('/<task_id>/events') # restplus
+class GetTaskEvents(Resource):
+    def get(self, task_id):
+        """Streams the progress of a task as Server-Sent Events: a 'progress' event for each stage that the task
+        reaches, and a final 'complete' event (with the location of the result) once the task has finished."""
+        task = get_task(task_id)
+        if task is None:
+            abort(404)
+
+        def generate():
+            sent = 0
+            while True:
+                with task['changed']:
+                    task['changed'].wait_for(lambda: is_finished(task) or len(task['progress']) > sent,
+                                             timeout=keepalive_interval)
+                    progress = task['progress'][sent:]
+                    finished = is_finished(task)
+                for stage in progress:
+                    yield make_event('progress', stage)
+                sent += len(progress)
+                if finished:
+                    yield make_event('complete', {'status': get_status(task),
+                                                  'location': task['location']})
+                    return
+                if not progress:
+                    yield ': keepalive\n\n'
+
+        return Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@tasks_bp.route('/metrics') # async_api
+@tasks_api.route('/metrics') # restplus
+class TaskMetrics(Resource):
+    def get(self):
+        """Reports the state of the task registry and of the result store, and the number of evicted tasks and results
+        (see evict_tasks and results.evict_results)."""
+        with tasks_lock:
+            metrics = dict(task_metrics)
+            metrics['tasks'] = len(tasks)
+            metrics['running'] = sum(1 for task in tasks.values() if 'completion_timestamp' not in task)
+        metrics.update(result_metrics)
+        metrics['results_budget'] = results.results_budget
+        metrics['files_budget'] = results.files_budget
+        metrics['max_age'] = task_max_age
+        return metrics
+
 
 """
 @tasks_bp.route('/<task_id>', methods=['GET'])
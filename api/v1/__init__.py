@@ -1,7 +1,2 @@
-from flask import Blueprint
-from flask_restplus import Api
-
-blueprint = Blueprint('v1', __name__)
-api_v1 = Api(blueprint)
-
-from api.v1 import routes
+# the blueprint and the routes of this api version are defined in routes.py, which is imported by the app factory
+# (see create_api_app) rather than here, so that the factories can be imported without Flask
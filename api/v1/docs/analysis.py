@@ -62,13 +62,18 @@ class DocAnalysis(ABC):
 
     # CITETRAILS:
 
-    @abstractmethod
-    def make_citetrail(self, node: etree._Element):
-        pass
-
-    def get_citetrail_ancestors(self, node: etree._Element):
-        return list([anc for anc in node.xpath('ancestor::*') if self.is_structural_node(anc)])[::-1]
-        # revert list so that ancestors are positioned relative to current node
+    def make_citetrail(self, node: etree._Element, position: int, parent_citetrail: str):
+        """
+        Makes the citetrail for a node, which is its position appended to the citetrail of its parent (e.g., '2.3'),
+        unless a doc type defines citetrails of its own.
+        :param position: the position of the node among its siblings that are structural or basic nodes
+        :param parent_citetrail: the citetrail of the nearest ancestor that is a structural or basic node, or None
+        """
+        cite = str(position)
+        citetrail = cite
+        if parent_citetrail is not None:
+            citetrail = parent_citetrail + '.' + cite
+        return citetrail
 
 
 class GuidelinesAnalysis(DocAnalysis):
@@ -108,21 +113,10 @@ class GuidelinesAnalysis(DocAnalysis):
     def make_title(self, node: etree._Element) -> str:
         return 'placeholder'  # TODO
 
-    def make_citetrail(self, node: etree._Element):
-        node_id = node.get('id')
-        citetrail_preceding = [prec for prec in node.xpath('preceding-sibling::*') if self.get_node_type(prec)]
-        citetrail_ancestors = [anc for anc in node.xpath('ancestor::*') if self.get_node_type(anc)]
-        cite = str(len(citetrail_preceding) + 1)
-        citetrail = cite
-        if len(citetrail_ancestors):
-            citetrail_parent = citetrail_ancestors[::-1][0]  # TODO does this work?
-            cp_citetrail = self.config.get_citetrail_mapping(get_xml_id(citetrail_parent))
-            citetrail = cp_citetrail + '.' + cite
-        return citetrail
 
-    def get_citetrail_ancestors(self, node: etree._Element):
-        return list([anc for anc in node.xpath('ancestor::*') if self.is_structural_node(anc)])[::-1]
-        # revert list so that ancestors are positioned relative to current node
+class FaqAnalysis(GuidelinesAnalysis):
+    """The FAQ are structured like the guidelines (divs with headings, paragraphs, and lists)."""
+    pass
 
 
 class ProjectmembersAnalysis(DocAnalysis):
@@ -159,9 +153,6 @@ class ProjectmembersAnalysis(DocAnalysis):
     def make_title(self, node: etree._Element) -> str:
         return 'placeholder'  # TODO
 
-    def make_citetrail(self, node: etree._Element):
-        return 'placeholder' # TODO
-
 
 class SpecialcharsAnalysis(DocAnalysis):
 
@@ -194,6 +185,3 @@ class SpecialcharsAnalysis(DocAnalysis):
             return str(node.xpath('tei:desc/text()', namespaces=xml_ns)[0])
         else:
             return None
-
-    def make_citetrail(self, node: etree._Element):
-        return 'placeholder'  # TODO
\ No newline at end of file
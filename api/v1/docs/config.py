@@ -10,10 +10,23 @@ doc_id_filenames = {
 
 tei_docs_path = 'tests/resources/in/svsal-tei/revision'  # TODO
 
+# number of rendered basic node fragments (html and txt) that are cached by node hash (see factory.render_basic_nodes)
+fragment_cache_size = 8192
+
+# number of processes for rendering the fragments of a doc in parallel; 1: sequential rendering
+render_processes = 4
+
+# minimum number of (uncached) basic nodes per process, below which fragments are rendered sequentially
+render_chunk_min_size = 64
+
+# number of seconds after which the rendering processes of a doc are terminated (the doc's task is aborted then)
+render_time_limit = 300
+
 
 class DocConfig:
 
-    def __init__(self, node_count=0):
+    def __init__(self, did=None, node_count=0):
+        self.did = did
         self.node_mappings = {}
         self.node_count = node_count
         self.cite_depth = 0
@@ -1,14 +1,28 @@
 from api.v1.docs.config import DocConfig, doc_id_filenames
-from api.v1.xutils import safe_xinclude, flatten
+from api.v1.xutils import resolve_xincludes, flatten
 from api.v1.errors import QueryValidationError
 from api.v1.xutils import is_element, get_xml_id
 from api.v1.errors import NodeIndexingError, QueryValidationError
-from api.v1.docs.analysis import DocAnalysis, GuidelinesAnalysis, ProjectmembersAnalysis, SpecialcharsAnalysis
-from api.v1.docs.html import DocHTMLTransformer, GuidelinesHTMLTransformer, ProjectmembersHTMLTransformer, \
-    SpecialcharsHTMLTransformer
-from api.v1.docs.config import tei_docs_path
+from api.v1.xutils import make_dts_fragment_string, xml_ns
+from api.v1.docs.analysis import DocAnalysis, GuidelinesAnalysis, FaqAnalysis, ProjectmembersAnalysis, \
+    SpecialcharsAnalysis
+from api.v1.docs.html import DocHTMLTransformer, GuidelinesHTMLTransformer, FaqHTMLTransformer, \
+    ProjectmembersHTMLTransformer, SpecialcharsHTMLTransformer
+from api.v1.docs.txt import DocTXTTransformer
+from api.v1.docs.config import tei_docs_path, fragment_cache_size, render_processes, render_chunk_min_size, \
+    render_time_limit
+from api.results import JSONResult, hold_result, get_held_result
+from api.workers import report_progress, check_abort, reserve_workers, release_workers, run_in_workers
 from lxml import etree
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
 
 
 class DocFactory(ABC):
@@ -29,18 +43,27 @@ class DocFactory(ABC):
             struct_index.append(n)
         return struct_index
 
-    def extract_structure(self, node: etree._Element):
+    def extract_structure(self, node: etree._Element, node_type=None, position=1, parent_citetrail=None, level=1):
         """
         Analyzes a TEI node, copies information relevant for indexing to a new sal_node element, and recursively
         analyzes all the descendants of the current node (appending relevant descendant sal_nodes to the current
-        sal_node's children.
+        sal_node's children. Information about siblings and ancestors is passed down the recursion, so that the
+        whole tree is indexed in a single traversal.
         :param node: the TEI node to be analyzed (might be any type of node)
-        :param config: the configuration object for the current factory event
-        :param analysis: the node analysis object for the current factory event
+        :param node_type: the type of the node (see DocAnalysis.get_node_type), if already determined by the caller
+        :param position: the position of the node among its siblings of some type (if node has a type itself)
+        :param parent_citetrail: the citetrail of the nearest ancestor with a type, or None if there is no such ancestor
+        :param level: the number of structural ancestors of the node, plus 1
         :return: either a sal_node element or None
         """
         if is_element(node):
-            node_type = self.analysis.get_node_type(node)
+            check_abort()
+            if node_type is None:
+                node_type = self.analysis.get_node_type(node)
+            citetrail = parent_citetrail
+            if node_type:
+                citetrail = self.analysis.make_citetrail(node, position, parent_citetrail)
+            sal_node = None
             if get_xml_id(node) and node_type:
                 sal_node = etree.Element('sal_node')
                 node_id = get_xml_id(node)
@@ -57,19 +80,26 @@ class DocFactory(ABC):
                 sal_node.set('title', title)  # TODO as child rather than attr?
 
                 # CITETRAIL
-                citetrail = self.analysis.make_citetrail(node)
                 self.config.put_citetrail_mapping(node_id, citetrail)
                 sal_node.set('citetrail', citetrail)
 
                 # LEVEL
-                citetrail_ancestors = self.analysis.get_citetrail_ancestors(node)
-                level = len(citetrail_ancestors) + 1
                 sal_node.set('level', str(level))
                 if self.config.get_cite_depth() < level:
                     self.config.set_cite_depth(level)
 
-                # CHILD NODES
-                children = list(flatten([self.extract_structure(child) for child in node]))
+            # CHILD NODES (counting the siblings with a type on the fly)
+            child_level = level + 1 if node_type == 'structural' else level
+            children = []
+            child_position = 0
+            for child in node:
+                child_type = self.analysis.get_node_type(child) if is_element(child) else ''
+                if child_type:
+                    child_position += 1
+                children.append(self.extract_structure(child, child_type, child_position, citetrail, child_level))
+
+            if sal_node is not None:
+                children = list(flatten(children))
                 if len(children) > 0:
                     sal_children = etree.Element('children')
                     for child in children:
@@ -80,10 +110,37 @@ class DocFactory(ABC):
                     sal_node.append(sal_children)
                 return sal_node
             else:
-                return [self.extract_structure(child) for child in node]
+                return children
         else:
             pass
 
+    def make_fragment_key(self, node: etree._Element) -> str:
+        """
+        Makes the cache key for the fragments of a basic node: a hash of the node's markup and of everything else its
+        rendering depends on, i.e. the doc type, the node's citetrail, and the citetrails of its internal link targets.
+        Requires that the structural index of the doc has been made.
+        """
+        key = hashlib.sha1()
+        citetrail = self.config.get_citetrail_mapping(get_xml_id(node))
+        key.update((self.config.did + '\n' + citetrail + '\n').encode('UTF-8'))
+        for target in node.xpath('descendant-or-self::*/@target'):
+            if target.startswith('#'):
+                key.update((target + '=' + (self.config.get_citetrail_mapping(target[1:]) or '') + '\n')
+                           .encode('UTF-8'))
+        key.update(etree.tostring(node, with_tail=False))
+        return key.hexdigest()
+
+    def render_fragments(self, node: etree._Element):
+        """Renders a basic node as HTML and TXT.
+        :return: a tuple (html, txt) of serialized dts:fragments
+        """
+        html_node = self.html_transformer.transform_basic_node(node)
+        if etree.iselement(html_node):
+            html_node.set('id', self.config.get_citetrail_mapping(get_xml_id(node)))
+        txt = self.txt_transformer.transform_basic_node(node)
+        return str(make_dts_fragment_string(html_node), encoding='UTF-8'), \
+               str(make_dts_fragment_string(txt), encoding='UTF-8')
+
 
 class GuidelinesFactory(DocFactory):
 
@@ -91,6 +148,16 @@ class GuidelinesFactory(DocFactory):
         self.config = config
         self.analysis = GuidelinesAnalysis(config)
         self.html_transformer = GuidelinesHTMLTransformer(config)
+        self.txt_transformer = DocTXTTransformer(config)
+
+
+class FaqFactory(DocFactory):
+
+    def __init__(self, config: DocConfig):
+        self.config = config
+        self.analysis = FaqAnalysis(config)
+        self.html_transformer = FaqHTMLTransformer(config)
+        self.txt_transformer = DocTXTTransformer(config)
 
 
 class ProjectmembersFactory(DocFactory):
@@ -99,6 +166,7 @@ class ProjectmembersFactory(DocFactory):
         self.config = config
         self.analysis = ProjectmembersAnalysis(config)
         self.html_transformer = ProjectmembersHTMLTransformer(config)
+        self.txt_transformer = DocTXTTransformer(config)
 
 
 class SpecialcharsFactory(DocFactory):
@@ -106,6 +174,7 @@ class SpecialcharsFactory(DocFactory):
         self.config = config
         self.analysis = SpecialcharsAnalysis(config)
         self.html_transformer = SpecialcharsHTMLTransformer(config)
+        self.txt_transformer = DocTXTTransformer(config)
 
 
 def create_doc_factory(doc_id: str) -> DocFactory:
@@ -113,9 +182,11 @@ def create_doc_factory(doc_id: str) -> DocFactory:
     :param doc_id: the id for the documentation type, as passed in from the client
     :return: an instance of a concrete DocFactory (i.e., of a subclass of DocFactory)
     """
-    config = DocConfig()
+    config = DocConfig(did=doc_id)
     if doc_id == 'guidelines':
         return GuidelinesFactory(config)
+    elif doc_id == 'faq':
+        return FaqFactory(config)
     elif doc_id == 'projectmembers':
         return ProjectmembersFactory(config)
     elif doc_id == 'specialchars':
@@ -124,27 +195,196 @@ def create_doc_factory(doc_id: str) -> DocFactory:
         return None  # TODO raise error?
 
 
-def transform(doc_id: str, request_data):
+# parsed and xincluded docs together with their structural indexes, by doc_id: ({path: mtime} of the doc file and of all
+# files it includes, factory, TEI root, structural index); entries are rebuilt once any of these files has changed
+docs = {}
+docs_lock = threading.Lock()
 
-    # 1.) Fetch file
-    filename = doc_id_filenames.get(doc_id)
-    if not filename:
-        raise QueryValidationError('Could not find matching file for doc_id ' + doc_id)
 
-    # 2.) Setup (factory, parser, config, element tree, etc.)
+def is_up_to_date(dependencies: dict) -> bool:
+    try:
+        return all(os.stat(path).st_mtime_ns == mtime for path, mtime in dependencies.items())
+    except FileNotFoundError:
+        return False
+
+
+def get_doc(doc_id: str, filename: str):
+    """Gets the factory, the (xincluded) TEI root, and the structural index for a doc, which are cached as long as
+    the doc's files do not change. The cached nodes must not be modified.
+    :return: a tuple (factory, tei_root, structural_index)
+    """
+    return get_doc_entry(doc_id, filename)[1:]
+
+
+def get_doc_entry(doc_id: str, filename: str):
+    """Like get_doc, but also returns the {path: mtime} dependencies of the doc as the first item of the tuple."""
+    with docs_lock:
+        cached = docs.get(doc_id)
+    if cached and is_up_to_date(cached[0]):
+        return cached
+
     factory = create_doc_factory(doc_id)
+    if factory is None:
+        raise QueryValidationError('Docs of type ' + doc_id + ' cannot be processed yet')
     parser = etree.XMLParser(attribute_defaults=False, no_network=False, ns_clean=True, remove_blank_text=False,
                              remove_comments=False, remove_pis=False, compact=False, collect_ids=True,
                              resolve_entities=False, huge_tree=False,
                              encoding='UTF-8')  # huge_tree=True, ns_clean=False ?
-    tree = etree.parse(tei_docs_path + '/' + filename + '.xml', parser)  # TODO url; requires that did = filename
-    tei_root = safe_xinclude(tree)
+    path = tei_docs_path + '/' + filename + '.xml'  # TODO url; requires that did = filename
+    dependencies = {os.path.abspath(path): os.stat(path).st_mtime_ns}
+    tree = etree.parse(path, parser)
+    tei_root = tree.getroot()
+    dependencies.update(resolve_xincludes(tei_root))
 
-    # 3.) Information Extraction
-    # a) extract the structural "skeleton" of the text, including basic node information
+    # extract the structural "skeleton" of the text, including basic node information
     structural_index = factory.make_structural_index(tei_root)
-    # output for debugging:
-    index_str = etree.tostring(structural_index, pretty_print=True)
-    with open('tests/resources/out/' + doc_id + "_index.xml", "wb") as fo:
-        fo.write(index_str)
+    entry = (dependencies, factory, tei_root, structural_index)
+    with docs_lock:
+        docs[doc_id] = entry
+    return entry
+
+
+def warm_up():
+    """Loads (i.e., parses and indexes, see get_doc) all docs that are available, so that the render processes
+    forked from the fork server (see preload.py) share them rather than each loading them again. Docs that cannot be
+    loaded are skipped."""
+    for doc_id, filename in doc_id_filenames.items():
+        try:
+            get_doc(doc_id, filename)
+        except QueryValidationError:
+            pass  # docs of this type cannot be processed yet
+        except (OSError, etree.LxmlError) as e:
+            logger.warning('Could not load doc %s: %s', doc_id, e)
+
+
+# rendered fragments of basic nodes, by fragment key (see DocFactory.make_fragment_key): (html, txt); since the key
+# covers everything a node's rendering depends on, unchanged nodes are not rendered again when their doc has changed
+fragments = OrderedDict()
+fragments_lock = threading.Lock()
+
+xml_id_attr = '{' + xml_ns['xml'] + '}id'
+
+
+def get_cached_fragments(key: str):
+    with fragments_lock:
+        cached = fragments.get(key)
+        if cached is not None:
+            fragments.move_to_end(key)
+        return cached
+
+
+def put_cached_fragments(key: str, rendered):
+    with fragments_lock:
+        fragments[key] = rendered
+        fragments.move_to_end(key)
+        while len(fragments) > fragment_cache_size:
+            fragments.popitem(last=False)
+
+
+def get_nodes_by_id(tei_root: etree._Element) -> dict:
+    return {node.get(xml_id_attr): node for node in tei_root.xpath('descendant-or-self::*[@xml:id]', namespaces=xml_ns)}
+
+
+def render_chunk(doc_id: str, filename: str, node_ids: list) -> list:
+    """
+    Renders the basic nodes node_ids of a doc; runs in a worker process of the rendering task, where the doc is parsed
+    and indexed (at most) once per change (see get_doc).
+    :return: the tuples (html, txt) of the nodes, in the order of node_ids
+    """
+    factory, tei_root, structural_index = get_doc(doc_id, filename)
+    nodes = get_nodes_by_id(tei_root)
+    return [factory.render_fragments(nodes[node_id]) for node_id in node_ids]
+
+
+def render_basic_nodes(doc_id: str, filename: str, factory: DocFactory, tei_root: etree._Element,
+                       node_ids: list) -> dict:
+    """
+    Gets the fragments of the basic nodes node_ids of a doc, from the fragment cache if possible. Nodes that are not
+    cached are rendered by worker processes if there are enough of them, otherwise sequentially.
+    :return: {xml:id: (html, txt)}
+    """
+    nodes = get_nodes_by_id(tei_root)
+    rendered = {}
+    uncached = []  # (xml:id, fragment key)
+    for node_id in node_ids:
+        check_abort()
+        key = factory.make_fragment_key(nodes[node_id])
+        cached = get_cached_fragments(key)
+        if cached is not None:
+            rendered[node_id] = cached
+        else:
+            uncached.append((node_id, key))
+    processes = 0
+    wanted = min(render_processes, len(uncached) // render_chunk_min_size)
+    if wanted > 1:
+        # worker processes are shared by all tasks (see workers.reserve_workers)
+        processes = reserve_workers(wanted)
+    if processes < 2:
+        release_workers(processes)
+        results = []
+        for node_id, key in uncached:
+            check_abort()
+            results.append(factory.render_fragments(nodes[node_id]))
+    else:
+        # chunks of consecutive nodes, one per process
+        chunk_size = -(-len(uncached) // processes)
+        try:
+            chunks = [(doc_id, filename, [node_id for node_id, key in uncached[i:i + chunk_size]])
+                      for i in range(0, len(uncached), chunk_size)]
+            results = [result for chunk in run_in_workers(render_chunk, chunks, processes, render_time_limit)
+                       for result in chunk]
+        finally:
+            release_workers(processes)
+    for (node_id, key), result in zip(uncached, results):
+        put_cached_fragments(key, result)
+        rendered[node_id] = result
+    return rendered
+
+
+# {path: mtime} of the files of the complete results by doc_id, which are held in the shared result store (see
+# results.hold_result) under ('doc', doc_id); frequently requested docs (such as the guidelines and the FAQ) are served
+# from there as long as their files do not change and they are not evicted
+doc_results = {}
+doc_results_lock = threading.Lock()
+
+
+def transform(doc_id: str, request_data) -> JSONResult:
+
+    # 1.) Fetch file
+    filename = doc_id_filenames.get(doc_id)
+    if not filename:
+        raise QueryValidationError('Could not find matching file for doc_id ' + doc_id)
+    with doc_results_lock:
+        dependencies = doc_results.get(doc_id)
+    cached = get_held_result(('doc', doc_id))
+    if cached and dependencies and is_up_to_date(dependencies):
+        return cached
+
+    # 2.) Setup (factory, parser, config, element tree, etc.) and 3.) Information Extraction
+    report_progress('indexing')
+    # a) extract the structural "skeleton" of the text, including basic node information (both are cached, see get_doc)
+    dependencies, factory, tei_root, structural_index = get_doc_entry(doc_id, filename)
+
+    # 4.) FRAGMENTS: html and txt of basic nodes (cached by node hash, and rendered in parallel for larger docs)
+    report_progress('fragments')
+    basic_ids = [node.get('id') for node in structural_index.iter('sal_node') if node.get('basic') == 'true']
+    rendered = render_basic_nodes(doc_id, filename, factory, tei_root, basic_ids)
+    passages = []
+    for node in structural_index.iter('sal_node'):
+        fragment = {'@id': node.get('citetrail'),
+                    'id': node.get('id'),
+                    'type': node.get('type'),
+                    'title': node.get('title'),
+                    'level': int(node.get('level')),
+                    'basic': node.get('basic') == 'true'}
+        if fragment['basic']:
+            fragment['html'], fragment['txt'] = rendered[node.get('id')]
+        passages.append(fragment)
 
+    # 5.) return to routes.py
+    result = JSONResult({'doc_id': doc_id, 'cite_depth': factory.config.get_cite_depth(), 'doc_passages': passages},
+                        'doc_passages')
+    with doc_results_lock:
+        doc_results[doc_id] = dependencies
+    hold_result(('doc', doc_id), result)
+    return result
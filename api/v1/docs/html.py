@@ -1,46 +1,172 @@
-
+from lxml import etree
+import re
+from api.v1.xutils import xml_ns, is_element, is_text_node, get_list_type, get_xml_id, flatten
+from api.v1.docs.config import DocConfig
 from abc import ABC, abstractmethod
 
 
 class DocHTMLTransformer(ABC):
     """
-    Transforms a basic node's TEI into HTML.
+    Transforms a basic node's TEI into HTML. Elements without a specific transformation function are passed through
+    as span elements (classed by their TEI name), so that unknown markup in docs never breaks rendering.
     """
 
     @abstractmethod
-    def __init__(self):
+    def __init__(self, config: DocConfig):
         pass
 
-    @abstractmethod
-    def transform_basic_node(self):
-        pass
+    # simple mappings of TEI elements to HTML elements: TEI name -> (HTML name, class)
+    element_mappings = {
+        'p': ('p', None),
+        'item': ('li', None),
+        'emph': ('em', None),
+        'term': ('span', 'term'),
+        'foreign': ('span', 'foreign'),
+        'title': ('span', 'title'),
+        'quote': ('q', None),
+        'code': ('code', None),
+        'eg': ('pre', None),
+        'table': ('table', None),
+        'row': ('tr', None),
+        'cell': ('td', None),
+        'label': ('span', 'label')
+    }
+
+    def transform_basic_node(self, node: etree._Element) -> etree._Element:
+        """Transforms a basic node (including all its descendants) into a single HTML element."""
+        return self.dispatch(node)
+
+    def dispatch(self, node):
+        if is_element(node):
+            localname = etree.QName(node).localname
+            elem_function = getattr(self, 'transform_' + localname.lower(), None)
+            if callable(elem_function):
+                return elem_function(node)
+            mapping = self.element_mappings.get(localname, ('span', localname))
+            return self.make_element(node, mapping[0], mapping[1])
+        elif is_text_node(node):
+            return self.transform_text_node(node)
+        # omit comments and processing instructions
+
+    def passthru(self, node):
+        return list(flatten([self.dispatch(child) for child in node.xpath('node()')]))
+
+    def make_element(self, node, elem_name, elem_class=None):
+        """Makes an HTML element elem_name with the transformed children of node."""
+        elem = etree.Element(elem_name)
+        if elem_class:
+            elem.set('class', elem_class)
+        return self.transform_append_children(elem, self.passthru(node))
+
+    def transform_append_children(self, transform_elem, children):
+        preceding_elem = None
+        for child in children:
+            if etree.iselement(child):
+                transform_elem.append(child)
+                preceding_elem = child
+            elif isinstance(child, str):
+                if preceding_elem is not None:
+                    preceding_elem.tail = (preceding_elem.tail or '') + child
+                else:
+                    transform_elem.text = (transform_elem.text or '') + child
+        return transform_elem
+
+    def transform_text_node(self, node):
+        return re.sub(r'\s+', ' ', str(node))
+
+    # TEI->HTML ELEMENT FUNCTIONS
+
+    def transform_head(self, node):
+        level = min(len(node.xpath('ancestor::tei:div', namespaces=xml_ns)) + 1, 6)
+        return self.make_element(node, 'h' + str(level))
+
+    def transform_hi(self, node):
+        rendition = node.get('rendition') or ''
+        if '#b' in rendition:
+            return self.make_element(node, 'b')
+        elif '#it' in rendition:
+            return self.make_element(node, 'i')
+        elif '#sup' in rendition:
+            return self.make_element(node, 'sup')
+        return self.make_element(node, 'span', 'hi')
+
+    def transform_lb(self, node):
+        if node.get('break') == 'no':
+            return None
+        return etree.Element('br')
+
+    def transform_list(self, node):
+        if get_list_type(node) == 'ordered':
+            return self.make_element(node, 'ol')
+        return self.make_element(node, 'ul')
+
+    def transform_ref(self, node):
+        a = self.make_element(node, 'a')
+        target = node.get('target')
+        if target:
+            a.set('href', self.resolve_target(target))
+        return a
+
+    def transform_ptr(self, node):
+        target = node.get('target') or ''
+        a = etree.Element('a')
+        a.set('href', self.resolve_target(target))
+        a.text = target
+        return a
+
+    def resolve_target(self, target: str) -> str:
+        """Resolves internal targets (#xml:id) to anchors of the respective citetrails; other targets are kept."""
+        if target.startswith('#'):
+            citetrail = self.config.get_citetrail_mapping(target[1:])
+            if citetrail:
+                return '#' + citetrail
+        return target
 
 
 class GuidelinesHTMLTransformer(DocHTMLTransformer):
 
-    def __init__(self, config):
+    def __init__(self, config: DocConfig):
         self.config = config
 
-    def transform_basic_node(self):
-        return 'test' # TODO
+
+class FaqHTMLTransformer(GuidelinesHTMLTransformer):
+    pass
 
 
 class ProjectmembersHTMLTransformer(DocHTMLTransformer):
 
-    def __init__(self, config):
+    def __init__(self, config: DocConfig):
         self.config = config
 
-    def transform_basic_node(self):
-        return 'test' # TODO
+    def transform_person(self, node):
+        return self.make_element(node, 'div', 'person')
+
+    def transform_org(self, node):
+        return self.make_element(node, 'div', 'org')
+
+    def transform_persname(self, node):
+        return self.make_element(node, 'span', 'persName')
+
+    def transform_orgname(self, node):
+        return self.make_element(node, 'span', 'orgName')
 
 
 class SpecialcharsHTMLTransformer(DocHTMLTransformer):
 
-    def __init__(self, config):
+    def __init__(self, config: DocConfig):
         self.config = config
 
-    def transform_basic_node(self):
-        return 'test' # TODO
+    def transform_char(self, node):
+        div = self.make_element(node, 'div', 'char')
+        if get_xml_id(node):
+            div.set('id', get_xml_id(node))
+        return div
+
+    def transform_mapping(self, node):
+        span = self.make_element(node, 'span', 'mapping')
+        if node.get('type'):
+            span.set('title', node.get('type'))
+        return span
 
 
 class ProjectdescHTMLTransformer(DocHTMLTransformer):
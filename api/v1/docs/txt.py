@@ -0,0 +1,51 @@
+from lxml import etree
+import re
+from api.v1.xutils import flatten, is_element, is_text_node
+from api.v1.docs.config import DocConfig
+
+
+class DocTXTTransformer:
+    """Transforms a basic node's TEI into plain text (with normalized whitespace)."""
+
+    def __init__(self, config: DocConfig):
+        self.config = config
+
+    def transform_basic_node(self, node: etree._Element) -> str:
+        return '\n'.join(' '.join(line.split()) for line in self.dispatch(node).split('\n')).strip()
+
+    def dispatch(self, node):
+        if is_element(node):
+            elem_function = getattr(self, 'transform_' + etree.QName(node).localname.lower(), None)
+            if callable(elem_function):
+                return elem_function(node)
+            return self.passthru(node)
+        elif is_text_node(node):
+            return self.transform_text_node(node)
+        else:
+            return ''
+        # omit comments and processing instructions
+
+    def passthru(self, node):
+        return ''.join(flatten([self.dispatch(child) for child in node.xpath('node()')]))
+
+    def transform_text_node(self, node):
+        return re.sub(r'\s+', ' ', str(node))
+
+    # ELEMENT FUNCTIONS
+
+    def transform_lb(self, node):
+        if not node.get('break') == 'no':
+            return ' '
+        return ''
+
+    def transform_item(self, node):
+        return '\n- ' + self.passthru(node)
+
+    def transform_list(self, node):
+        return self.passthru(node) + '\n'
+
+    def transform_row(self, node):
+        return '\n' + self.passthru(node)
+
+    def transform_cell(self, node):
+        return self.passthru(node) + ' '
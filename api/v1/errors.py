@@ -4,6 +4,11 @@ class TEIMarkupError(Exception):
     pass
 
 
+class XIncludeError(Exception):
+    """Raised if an xi:include cannot be resolved (and has no xi:fallback)."""
+    pass
+
+
 class TEIUnkownElementError(Exception):
     pass
 
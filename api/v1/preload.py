@@ -0,0 +1,17 @@
+"""
+Loaded by the fork server from which the worker processes of tasks are forked (see workers.make_worker_pool): imports
+the factory modules (and, with them, lxml and all compiled XPaths, but not the web stack), and warms up the works
+factories and docs, so that the worker processes share all of this with the fork server copy-on-write. Not to be
+imported by the app itself.
+"""
+
+import gc
+from api.v1.works import factory as work_factory
+from api.v1.docs import factory as doc_factory
+
+
+work_factory.warm_up()
+doc_factory.warm_up()
+
+# keep the garbage collector of the worker processes from touching (and thereby copying) the preloaded objects
+gc.freeze()
@@ -1,15 +1,25 @@
-from flask_restplus import Resource
-from flask import request
-from api.v1 import api_v1
+from flask_restplus import Resource, Api
+from flask import Blueprint, request, abort, Response
 from api.tasks import async_api
+from api.results import get_int_arg
 from api.v1.works import factory as work_factory
+from api.v1.works.result import put_work_result, get_work_result, get_work_navigation, make_navigation, \
+    document_formats
+from api.v1.works.corpus import refresh_linking_works
 from api.v1.docs import factory as doc_factory
+from api.v1.xutils import supported_content_encodings
+from lxml import etree
+import os
 import time
+import zlib
 from flask import jsonify
 
 
 # ++++ V1 ROUTES ++++
 
+blueprint = Blueprint('v1', __name__)
+api_v1 = Api(blueprint)
+
 
 @api_v1.route('/')
 class HelloWorld(Resource):
@@ -34,17 +44,80 @@ class LongRunningTask(Resource):
 
 @api_v1.route('/texts/<string:wid>')
 class WorkFactoryEvent(Resource):
-    @async_api
     def post(self, wid, path=''):
+        # the request body is parsed while it is being read (rather than via request.data, which buffers it
+        # completely), and this is done before the task is started: once the 202 response has been sent, the server
+        # does not keep the rest of the body available for reading
+        content_encoding = request.headers.get('Content-Encoding')
+        if content_encoding and content_encoding.lower() not in supported_content_encodings:
+            abort(415, 'Unsupported Content-Encoding: ' + content_encoding)
+        factory = work_factory.acquire_factory()
+        try:
+            tei_root, tei_path = work_factory.receive_work(request.stream, factory.parser, content_encoding)
+        except BaseException as e:
+            # e.g., malformed data, or the client has disconnected while sending it (receive_work has removed the
+            # partially spooled dataset already)
+            work_factory.release_factory(factory, failed=True)
+            if isinstance(e, (etree.XMLSyntaxError, zlib.error)):
+                abort(400, 'Invalid TEI dataset: ' + str(e))
+            raise
+        try:
+            return self.transform(wid, factory, tei_root, tei_path)
+        except BaseException:
+            # the task has not been started (e.g., due to an invalid query parameter)
+            if tei_path:
+                os.remove(tei_path)
+            work_factory.release_factory(factory)
+            raise
+
+    @async_api
+    def transform(self, wid, factory, tei_root, tei_path):
         start = time.time()
         print("Starting transformation, time: '%s'" % start)
-        request_data = request.data  # TODO process request data (once they are available in a more extensive format)
         #work_factory.transform(wid, request_data)
-        resp = work_factory.transform(wid, request_data)
+        result = work_factory.transform_received(wid, factory, tei_root, tei_path)
+        put_work_result(result)
+        # links from other works into this work might resolve differently now
+        refresh_linking_works(wid)
         end = time.time()
         print("Ending transformation, time: '%s'" % end)
         print('Elapsed time: ', end - start)
-        return jsonify(resp)
+        return result
+
+
+@api_v1.route('/texts/<string:wid>/navigation')
+class WorkNavigation(Resource):
+    def get(self, wid):
+        """DTS navigation for the most recently transformed version of a work: lists the members up to ?level=N
+        (default: 1) levels below the passage ?ref=<citetrail> (default: the work itself)."""
+        index = get_work_navigation(wid)
+        if index is None:
+            abort(404, 'Work ' + wid + ' has not been transformed yet')
+        navigation = make_navigation(wid, index, request.args.get('ref'), get_int_arg(request, 'level', 1))
+        if navigation is None:
+            abort(404, 'Unknown reference: ' + request.args.get('ref'))
+        return navigation
+
+
+@api_v1.route('/texts/<string:wid>/document')
+class WorkDocument(Resource):
+    def get(self, wid):
+        """DTS document for a single passage ?ref=<citetrail> of the most recently transformed version of a work, in
+        ?format=html|txt_edit|txt_orig|tei (default: html)."""
+        result = get_work_result(wid)
+        if result is None:
+            # (also if the result has been evicted meanwhile, see results.hold_result)
+            abort(404, 'Work ' + wid + ' has not been transformed yet (or its result has been evicted)')
+        ref = request.args.get('ref')
+        fmt = request.args.get('format', 'html')
+        if not ref:
+            abort(400, 'Query parameter ref is required')
+        if fmt not in document_formats:
+            abort(400, 'Query parameter format must be one of: ' + ', '.join(document_formats))
+        passage = result.get_passage(ref, fmt)
+        if passage is None:
+            abort(404, 'No ' + fmt + ' content for reference: ' + ref)
+        return Response(passage, mimetype=document_formats[fmt])
 
 @api_v1.route('/docs/<string:did>')
 class DocFactoryEvent(Resource):
@@ -53,11 +126,12 @@ class DocFactoryEvent(Resource):
         start = time.time()
         print("Starting transformation, time: '%s'" % start)
         request_data = request.data # TODO process request data (once they are available in a more extensive format)
-        doc_factory.transform(did, request_data)
+        # frequently requested docs are returned from cache as long as their files have not changed
+        result = doc_factory.transform(did, request_data)
         end = time.time()
         print("Ending transformation, time: '%s'" % end)
         print('Elapsed time: ', end - start)
-        return {'answer': 'processed'}
+        return result
 
 
 '''
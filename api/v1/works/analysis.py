@@ -6,6 +6,18 @@ from lxml import etree
 import re
 
 
+def cut_at_open_bracket(text: str, bracket: str) -> str:
+    """
+    Cuts a text (the prefix of some longer text, with bracketed parts already removed) at the first bracket that
+    might still be closed in the longer text, i.e. the first bracket on the last line (since bracketed parts do not
+    span lines).
+    """
+    open_position = text.find(bracket, text.rfind('\n') + 1)
+    if open_position >= 0:
+        return text[:open_position]
+    return text
+
+
 class WorkAnalysis:
 
     def __init__(self, config: WorkConfig):
@@ -417,8 +429,20 @@ class WorkAnalysis:
         return title
 
     def make_node_teaser(self, elem):
-        normalized_text = normalize_space(re.sub(r'\{.*?\}', '', re.sub(r'\[.*?\]', '',
-                                                                        self.txt_transformer.dispatch(elem, 'edit'))))
+        # only a prefix of elem's text is rendered, which is extended until it is long enough for the teaser
+        budget = 2 * config_teaser_length
+        while True:
+            text, complete = self.txt_transformer.dispatch_bounded(elem, 'edit', budget)
+            if complete:
+                normalized_text = normalize_space(re.sub(r'\{.*?\}', '', re.sub(r'\[.*?\]', '', text)))
+                break
+            # brackets that are still open at the end of the prefix might be closed later on, so the prefix is only
+            # reliable up to the first of them
+            without_brackets = cut_at_open_bracket(re.sub(r'\[.*?\]', '', text), '[')
+            normalized_text = normalize_space(cut_at_open_bracket(re.sub(r'\{.*?\}', '', without_brackets), '{'))
+            if len(normalized_text) > config_teaser_length:
+                break
+            budget *= 4
         if len(normalized_text) > config_teaser_length:
             shortened = normalize_space(normalized_text[:config_teaser_length])
             return '"' + shortened + '…"'
@@ -1,10 +1,16 @@
+import os
 from lxml import etree
 from api.v1.xutils import xml_ns
+from config import basedir
 
 
 # preliminary path to works TEI until we have svsal-tei online:
 tei_works_path = 'tests/resources/in/svsal-tei/works'
 
+# directory where data derived from works (such as node maps) are persisted; relative to the root directory of the app
+# (rather than to the working directory), so that the app, the fork server and the worker processes agree on it
+works_data_path = os.path.join(basedir, 'data', 'works')
+
 
 # TEMPORARY / DEBUGGING
 id_server = 'https://id.salamanca.school'
@@ -68,18 +74,52 @@ citation_labels = {
 
 teaser_length = 60
 
+# number of passages (of all works and formats together) that are cached for the DTS document endpoint
+passage_cache_size = 4096
+
+# number of processes for indexing chunks (e.g., volumes or top-level divs) of a work in parallel; 1: sequential indexing
+index_processes = 4
+
+# minimum number of elements (of the text) per indexing process, below which works are indexed sequentially, since
+# starting the processes and re-parsing the TEI dataset in each of them would take longer than indexing the work
+index_chunk_min_size = 20000
+
+# number of seconds after which the indexing processes of a work are terminated (the work's task is aborted then)
+index_time_limit = 600
+
+# number of factories (with parsers and transformers) that are set up and warmed up when the app (unless
+# WARM_UP_FACTORIES is off in its config) and the indexing processes start (see factory.warm_up); idle factories are
+# reused by subsequent tasks, up to this number
+warm_factories = 2
+
+# number of teiHeaders for which extracted metadata are cached (see metadata.WorkMetadataTransformer.extract_header)
+header_cache_size = 1024
+
+# HTML serialization: 'string' writes HTML directly into string buffers (see htmlwriter.py), 'lxml' builds and
+# serializes an lxml tree for each passage
+html_serialization = 'string'
+
+# handling of {%note:<xml:id>%} placeholders for marginal notes in txt_edit/txt_orig: 'keep' leaves them to the client,
+# 'inline' replaces them with the note's text, 'link' with the note's citetrail URI (see txt.resolve_note_placeholders)
+txt_note_placeholders = 'keep'
+
 orig_class = 'orig'
 edit_class = 'edit'
 
 
 class WorkConfig:
     def __init__(self, wid, node_count=0):
-        self.wid = wid
         self.citation_labels = citation_labels
         self.teaser_length = teaser_length
+        self.reset(wid, node_count)
+
+    def reset(self, wid, node_count=0):
+        """Resets all per-work state, so that the config (and the factory using it) can be reused for another work."""
+        self.wid = wid
         self.chars = None
         self.prefix_defs = {}
         self.node_mappings = {}
+        self.facs_mappings = {}
         self.node_count = node_count
         self.cite_depth = 0
 
@@ -133,6 +173,12 @@ class WorkConfig:
             self.node_mappings[xml_id] = {}
         self.node_mappings[xml_id]['passagetrail'] = passagetrail
 
+    def get_facs_mapping(self, facs):
+        return self.facs_mappings.get(facs)
+
+    def put_facs_mapping(self, facs, xml_id, citetrail, image_uri):
+        self.facs_mappings[facs] = {'id': xml_id, 'citetrail': citetrail, 'image': image_uri}
+
     def get_citation_labels(self):
         return self.citation_labels
 
@@ -0,0 +1,144 @@
+"""
+Corpus-wide registry for resolving references between works. Citetrails of other works are looked up in their
+(memory-mapped) node maps, which are written by each completed transformation (see nodemap.py) and can be shared
+by any number of rendering processes.
+
+For each work, the cross-work links rendered into its passages are recorded, and for each linked work, a marker file
+backlinks/<target_wid>/<source_wid> indicates that the source work links to it. When a work has been transformed
+anew, only those passages of linking works whose links resolve differently now need to be updated.
+"""
+
+import json
+import os
+import threading
+from xml.sax.saxutils import escape
+from api.v1.works.config import works_data_path, id_server
+from api.v1.works.nodemap import get_node_map
+from api.v1.works.result import get_work_result, replace_work_result
+
+
+def get_cross_work_links_path(wid: str) -> str:
+    return os.path.join(works_data_path, wid + '.links.json')
+
+
+def get_backlinks_path(target_wid: str) -> str:
+    return os.path.join(works_data_path, 'backlinks', target_wid)
+
+
+def make_cross_work_uri(target_wid: str, xml_id: str) -> str:
+    """Makes the URI for node xml_id in work target_wid: the node's citetrail URI if target_wid has already been
+    indexed and contains the node, otherwise the URI of the work itself."""
+    node_map = get_node_map(target_wid)
+    citetrail = node_map.get_citetrail(xml_id) if node_map and xml_id else None
+    if citetrail:
+        return id_server + '/texts/' + target_wid + ':' + citetrail
+    return id_server + '/texts/' + target_wid
+
+
+def put_cross_work_links(wid: str, links: dict):
+    """
+    Records the cross-work links of a work and updates the backlink markers of the linked works.
+    :param links: {passage citetrail: [[target_wid, xml_id, uri, number of html anchors], ...]}, in rendering order
+    """
+    old_targets = set(link[0] for passage_links in get_cross_work_links(wid).values() for link in passage_links)
+    new_targets = set(link[0] for passage_links in links.values() for link in passage_links)
+    for target_wid in new_targets - old_targets:
+        os.makedirs(get_backlinks_path(target_wid), exist_ok=True)
+        open(os.path.join(get_backlinks_path(target_wid), wid), 'w').close()
+    for target_wid in old_targets - new_targets:
+        try:
+            os.remove(os.path.join(get_backlinks_path(target_wid), wid))
+        except FileNotFoundError:
+            pass
+    path = get_cross_work_links_path(wid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(tmp_path, 'w') as fo:
+        json.dump(links, fo)
+    os.replace(tmp_path, path)
+
+
+def get_cross_work_links(wid: str) -> dict:
+    try:
+        with open(get_cross_work_links_path(wid)) as fi:
+            return json.load(fi)
+    except FileNotFoundError:
+        return {}
+
+
+def get_linking_works(target_wid: str) -> list:
+    try:
+        return sorted(os.listdir(get_backlinks_path(target_wid)))
+    except FileNotFoundError:
+        return []
+
+
+def get_stale_links(wid: str, target_wid: str) -> dict:
+    """Determines the links from wid to target_wid that resolve to a different URI by now.
+    :return: {passage citetrail: [[target_wid, xml_id, old uri, new uri, number of html anchors], ...]}; only
+    passages containing stale links are included, but with all their cross-work links (in rendering order)
+    """
+    stale = {}
+    for citetrail, passage_links in get_cross_work_links(wid).items():
+        updated = []
+        changed = False
+        for link_wid, xml_id, uri, anchors in passage_links:
+            new_uri = uri
+            if link_wid == target_wid:
+                new_uri = make_cross_work_uri(link_wid, xml_id)
+                changed = changed or new_uri != uri
+            updated.append([link_wid, xml_id, uri, new_uri, anchors])
+        if changed:
+            stale[citetrail] = updated
+    return stale
+
+
+def relink_html(html: str, passage_links: list) -> str:
+    """Replaces the link targets in a passage's HTML, anchor by anchor, in rendering order."""
+    parts = []
+    cursor = 0
+    for link_wid, xml_id, old_uri, new_uri, anchors in passage_links:
+        old_attr = 'href="' + escape(old_uri, {'"': '&quot;'}) + '"'
+        new_attr = 'href="' + escape(new_uri, {'"': '&quot;'}) + '"'
+        for _ in range(anchors):
+            found = html.find(old_attr, cursor)
+            if found < 0:
+                break
+            parts.append(html[cursor:found] + new_attr)
+            cursor = found + len(old_attr)
+    parts.append(html[cursor:])
+    return ''.join(parts)
+
+
+def refresh_linking_works(target_wid: str):
+    """
+    Updates the links into target_wid in the (currently available) results of all works linking to target_wid,
+    e.g. after target_wid has been transformed anew. Only passages whose links resolve differently are relinked;
+    their HTML is patched instead of rendering it again from TEI, and only the parts of the result that contain
+    them are compressed anew (see results.JSONResult.patch_items).
+    """
+    for wid in get_linking_works(target_wid):
+        stale = get_stale_links(wid, target_wid)
+        if not stale:
+            continue
+        result = get_work_result(wid)
+        if result is not None:
+            passages = {}
+            for citetrail, passage_links in stale.items():
+                position = result.refs.get(citetrail)
+                if position is not None and result.get_item_value(position, 'html'):
+                    passage = json.loads(result.get_item_bytes(position))
+                    passage['html'] = relink_html(passage['html'], passage_links)
+                    passages[position] = passage
+            patched = result.patch_items(passages)
+            if not replace_work_result(result, patched):
+                # wid has been transformed anew meanwhile (with links that resolve as they do now), or its result has
+                # been evicted
+                patched.discard()
+                continue
+            links = get_cross_work_links(wid)
+            for citetrail, passage_links in stale.items():
+                links[citetrail] = [[link_wid, xml_id, new_uri, anchors]
+                                    for link_wid, xml_id, old_uri, new_uri, anchors in passage_links]
+            put_cross_work_links(wid, links)
+        # if there is no result for wid at the moment, its links stay stale until wid is transformed again
@@ -1,14 +1,25 @@
 from api.v1.works.analysis import WorkAnalysis
 from api.v1.xutils import xml_ns, flatten, safe_xinclude, get_node_by_xmlid, make_dts_fragment_string, is_element, \
-    get_xml_id, normalize_space, exists, copy_attributes
-from api.v1.works.config import WorkConfig, tei_works_path
-from api.v1.errors import NodeIndexingError
+    get_xml_id, normalize_space, exists, copy_attributes, feed_parser
+from api.v1.works.config import WorkConfig, tei_works_path, html_serialization, txt_note_placeholders, \
+    index_processes, index_chunk_min_size, index_time_limit, warm_factories
+from api.v1.errors import NodeIndexingError, TEIMarkupError
+from api.workers import report_progress, check_abort, detach_task, reserve_workers, release_workers, run_in_workers
 from api.v1.works.tei import WorkTEITransformer
 from api.v1.works.html import WorkHTMLTransformer
-from api.v1.works.txt import WorkTXTTransformer
+from api.v1.works.htmlwriter import WorkHTMLWriter
+from api.v1.works.txt import WorkTXTTransformer, resolve_note_placeholders
 from api.v1.works.metadata import WorkMetadataTransformer
+from api.v1.works.navigation import NavigationIndex
+from api.v1.works.result import WorkResult
+from api.v1.works.nodemap import write_node_map, get_node_map_path
+from api.v1.works.corpus import put_cross_work_links
 from lxml import etree
+import io
 import json
+import os
+import tempfile
+import threading
 from copy import deepcopy
 import re
 
@@ -20,9 +31,23 @@ class WorkFactory:
         self.analysis = WorkAnalysis(self.config)
         self.tei_transformer = WorkTEITransformer(config=self.config, analysis=self.analysis)
         self.txt_transformer = WorkTXTTransformer(config=self.config, analysis=self.analysis)
-        self.html_transformer = WorkHTMLTransformer(config=self.config, analysis=self.analysis,
-                                                    txt_transformer=self.txt_transformer)
+        if html_serialization == 'string':
+            self.html_transformer = WorkHTMLWriter(config=self.config, analysis=self.analysis,
+                                                   txt_transformer=self.txt_transformer)
+        else:
+            self.html_transformer = WorkHTMLTransformer(config=self.config, analysis=self.analysis,
+                                                        txt_transformer=self.txt_transformer)
         self.metadata_transformer = WorkMetadataTransformer(config=self.config, analysis=self.analysis)
+        # workaround for circular initialization of txt_transformer and analysis:
+        self.analysis.txt_transformer = self.txt_transformer
+        self.parser = make_work_parser()
+
+    def reset(self, work_id: str):
+        """Resets the per-work state of the factory (i.e., of its config and transformers) for indexing work_id, so
+        that the factory can be reused rather than set up anew for each work (see acquire_factory)."""
+        self.config.reset(work_id, node_count=0)
+        self.txt_transformer.reset()
+        self.html_transformer.reset()
 
     def make_structural_index(self, tei_text: etree._Element) -> etree._Element:
         """Creates an XML representation of the structure of a text, where relevant nodes are nested according
@@ -39,6 +64,7 @@ class WorkFactory:
 
     def extract_structure(self, node):
         if is_element(node):
+            check_abort()
             node_type = self.analysis.get_node_type(node)
             if get_xml_id(node) and node_type:
                 sal_node = etree.Element('sal_node')
@@ -128,18 +154,22 @@ class WorkFactory:
     get_citable_children = etree.XPath('children/descendant::sal_node[@citetrailParent = $id]')  # TODO does this work?
 
     def enrich_index(self, sal_index):
+        enriched_index = self.enrich_nodes(sal_index)
+        self.complete_trails(enriched_index)
+        return enriched_index
+
+    def enrich_nodes(self, sal_index):
+        """First step of enrich_index(): flattens the index and enriches each node with the information that can be
+        derived from its surroundings in sal_index (members, prev/next, and the node's own citetrail and passagetrail
+        parts). Full citetrails and passagetrails are made afterwards, see complete_trails()."""
         enriched_index = etree.Element('sal_index')
-        node_count = 0
         for node in sal_index.iter('sal_node'):
+            check_abort()
             sal_node_id = node.get('id')
             # print('enrich_index: Processing node ' + sal_node_id)
             enriched_node = etree.Element('sal_node')
             copy_attributes(node, enriched_node)
 
-            # POSITION of node
-            enriched_node.set('n', str(node_count))
-            node_count = node_count + 1
-
             # MEMBER (list of xml:id, separated by ';')
             citable_children = self.get_citable_children(node, id=sal_node_id) # TODO does this belong to analysis?
             if len(citable_children):
@@ -164,44 +194,24 @@ class WorkFactory:
             # CITETRAIL
             # determine citetrail position based on preceding-sibling::sal_node with similar @cite
             this_cite = node.get('cite')
-            revised_cite = this_cite
             if this_cite:
                 similar_preceding = len(node.xpath('preceding-sibling::sal_node[@cite = "' + this_cite + '"]'))
                 similar_following = len(node.xpath('following-sibling::sal_node[@cite = "' + this_cite + '"]'))
-                if similar_preceding > 0 or similar_following > 0:
-                    if re.match(r'\d$', this_cite):
-                        # if cite ends with number, use '-' as separator (e.g., for preserving page numbers)
-                        revised_cite += '-' + str(similar_preceding + 1)
-                    else:
-                        revised_cite += str(similar_preceding + 1)
+                revised_cite = self.revise_cite(this_cite, similar_preceding, similar_following)
             else:
                 # if node has no @cite[./string()], simply count similarly unnamed preceding siblings
                 revised_cite = str(len(node.xpath('preceding-sibling::sal_node[not(@cite)]')) + 1)
-            # construct full citetrail and put them into node and config.node_mappings
-            if node.get('citetrailParent'):
-                # since iter() is depth-first, we can assume that the parent's full citetrail has already been registered
-                parent_citetrail = self.config.get_citetrail_mapping(node.get('citetrailParent'))
-                full_citetrail = parent_citetrail + '.' + revised_cite
-                enriched_node.set('citetrailParent', parent_citetrail)  # overwrite old xml:id-based value
-                enriched_node.set('citetrail', full_citetrail)
-                self.config.put_citetrail_mapping(node.get('id'), full_citetrail)
-            else:
-                enriched_node.set('citetrail', revised_cite)
-                self.config.put_citetrail_mapping(node.get('id'), revised_cite)
-
-            # CRUMBTRAIL
-            # TODO?
+            enriched_node.set('revisedCite', revised_cite)
 
             # PASSAGETRAIL
             this_passage = node.xpath('passage/text()')
-            revised_passage = ''
             if len(this_passage):
                 revised_passage = str(this_passage[0])
+                enriched_node.set('passage', revised_passage)
                 # print('revised_passage is: ' + revised_passage)
                 # for div, milestones, and notes: determine passagetrail position based on preceding::sal_node with similar
                 # passagetrails within *the same passagetrail section* (structure is more complicated than with citetrails,
                 # since parent::sal_node is not necessarily a passagetrail "parent")
-                position = ''
                 if node.get('name') in ('div', 'milestone') or node.get('type') == 'note':
                     passagetrail_parent = None
                     if node.get('passagetrailParent'):
@@ -222,27 +232,194 @@ class WorkFactory:
                         for s in similar:
                             if exists(s, 'following::sal_node[@id = "' + node.get('id') + '"]'):
                                 similar_preceding.append(s)
-                        position = str(len(similar_preceding) + 1)
-                        revised_passage += ' [' + position + ']'
-                        # TODO: using square brackets to indicate automatic numbering/"normalization" ?
-            if node.get('passagetrailParent'):
-                parent_passagetrail = self.config.get_passagetrail_mapping(node.get('passagetrailParent'))
+                        enriched_node.set('passagePosition', str(len(similar_preceding) + 1))
+
+            # FINALIZATION
+            enriched_index.append(enriched_node)
+        return enriched_index
+
+    def revise_cite(self, cite, similar_preceding, similar_following):
+        """Numbers a node's @cite if siblings have the same @cite."""
+        if similar_preceding > 0 or similar_following > 0:
+            if re.match(r'\d$', cite):
+                # if cite ends with number, use '-' as separator (e.g., for preserving page numbers)
+                return cite + '-' + str(similar_preceding + 1)
+            else:
+                return cite + str(similar_preceding + 1)
+        return cite
+
+    def complete_trails(self, enriched_index):
+        """Second step of enrich_index(): determines the position of each node as well as full citetrails and
+        passagetrails (from the citetrails/passagetrails of parent nodes), and puts them into config.node_mappings."""
+        node_count = 0
+        for enriched_node in enriched_index.iter('sal_node'):
+            check_abort()
+            # POSITION of node
+            enriched_node.set('n', str(node_count))
+            node_count = node_count + 1
+
+            # CITETRAIL
+            revised_cite = enriched_node.attrib.pop('revisedCite')
+            # construct full citetrail and put them into node and config.node_mappings
+            if enriched_node.get('citetrailParent'):
+                # since iter() is depth-first, we can assume that the parent's full citetrail has already been registered
+                parent_citetrail = self.config.get_citetrail_mapping(enriched_node.get('citetrailParent'))
+                full_citetrail = parent_citetrail + '.' + revised_cite
+                enriched_node.set('citetrailParent', parent_citetrail)  # overwrite old xml:id-based value
+                enriched_node.set('citetrail', full_citetrail)
+                self.config.put_citetrail_mapping(enriched_node.get('id'), full_citetrail)
+            else:
+                enriched_node.set('citetrail', revised_cite)
+                self.config.put_citetrail_mapping(enriched_node.get('id'), revised_cite)
+
+            # CRUMBTRAIL
+            # TODO?
+
+            # PASSAGETRAIL
+            revised_passage = enriched_node.attrib.pop('passage', '')
+            position = enriched_node.attrib.pop('passagePosition', None)
+            if position:
+                revised_passage += ' [' + position + ']'
+                # TODO: using square brackets to indicate automatic numbering/"normalization" ?
+            if enriched_node.get('passagetrailParent'):
+                parent_passagetrail = self.config.get_passagetrail_mapping(enriched_node.get('passagetrailParent'))
                 if revised_passage:
                     full_passagetrail = parent_passagetrail + ' ' + revised_passage
                     enriched_node.set('passagetrail', full_passagetrail)
-                    self.config.put_passagetrail_mapping(node.get('id'), full_passagetrail)
+                    self.config.put_passagetrail_mapping(enriched_node.get('id'), full_passagetrail)
                 else:
                     enriched_node.set('passagetrail', parent_passagetrail)
-                    self.config.put_passagetrail_mapping(node.get('id'), parent_passagetrail)
+                    self.config.put_passagetrail_mapping(enriched_node.get('id'), parent_passagetrail)
             else:
                 enriched_node.set('passagetrail', revised_passage)
-                self.config.put_passagetrail_mapping(node.get('id'), revised_passage)
+                self.config.put_passagetrail_mapping(enriched_node.get('id'), revised_passage)
                 # if passage does not exist, we set an empty passagetrail
 
-            # FINALIZATION
-            enriched_index.append(enriched_node)
+    # PARALLEL INDEXING
+
+    def get_top_level_nodes(self, node):
+        """Gets the outermost nodes at or below node that become sal_nodes (see extract_structure), i.e. the top level
+        of the structural index, in document order."""
+        if is_element(node):
+            if get_xml_id(node) and self.analysis.get_node_type(node):
+                return [node]
+            return [top_level_node for child in node for top_level_node in self.get_top_level_nodes(child)]
+        return []
+
+    def make_index(self, work_id: str, tei_path, tei_text: etree._Element):
+        """
+        Creates the enriched index of a work (see make_structural_index() and enrich_index()). If index_processes > 1
+        and the text is large enough (see index_chunk_min_size), the top-level nodes of the text (e.g., volumes or
+        top-level divs) are indexed in chunks by parallel processes (see index_chunk()), and the partial indexes are
+        stitched together (see stitch_index()). The result is the same as with sequential indexing.
+        :param tei_path: the path of the spooled TEI dataset of the work (see receive_work), which is parsed anew by
+        each process, or None if the work is to be indexed sequentially
+        """
+        top_level_nodes = self.get_top_level_nodes(tei_text)
+        processes = 0
+        if index_processes > 1 and len(top_level_nodes) > 1 and tei_path is not None:
+            sizes = [sum(1 for _ in node.iter()) for node in top_level_nodes]
+            wanted = min(index_processes, len(top_level_nodes), sum(sizes) // index_chunk_min_size)
+            if wanted > 1:
+                # worker processes are shared by all tasks (see workers.reserve_workers)
+                processes = reserve_workers(wanted)
+        if processes < 2:
+            release_workers(processes)
+            return self.enrich_index(self.make_structural_index(tei_text))
+        try:
+            # chunks of consecutive top-level nodes with roughly the same number of elements
+            chunk_size = sum(sizes) / processes
+            chunks = []
+            start = 0
+            size = 0
+            for i in range(len(sizes)):
+                size += sizes[i]
+                if size >= chunk_size and len(chunks) < processes - 1:
+                    chunks.append((start, i + 1))
+                    start = i + 1
+                    size = 0
+            if start < len(sizes):
+                chunks.append((start, len(sizes)))
+            chunk_results = run_in_workers(index_chunk, [(work_id, tei_path, start, end) for start, end in chunks],
+                                           processes, index_time_limit, initializer=init_index_worker)
+        finally:
+            release_workers(processes)
+        return self.stitch_index(chunk_results)
+
+    def stitch_index(self, chunk_results):
+        """
+        Stitches the partial indexes of consecutive chunks (see index_chunk()) together and completes them. Information
+        that depends on nodes in other chunks is determined anew: prev/next and citetrail numbering of top-level nodes
+        (which are siblings across chunks), and the numbering of passagetrails that have no passagetrail parent (for
+        which similar nodes in the whole index are counted, see enrich_nodes()).
+        """
+        enriched_index = etree.Element('sal_index')
+        top_level_nodes = []
+        passages = {}  # (name, passage, passagetrailAncestorsN) -> number of such nodes in the preceding chunks
+        for chunk, top_level_ids, cite_depth in chunk_results:
+            if self.config.get_cite_depth() < cite_depth:
+                self.config.set_cite_depth(cite_depth)
+            top_level_ids = set(top_level_ids)
+            chunk_passages = {}
+            for enriched_node in list(etree.fromstring(chunk)):
+                if enriched_node.get('passage') is not None:
+                    passage = (enriched_node.get('name'), enriched_node.get('passage'),
+                               enriched_node.get('passagetrailAncestorsN'))
+                    if enriched_node.get('passagePosition') and not enriched_node.get('passagetrailParent'):
+                        position = int(enriched_node.get('passagePosition')) + passages.get(passage, 0)
+                        enriched_node.set('passagePosition', str(position))
+                    chunk_passages[passage] = chunk_passages.get(passage, 0) + 1
+                if enriched_node.get('id') in top_level_ids:
+                    top_level_nodes.append(enriched_node)
+                enriched_index.append(enriched_node)
+            for passage, count in chunk_passages.items():
+                passages[passage] = passages.get(passage, 0) + count
+
+        # PREV/NEXT NODES of top-level nodes (see enrich_nodes())
+        main_nodes = [node for node in top_level_nodes if node.get('type') in ('main', 'structural')]
+        for i, node in enumerate(main_nodes):
+            node.attrib.pop('prev', None)
+            node.attrib.pop('next', None)
+            if i > 0:
+                node.set('prev', main_nodes[i - 1].get('id'))
+            if i < len(main_nodes) - 1:
+                node.set('next', main_nodes[i + 1].get('id'))
+        # CITETRAIL of top-level nodes (see enrich_nodes())
+        cites = {}
+        for node in top_level_nodes:
+            if node.get('cite'):
+                cites[node.get('cite')] = cites.get(node.get('cite'), 0) + 1
+        similar_preceding = {}
+        unnamed_preceding = 0
+        for node in top_level_nodes:
+            this_cite = node.get('cite')
+            if this_cite:
+                preceding = similar_preceding.get(this_cite, 0)
+                node.set('revisedCite', self.revise_cite(this_cite, preceding, cites[this_cite] - preceding - 1))
+                similar_preceding[this_cite] = preceding + 1
+            else:
+                unnamed_preceding += 1
+                node.set('revisedCite', str(unnamed_preceding))
+
+        self.complete_trails(enriched_index)
         return enriched_index
 
+    def make_facs_index(self, tei_root: etree._Element):
+        """Registers the xml:id, citetrail and IIIF image URI of each (non-duplicate) page break by its @facs in
+        config, so that facs references and page links can be resolved without searching the tree. Requires that
+        citetrails have already been determined (see enrich_index).
+        """
+        for pb in tei_root.iter('{' + xml_ns['tei'] + '}pb'):
+            facs = pb.get('facs')
+            xml_id = pb.get('{' + xml_ns['xml'] + '}id')
+            if facs and xml_id and not (pb.get('sameAs') or pb.get('corresp')) \
+                    and not self.config.get_facs_mapping(facs):
+                try:
+                    image_uri = self.html_transformer.facs_to_uri(facs)
+                except TEIMarkupError:
+                    image_uri = None  # illegal @facs values are reported if the page is rendered
+                self.config.put_facs_mapping(facs, xml_id, self.config.get_citetrail_mapping(xml_id), image_uri)
+
     def extract_toc(enriched_index: etree._Element):
         pass  # TODO
 
@@ -258,47 +435,209 @@ class WorkFactory:
         return pages
 
 
-def transform(work_id: str, request_data):
-
-    # 0.) get, parse, and expand the xml dataset
-    parser = etree.XMLParser(attribute_defaults=False, no_network=False, ns_clean=True, remove_blank_text=False,
-                             remove_comments=False, remove_pis=False, compact=False, collect_ids=True,
-                             resolve_entities=False, huge_tree=False, encoding='UTF-8')  # huge_tree=True, ns_clean=False ?
+def make_work_parser() -> etree.XMLParser:
+    return etree.XMLParser(attribute_defaults=False, no_network=False, ns_clean=True, remove_blank_text=False,
+                           remove_comments=False, remove_pis=False, compact=False, collect_ids=True,
+                           resolve_entities=False, huge_tree=False, encoding='UTF-8')  # huge_tree=True, ns_clean=False ?
+
+
+def receive_work(request_data, parser: etree.XMLParser, content_encoding=None):
+    """
+    Parses the TEI dataset of a work while it is being received. If works are indexed in parallel, the dataset is
+    also spooled to a temporary file, from which the indexing processes parse it (see index_chunk).
+    :param request_data: the dataset as a binary stream (such as the request body) or as bytes
+    :param parser: the parser to be used (see make_work_parser)
+    :param content_encoding: the content coding of request_data (e.g., 'gzip'), if any
+    :return: a tuple (TEI root, path of the spooled dataset or None)
+    """
+    if isinstance(request_data, bytes):
+        request_data = io.BytesIO(request_data)
+    if index_processes < 2:
+        return feed_parser(request_data, parser, content_encoding), None
+    fd, tei_path = tempfile.mkstemp(prefix='work-', suffix='.xml')
+    try:
+        with os.fdopen(fd, 'wb') as spool:
+            tei_root = feed_parser(request_data, parser, content_encoding, copy_to=spool)
+    except BaseException:
+        os.remove(tei_path)
+        raise
+    return tei_root, tei_path
+
+
+def parse_work(tei_path: str, parser: etree.XMLParser) -> etree._Element:
     #tree = etree.parse(tei_works_path + '/' + work_id + '.xml', parser)  # TODO url
-    tei_root = etree.fromstring(request_data, parser)
+    return etree.parse(tei_path, parser).getroot()
     #tei_root = safe_xinclude(tree)
-    tei_header = tei_root.xpath('tei:teiHeader', namespaces=xml_ns)[0]
-    tei_text = tei_root.xpath('child::tei:text', namespaces=xml_ns)[0]
 
-    # TODO TEI validation
-    # 1.) Setup
-    config = WorkConfig(wid=work_id, node_count=0)
-    factory = WorkFactory(config)
-    # workaround for circular initialization of txt_transformer and analysis:
-    factory.analysis.txt_transformer = factory.txt_transformer
 
-    # put some technical metadata from the teiHeader into config
+# factories that are set up (and warmed up, see warm_up) but currently not in use by any task; a factory is used by
+# a single task at a time, and only its per-work state is reset for the next task (see acquire_factory)
+idle_factories = []
+idle_factories_lock = threading.Lock()
+
+
+def acquire_factory() -> WorkFactory:
+    """Gets an idle factory, or sets up a new one if all factories are in use. The factory must be given back with
+    release_factory() once the work has been transformed."""
+    with idle_factories_lock:
+        if idle_factories:
+            return idle_factories.pop()
+    return WorkFactory(WorkConfig(wid=None, node_count=0))
 
+
+def release_factory(factory: WorkFactory, failed: bool = False):
+    """Makes a factory available for reuse. Factories of failed or aborted tasks are released with failed=True: their
+    parser might be in an undefined state and is replaced by a new one (the per-work state of the config and the
+    transformers is reset for all factories anyway), so that the pool of warm factories does not shrink."""
+    if failed:
+        factory.parser = make_work_parser()
+    factory.reset(None)
+    with idle_factories_lock:
+        if len(idle_factories) < warm_factories:
+            idle_factories.append(factory)
+
+
+def make_factory(work_id: str, tei_root: etree._Element, factory: WorkFactory) -> WorkFactory:
+    """Prepares an acquired factory for the transformation of work_id."""
+    factory.reset(work_id)
+    config = factory.config
+
+    # put some technical metadata from the teiHeader into config
+    tei_header = tei_root.xpath('tei:teiHeader', namespaces=xml_ns)[0]
     char_decl = tei_header.xpath('descendant::tei:charDecl', namespaces=xml_ns)[0]
     config.set_chars(char_decl)
     prefix_defs = tei_root.xpath('descendant::tei:prefixDef', namespaces=xml_ns)
     for pd in prefix_defs:
         config.set_prefix_def(pd)
+    return factory
+
+
+def init_index_worker():
+    """Initializer for the worker processes of parallel indexing (see WorkFactory.make_index)."""
+    detach_task()
+    warm_up()
+
+
+def index_chunk(work_id: str, tei_path: str, start: int, end: int):
+    """
+    Indexes the top-level nodes start to end (exclusive) of a work (see WorkFactory.make_index); runs in a worker
+    process of the indexing task.
+    :return: a tuple (the serialized partial index as produced by WorkFactory.enrich_nodes(), the xml:ids of the
+    chunk's top-level nodes, the cite depth of the chunk)
+    """
+    factory = acquire_factory()
+    try:
+        tei_root = parse_work(tei_path, factory.parser)
+        make_factory(work_id, tei_root, factory)
+        tei_text = tei_root.xpath('child::tei:text', namespaces=xml_ns)[0]
+        structural_index = etree.Element('sal_index')
+        for node in factory.get_top_level_nodes(tei_text)[start:end]:
+            for sal_node in flatten([factory.extract_structure(node)]):
+                structural_index.append(sal_node)
+        enriched_index = factory.enrich_nodes(structural_index)
+        result = etree.tostring(enriched_index), [node.get('id') for node in structural_index], \
+                 factory.config.get_cite_depth()
+    except BaseException:
+        release_factory(factory, failed=True)
+        raise
+    release_factory(factory)
+    return result
+
+
+# a minimal work, which is transformed by each factory that is set up during warm_up()
+warm_up_tei = b'''<TEI xmlns="http://www.tei-c.org/ns/1.0">
+    <teiHeader><encodingDesc><charDecl><char xml:id="char017f"><mapping
+    type="precomposed">&#383;</mapping><mapping type="standardized">s</mapping></char></charDecl>
+    </encodingDesc></teiHeader>
+    <text xml:id="W0000-00" type="work_monograph"><front xml:id="W0000-00-0001-fr-0001"><titlePage
+    xml:id="W0000-00-0001-tp-0001"><titlePart>Titulus</titlePart></titlePage></front><body><div
+    xml:id="W0000-00-0001-d1-0001" type="chapter" n="1"><head xml:id="W0000-00-0001-he-0001">Caput <hi
+    rendition="#it">primum</hi></head><p xml:id="W0000-00-0001-pa-0001">Textus <choice><abbr>q.</abbr><expan>quaestio</expan>
+    </choice> <g ref="#char017f">&#383;</g><lb break="no"/>b <note xml:id="W0000-00-0001-nm-0001" place="margin" n="a">Nota
+    </note></p></div></body></text></TEI>'''
+
+
+def warm_up():
+    """
+    Sets up idle factories up to warm_factories and makes each of them transform a minimal work (without persisting
+    anything), so that the setup of parsers and transformers as well as the first evaluation of their compiled XPaths
+    is done before the first task, rather than during it. Called when the app, the fork server of the worker
+    processes (see preload.py), and the indexing processes start; factories inherited from the fork server are kept.
+    """
+    with idle_factories_lock:
+        missing = warm_factories - len(idle_factories)
+    factories = [WorkFactory(WorkConfig(wid=None, node_count=0)) for _ in range(missing)]
+    for factory in factories:
+        tei_root = feed_parser(io.BytesIO(warm_up_tei), factory.parser)
+        make_factory('W0000', tei_root, factory)
+        tei_text = tei_root.xpath('child::tei:text', namespaces=xml_ns)[0]
+        enriched_index = factory.make_index('W0000', None, tei_text)
+        factory.make_facs_index(tei_root)
+        for node in enriched_index.iter('sal_node'):
+            factory.metadata_transformer.make_passage_metadata(node, factory.config)
+            if node.get('basic') == 'true':
+                tei_node = get_node_by_xmlid(tei_root, xmlid=node.get('id'))[0]
+                factory.txt_transformer.dispatch(tei_node, 'edit')
+                factory.txt_transformer.dispatch(tei_node, 'orig')
+                factory.html_transformer.serialize_fragment(factory.html_transformer.dispatch(tei_node))
+                factory.tei_transformer.wrap_tei_node_in_ancestors(tei_node, deepcopy(tei_node))
+    for factory in factories:
+        release_factory(factory)
+
+
+def transform(work_id: str, request_data, content_encoding=None):
+
+    # 0.) get a factory (with its parser, see acquire_factory), and parse the xml dataset (while it is being received,
+    # see receive_work)
+    factory = acquire_factory()
+    try:
+        tei_root, tei_path = receive_work(request_data, factory.parser, content_encoding)
+    except BaseException:
+        release_factory(factory, failed=True)
+        raise
+    return transform_received(work_id, factory, tei_root, tei_path)
+
+
+def transform_received(work_id: str, factory: WorkFactory, tei_root: etree._Element, tei_path):
+    """Transforms a work that has already been received with the parser of an acquired factory (see receive_work),
+    e.g. in the thread of the request before its task is started; removes the spooled dataset (if any) and releases
+    the factory afterwards."""
+    try:
+        result = transform_work(work_id, tei_root, tei_path, factory)
+    except BaseException:
+        release_factory(factory, failed=True)
+        raise
+    finally:
+        if tei_path:
+            os.remove(tei_path)
+    release_factory(factory)
+    return result
+
+
+def transform_work(work_id: str, tei_root: etree._Element, tei_path, factory: WorkFactory):
+    tei_header = tei_root.xpath('tei:teiHeader', namespaces=xml_ns)[0]
+    tei_text = tei_root.xpath('child::tei:text', namespaces=xml_ns)[0]
+
+    # TODO TEI validation
+    # 1.) Setup (resetting the per-work state of the factory)
+    make_factory(work_id, tei_root, factory)
+    config = factory.config
 
     # 1.) INDEXING
+    report_progress('indexing')
     # a) extract the basic structure of the text (i.e., the hierarchy of all relevant nodes), also building
-    # preliminary citetrails
-    structural_index = factory.make_structural_index(tei_text)
-    # for debugging:
-    #with open('tests/resources/out/' + work_id + "_index0.xml", "wb") as fo:
-    #    fo.write(etree.tostring(structural_index, pretty_print=True))
-
-    # b) enrich index (e.g., make full citetrails), and flatten nodes
-    enriched_index = factory.enrich_index(structural_index)
+    # preliminary citetrails, and b) enrich index (e.g., make full citetrails), and flatten nodes - for larger works,
+    # this is done in parallel for chunks of the text (see WorkFactory.make_index)
+    enriched_index = factory.make_index(work_id, tei_path, tei_text)
     # for debugging:
     #with open('tests/resources/out/' + work_id + "_index.xml", "wb") as fo:
     #    fo.write(etree.tostring(enriched_index, pretty_print=True))
 
+    # persist node mappings for resolving references into this work later on (see nodemap.get_node_map)
+    write_node_map(get_node_map_path(work_id), config.get_node_mappings())
+    # c) index page breaks by @facs
+    factory.make_facs_index(tei_root)
+
     # 2.) TOC and PAGINATION (TODO not yet fully working)
 #    pages = extract_pagination(enriched_index)
     # for debugging:
@@ -306,8 +645,13 @@ def transform(work_id: str, request_data):
 #        fo.write(json.dumps(pages, indent=4))
 
     # 3.) PASSAGES
+    report_progress('passages')
     passages = []
+    cross_work_links = {}
+    pending_txt = []  # (fragment, txt_edit, txt_orig) of passages with marginal note placeholders
+    notes_edit, notes_orig = {}, {}  # xml:id -> (txt, citetrail URI) of marginal notes
     for node in enriched_index.iter('sal_node'):
+        check_abort()
         fragment = {}
         dts_resource_metadata = factory.metadata_transformer.make_passage_metadata(node, config)
         fragment.update(dts_resource_metadata)
@@ -319,18 +663,28 @@ def transform(work_id: str, request_data):
             # root.xpath('//*[@xml:id = "' + node_id + '"]', namespaces=xml_ns)[0]
             tei_node = get_node_by_xmlid(tei_root, xmlid=node_id)[0]
             # TXT
-            txt_edit = make_dts_fragment_string(factory.txt_transformer.dispatch(tei_node, 'edit'))
-            txt_orig = make_dts_fragment_string(factory.txt_transformer.dispatch(tei_node, 'orig'))
+            txt_edit, placeholders_edit = factory.txt_transformer.dispatch_passage(tei_node, 'edit')
+            txt_orig, placeholders_orig = factory.txt_transformer.dispatch_passage(tei_node, 'orig')
+            if (placeholders_edit or placeholders_orig) and txt_note_placeholders != 'keep':
+                # placeholders are resolved once all notes have been rendered (see below)
+                pending_txt.append((fragment, txt_edit, txt_orig))
+            if factory.analysis.is_marginal_node(tei_node):
+                note_uri = factory.txt_transformer.make_note_uri(node.get('citetrail'))
+                notes_edit[node_id] = (txt_edit, note_uri)
+                notes_orig[node_id] = (txt_orig, note_uri)
             # HTML
             html_node = factory.html_transformer.dispatch(tei_node) # this assumes that there is exactly 1 html result node
-            html = make_dts_fragment_string(html_node)
+            html = factory.html_transformer.serialize_fragment(html_node)
+            passage_links = factory.html_transformer.pop_cross_work_links()
+            if passage_links:
+                cross_work_links[node.get('citetrail')] = passage_links
             # TEI
             tei_node_with_ancestors = factory.tei_transformer.wrap_tei_node_in_ancestors(tei_node, deepcopy(tei_node))
             tei = make_dts_fragment_string(tei_node_with_ancestors)
             # aggregate:
-            content = {'txt_edit': str(txt_edit, encoding='UTF-8'),
-                       'txt_orig': str(txt_orig, encoding='UTF-8'),
-                       'html': str(html, encoding='UTF-8'),
+            content = {'txt_edit': str(make_dts_fragment_string(txt_edit), encoding='UTF-8'),
+                       'txt_orig': str(make_dts_fragment_string(txt_orig), encoding='UTF-8'),
+                       'html': html,
                        'tei': str(tei, encoding='UTF-8')}
             fragment.update(content)
         passages.append(fragment)
@@ -338,11 +692,23 @@ def transform(work_id: str, request_data):
     #with open('tests/resources/out/' + work_id + '_resources.json', 'w') as fo:
     #    fo.write(json.dumps(passages, indent=4))
 
+    # resolve marginal note placeholders in a single pass, with the notes' txt as rendered above
+    for fragment, txt_edit, txt_orig in pending_txt:
+        txt_edit = resolve_note_placeholders(txt_edit, notes_edit, txt_note_placeholders)
+        txt_orig = resolve_note_placeholders(txt_orig, notes_orig, txt_note_placeholders)
+        fragment['txt_edit'] = str(make_dts_fragment_string(txt_edit), encoding='UTF-8')
+        fragment['txt_orig'] = str(make_dts_fragment_string(txt_orig), encoding='UTF-8')
+
+    # register links to other works in the corpus (see corpus.refresh_linking_works)
+    put_cross_work_links(work_id, cross_work_links)
+
     # 4.) WORK/VOLUME METADATA
+    report_progress('metadata')
     resource_metadata = factory.metadata_transformer.make_resource_metadata(tei_header, config, work_id)
 
-    # 5.) return to routes.py:
-    return {'work_metadata': resource_metadata, 'work_passages': passages}
+    # 5.) return to routes.py (together with the indexes required for DTS queries):
+    navigation = NavigationIndex(enriched_index)
+    return WorkResult(work_id, {'work_metadata': resource_metadata, 'work_passages': passages}, navigation)
     # for debugging:
     #with open('tests/resources/out/' + work_id + '_metadata.json', 'w') as fo:
     #    fo.write(json.dumps(resource_metadata, indent=4))
@@ -1,10 +1,11 @@
-from api.v1.xutils import xml_ns, get_list_type, get_target_node
+from api.v1.xutils import xml_ns, get_list_type, make_dts_fragment_string
 from api.v1.works.txt import *
 from api.v1.errors import TEIMarkupError, TEIUnkownElementError
 from api.v1.works.config import edit_class, orig_class, image_server, iiif_img_default_params, tei_text_elements, \
     id_server, WorkConfig
 from api.v1.works.analysis import WorkAnalysis
 from api.v1.works.txt import WorkTXTTransformer
+from api.v1.works.targets import TargetResolver
 
 
 class WorkHTMLTransformer:
@@ -13,6 +14,12 @@ class WorkHTMLTransformer:
         self.config = config
         self.analysis = analysis
         self.txt_transformer = txt_transformer
+        self.target_resolver = TargetResolver(config)
+        self.cross_work_links = []  # links to nodes in other works, rendered since the last pop_cross_work_links()
+
+    def reset(self):
+        self.target_resolver.reset()
+        self.cross_work_links = []
 
     # TODO: simplify the following XPaths
     # determines whether hi occurs within a section with overwriting alignment information:
@@ -54,10 +61,6 @@ class WorkHTMLTransformer:
 
     # TODO: error handling
     def passthru(self, node):
-        children = [self.dispatch(child) for child in node.xpath('node()')
-                        if not (is_element(child)
-                                and ((self.analysis.is_basic_node(child) or self.analysis.is_structural_node(child))
-                                     or (self.analysis.is_list_node(child) and self.analysis.has_basic_ancestor(child))))]
         children = []
         for child in node.xpath('node()'):
             if is_element(child):
@@ -116,7 +119,7 @@ class WorkHTMLTransformer:
         return self.transform_orig_elem(node)
 
     def transform_argument(self, node):
-        argument = etree.Element('p')
+        argument = self.make_element('p')
         argument.set('class', 'argument')
         return self.passthru_append(node, argument)
         # TODO: css for argument if not is_basic_nodeent
@@ -168,7 +171,7 @@ class WorkHTMLTransformer:
     def transform_edit_elem(self, node):
         if exists(node, 'parent::tei:choice'):
             orig_str = 'test' # TODO: string-join(render:dispatch($node/parent::tei:choice/(tei:abbr|tei:orig|tei:sic), 'orig'), '')
-            span = etree.Element('span')
+            span = self.make_element('span')
             span.set('class', 'edit ' + etree.QName(node).localname)
             span.set('title', orig_str)
             return self.passthru_append(node, span)
@@ -279,7 +282,7 @@ class WorkHTMLTransformer:
                 css_classes.append('hi-sub') # vertical-align:sub;font-size:.83em;
             elif s == '#sup':
                 css_classes.append('hi-sup') # vertical-align:super;font-size: .83em;
-        span = etree.Element('span')
+        span = self.make_element('span')
         span.set('class', ' '.join(css_classes))
         return self.passthru_append(node, span)
 
@@ -392,7 +395,7 @@ class WorkHTMLTransformer:
                 title = 'p. ' + title
             page_link = self.make_element_with_class('a', 'page-link')
             page_link.set('title', title)
-            page_link.set('href', self.facs_to_uri(node.get('facs')))
+            page_link.set('href', self.get_image_uri(node.get('facs')))
             # TODO i18n 'View image of ' + title
             page_link.append(self.make_element_with_class('i', 'fas fa-book-open'))
             label = self.make_element_with_class('span', 'page-label')
@@ -429,9 +432,16 @@ class WorkHTMLTransformer:
             return self.passthru_append(node, self.make_element_with_class('sup', 'ref-note'))
             # TODO: get reference to note, e.g. for highlighting
         elif node.get('target'):
-            resolved_uri = self.make_uri_from_target(node, node.get('target'))
+            resolved_uri, cross_work_target = self.resolve_target(node, node.get('target'))
             if resolved_uri:
-                return self.transform_node_to_link(node, resolved_uri)
+                if not cross_work_target:
+                    return self.transform_node_to_link(node, resolved_uri)[0]
+                # links to other works are recorded (in rendering order, i.e. before any links within this one), so
+                # that they can be relinked later on (see corpus.relink_html)
+                link = [cross_work_target[0], cross_work_target[1], resolved_uri, 0]
+                self.cross_work_links.append(link)
+                transformed, link[3] = self.transform_node_to_link(node, resolved_uri)
+                return transformed
             else:
                 return self.passthru(node)
         else:
@@ -505,10 +515,11 @@ class WorkHTMLTransformer:
     def transform_node_to_link(self, node: etree._Element, uri: str):
         """
         Transforms a $node into an HTML link anchor (a[@href]). Prevents child::tei:pb from occurring within the link, if required.
+        :return: a tuple (the transformed node, the number of anchors into which the link has been split)
         """
         if not exists(node, 'child::tei:pb'):
             a = self.make_a_with_href(uri, True)
-            return self.passthru_append(node, a)
+            return self.passthru_append(node, a), 1
         else:
             # make an anchor for the preceding part, then render the pb, then "continue" the anchor
             # note that this currently works only if pb occurs at the child level, and only with the first pb
@@ -517,85 +528,58 @@ class WorkHTMLTransformer:
             page_break = self.dispatch(node.xpath('child::tei:pb[1]', namespaces=xml_ns)[0])
             after_children = self.dispatch_multiple(node.xpath('child::tei:pb[1]/following-sibling::node()', namespaces=xml_ns))
             after = self.transform_append_children(self.make_a_with_href(uri, True), after_children)
-            return [before, page_break, after]
+            return [before, page_break, after], 2
 
     def make_a_with_href(self, href_value, target_blank=True):
-        a = etree.Element('a')
+        a = self.make_element('a')
         a.set('href', href_value)
         if target_blank:
             a.set('target', '_blank')
         return a
 
-    # TODO: testing, esp. from 1st "elif" onwards
-    def make_uri_from_target(self, node, targets):
-        target = targets.split()[0] # if there are several, first one wins
-        work_scheme = r'(work:(W[A-z0-9.:_\-]+))?#(.*)' # TODO is this failsafe?
-        facs_scheme = r'facs:((W[0-9]+)[A-z0-9.:#_\-]+)'
-        generic_scheme = r'(\S+):([A-z0-9.:#_\-]+)'
-        uri = target
-        if target.startswith('#'):
-            # target is some node in the current work
-            targeted = get_target_node(node, id=target[1:])
-            if len(targeted) == 1:
-                uri = self.make_citetrail_uri_from_xml_id(get_xml_id(targeted[0]))
-        elif re.match(work_scheme, target):
-            # target is something like "work:W...#..."
-            if re.sub(work_scheme, '$2', target):
-                target_work_id = re.sub(work_scheme, '$2', target)
-                uri = id_server + '/texts/' + target_work_id
-                # TODO this merely refers to a complete work, how to handle specific nodes/citetrails?
-            else:
-                # target is just a link to a fragment anchor, so targetWorkId = currentWork
-                anchor_id = re.sub(work_scheme, '$3', target)
-                if anchor_id:
-                    uri = self.make_citetrail_uri_from_xml_id(anchor_id)
-        elif re.match(facs_scheme, target):
-            # target is a facs string
-            target_work_id = re.sub(facs_scheme, '$2', target)
-            if target_work_id == self.config.wid: # TODO: workaround for dynamic config
-                # facs is in the same work
-                pb = node.xpath('ancestor::tei:TEI//tei:pb[@facs = "' + target + '"'
-                                + ' and not(@sameAs or @corresp) and @xml:id]', namespaces=xml_ns)
-                if len(pb) > 0:
-                    uri = self.make_citetrail_uri_from_xml_id(get_xml_id(pb[0]))
-            else:
-                raise TEIMarkupError('@target refers to @facs from a different work than the current one')
-        elif re.match(generic_scheme, target):
-            # use the general replacement mechanism as defined by the teiHeader's prefixDef
-            prefix = re.sub(generic_scheme, '$1', target)
-            value = re.sub(generic_scheme, '$2', target)
-            prefix_def = self.config.get_prefix_defs().get(prefix)
-            if prefix_def:
-                if re.match(prefix_def['matchPattern'], value):
-                    uri = re.sub(prefix_def['matchPattern'], prefix_def['replacementPattern'], value)
-            else:
-                search = re.search(generic_scheme, target)
-                uri = re.sub(generic_scheme, '$0', target)  # TODO is this working?
-        return uri
+    def resolve_target(self, node, targets):
+        """
+        Resolves the first of targets (if there are several, the first one wins).
+        :return: a tuple (uri, (target work id, xml:id) if the target is a node in another work, otherwise None)
+        """
+        target = targets.split()[0]
+        return self.target_resolver.resolve(node, target)
+
+    def pop_cross_work_links(self):
+        """
+        Gets the links to other works that have been rendered since the last call, and resets them.
+        :return: a list of [target work id, xml:id, uri, number of html anchors] in rendering order
+        """
+        links = self.cross_work_links
+        self.cross_work_links = []
+        return links
 
     def make_citetrail_uri_from_xml_id(self, id: str):
         """
         Tries to derive the citetrail for a node from its @xml:id. Works only if the node/@xml:id is in work "config.wid"
         """
-        citetrail = self.config.get_citetrail_mapping(id)
-        if citetrail:
-            print('Deriving citetrail ' + citetrail + ' from xml:id ' + id)
-            return id_server + '/texts/' + self.config.wid + ':' + citetrail
-        else:
-            return ''
+        return self.target_resolver.make_citetrail_uri(id)
+
+    def get_image_uri(self, pb_facs):
+        """Gets the IIIF image URI for a page from the facs index (see WorkFactory.make_facs_index), or derives it
+        from @facs if the page has not been indexed."""
+        facs_mapping = self.config.get_facs_mapping(pb_facs)
+        if facs_mapping and facs_mapping['image']:
+            return facs_mapping['image']
+        return self.facs_to_uri(pb_facs)
+
+    single_vol_facs_regex = re.compile(r'facs:(W[0-9]{4})\-([0-9]{4})')
+    multi_vol_facs_regex = re.compile(r'facs:(W[0-9]{4})\-([A-z])\-([0-9]{4})')
 
     def facs_to_uri(self, pb_facs):
         facs = pb_facs.split()[0]
-        single_vol_regex = r'facs:(W[0-9]{4})\-([0-9]{4})'
-        multi_vol_regex = r'facs:(W[0-9]{4})\-([A-z])\-([0-9]{4})'
-        if re.match(single_vol_regex, facs): # single-volume work, e.g. "facs:W0017-0005"
-            work_id = re.sub(single_vol_regex, '$1', facs)
-            facs_id = re.sub(single_vol_regex, '$2', facs)
+        single_vol_match = self.single_vol_facs_regex.match(facs)
+        multi_vol_match = self.multi_vol_facs_regex.match(facs)
+        if single_vol_match: # single-volume work, e.g. "facs:W0017-0005"
+            work_id, facs_id = single_vol_match.groups()
             return image_server + '/iiif/image/' + work_id + '!' + work_id + '-' + facs_id + iiif_img_default_params
-        elif re.match(multi_vol_regex, facs):
-            work_id = re.sub(multi_vol_regex, '$1', facs)
-            vol_id = re.sub(multi_vol_regex, '$2', facs)
-            facs_id = re.sub(multi_vol_regex, '$3', facs)
+        elif multi_vol_match:
+            work_id, vol_id, facs_id = multi_vol_match.groups()
             return image_server + '/iiif/image/' + work_id + '!' + vol_id + '!' + \
                    work_id + '-' + vol_id + '-' + facs_id + iiif_img_default_params
         else:
@@ -635,7 +619,11 @@ class WorkHTMLTransformer:
     def make_element(self, elem_name):
         return etree.Element(elem_name)
 
+    def serialize_fragment(self, html_node) -> str:
+        """Serializes the HTML result of dispatch() for a basic node as a dts:fragment."""
+        return str(make_dts_fragment_string(html_node), encoding='UTF-8')
+
     def make_element_with_class(self, elem_name, class_name):
-        el = etree.Element(elem_name)
+        el = self.make_element(elem_name)
         el.set('class', class_name)
-        return el
\ No newline at end of file
+        return el
@@ -0,0 +1,144 @@
+"""
+String-based HTML output for WorkHTMLTransformer: rather than building an lxml tree for each passage and serializing
+it (via a dts:fragment wrapper) to bytes that are decoded again, HTML elements are collected as lightweight objects
+and written as escaped markup directly into a string buffer. The output is identical to lxml's serialization.
+"""
+
+from api.v1.xutils import dts_ns, flatten
+from api.v1.works.config import WorkConfig
+from api.v1.works.analysis import WorkAnalysis
+from api.v1.works.txt import WorkTXTTransformer
+from api.v1.works.html import WorkHTMLTransformer
+
+
+def escape_text(text: str) -> str:
+    # escaping as done by libxml2 for text content
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    return text
+
+
+def escape_attribute(value: str) -> str:
+    # escaping as done by libxml2 for attribute values (in double quotes)
+    value = escape_text(value)
+    if '"' in value:
+        value = value.replace('"', '&quot;')
+    if '\n' in value:
+        value = value.replace('\n', '&#10;')
+    if '\t' in value:
+        value = value.replace('\t', '&#9;')
+    return value
+
+
+class HTMLElement:
+    """
+    A minimal stand-in for the lxml elements created by WorkHTMLTransformer, supporting set(), append() and
+    (leading) text. Child elements and text are kept in a single list of content, so that appending text is never
+    quadratic.
+    """
+
+    __slots__ = ('tag', 'attrib', 'content')
+
+    def __init__(self, tag: str):
+        self.tag = tag
+        self.attrib = {}
+        self.content = []  # HTMLElement and str, in document order
+
+    def set(self, name: str, value: str):
+        self.attrib[name] = value
+
+    def get(self, name: str):
+        return self.attrib.get(name)
+
+    def append(self, child):
+        self.content.append(child)
+
+    @property
+    def text(self):
+        if self.content and isinstance(self.content[0], str):
+            return self.content[0]
+
+    @text.setter
+    def text(self, value):
+        if self.content and isinstance(self.content[0], str):
+            del self.content[0]
+        if value is not None:
+            self.content.insert(0, value)
+
+    def write(self, buffer: list):
+        buffer.append('<' + self.tag)
+        for name, value in self.attrib.items():
+            buffer.append(' ' + name + '="' + escape_attribute(value) + '"')
+        if self.content:
+            buffer.append('>')
+            for child in self.content:
+                if isinstance(child, str):
+                    buffer.append(escape_text(child))
+                else:
+                    child.write(buffer)
+            buffer.append('</' + self.tag + '>')
+        else:
+            buffer.append('/>')
+
+
+dts_fragment_start = '<dts:fragment xmlns:dts="' + dts_ns['dts'] + '">'
+dts_fragment_end = '</dts:fragment>'
+dts_fragment_empty = '<dts:fragment xmlns:dts="' + dts_ns['dts'] + '"/>'
+
+
+def make_dts_fragment_html(content) -> str:
+    """String-based equivalent of xutils.make_dts_fragment_string for HTMLElement content (an element, a string, or
+    a list of elements and strings)."""
+    if isinstance(content, (HTMLElement, str)):
+        parts = [content]
+    elif isinstance(content, list):
+        parts = [part for part in flatten(content) if isinstance(part, (HTMLElement, str))]
+    else:
+        parts = []
+    if not parts:
+        return dts_fragment_empty
+    buffer = [dts_fragment_start]
+    for part in parts:
+        if isinstance(part, str):
+            buffer.append(escape_text(part))
+        else:
+            part.write(buffer)
+    buffer.append(dts_fragment_end)
+    return ''.join(buffer)
+
+
+class WorkHTMLWriter(WorkHTMLTransformer):
+    """WorkHTMLTransformer that produces HTMLElement objects and serializes them as strings."""
+
+    def __init__(self, config: WorkConfig, analysis: WorkAnalysis, txt_transformer: WorkTXTTransformer):
+        super().__init__(config=config, analysis=analysis, txt_transformer=txt_transformer)
+
+    def make_element(self, elem_name):
+        return HTMLElement(elem_name)
+
+    def transform_append_children(self, transform_elem, children):
+        # like WorkHTMLTransformer.transform_append_children, strings that precede the first appended element
+        # become part of the leading text of transform_elem, even if transform_elem already has child elements
+        leading = []
+        preceding_elem = None
+        for child in children:
+            if isinstance(child, HTMLElement):
+                transform_elem.append(child)
+                preceding_elem = child
+            elif isinstance(child, str):
+                if preceding_elem is None:
+                    leading.append(child)
+                else:
+                    transform_elem.append(child)
+        if leading:
+            transform_elem.text = (transform_elem.text or '') + ''.join(leading)
+        return transform_elem
+
+    def serialize_fragment(self, html_node) -> str:
+        return make_dts_fragment_html(html_node)
@@ -1,5 +1,10 @@
 from lxml import etree
-from api.v1.works.config import id_server
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+from api.v1.works.config import id_server, header_cache_size
 from api.v1.xutils import xml_ns, exists
 from api.v1.works.config import WorkConfig
 from api.v1.works.analysis import WorkAnalysis
@@ -11,6 +16,100 @@ context = {
     'sal': 'https://api.salamanca.school/' # TODO point to an actual reference document here
 }
 
+# data extracted from teiHeaders (see WorkMetadataTransformer.extract_header), by digest of the serialized teiHeader, so
+# that identical headers (e.g., of the volumes of a work, or of a work that is processed again) are evaluated only once
+header_cache = OrderedDict()
+header_cache_lock = threading.Lock()
+
+tei_tag_prefix = '{' + xml_ns['tei'] + '}'
+header_step_regex = re.compile(r'tei:(\w+)(?:\[(.*)\])?$')
+header_equals_regex = re.compile(r'@(\w+) = "([^"]*)"$')
+header_contains_regex = re.compile(r'contains\(@(\w+), "([^"]*)"\)$')
+
+
+def compile_header_predicate(predicate: str):
+    """Compiles an XPath predicate of the forms used in header_schema (@a = "v", @a = "v" or @b = "w",
+    contains(@a, "v")) into a function of an element."""
+    contains = header_contains_regex.match(predicate)
+    if contains:
+        name, value = contains.groups()
+        return lambda element: value in (element.get(name) or '')
+    conditions = []
+    for condition in predicate.split(' or '):
+        equals = header_equals_regex.match(condition)
+        if not equals:
+            raise ValueError('Unsupported predicate in header schema: ' + predicate)
+        conditions.append(equals.groups())
+    return lambda element: any(element.get(name) == value for name, value in conditions)
+
+
+def compile_header_schema(schema: dict) -> dict:
+    """
+    Compiles the paths of a header schema (see WorkMetadataTransformer.header_schema) into a tree of element names,
+    so that all fields are extracted in a single walk over the teiHeader, which only descends into elements that
+    are part of some path (see extract_header_values).
+    :return: the root of the tree: {'children': {tag: node}, 'fields': [(field, predicates, select)]}, where
+    predicates holds a tuple (step number, function) for each step of the path that has a predicate, and select is
+    'text()', '@name' or None (for the element itself)
+    """
+    root = {'children': {}, 'fields': []}
+    for field, (path, converter) in schema.items():
+        steps = path.split('/')
+        select = None
+        if steps[-1] == 'text()' or steps[-1].startswith('@'):
+            select = steps.pop()
+        node = root
+        predicates = []
+        for i, step in enumerate(steps):
+            match = header_step_regex.match(step)
+            if not match:
+                raise ValueError('Unsupported step in header schema: ' + step)
+            name, predicate = match.groups()
+            if predicate:
+                predicates.append((i, compile_header_predicate(predicate)))
+            node = node['children'].setdefault(tei_tag_prefix + name, {'children': {}, 'fields': []})
+        node['fields'].append((field, tuple(predicates), select))
+    return root
+
+
+def select_header_values(element: etree._Element, select) -> list:
+    if select is None:
+        return [element]
+    if select == 'text()':
+        # all text nodes that are children of the element
+        return [text for text in [element.text] + [child.tail for child in element] if text is not None]
+    value = element.get(select[1:])
+    return [value] if value is not None else []
+
+
+def extract_header_values(tei_header: etree._Element, schema: dict) -> dict:
+    """Walks the parts of a teiHeader that are covered by a compiled header schema (see compile_header_schema) once.
+    :return: {field: [value, ...]}, with the values of each field in document order
+    """
+    values = {}
+    stack = []
+
+    def walk(element, node):
+        for child in element:
+            child_node = node['children'].get(child.tag)
+            if child_node is None:
+                # (also skips comments and processing instructions, whose tags are not strings)
+                continue
+            stack.append(child)
+            for field, predicates, select in child_node['fields']:
+                for i, predicate in predicates:
+                    if not predicate(stack[i]):
+                        break
+                else:
+                    values.setdefault(field, []).extend(select_header_values(child, select))
+            if child_node['children']:
+                walk(child, child_node)
+            stack.pop()
+
+    walk(tei_header, schema)
+    return values
+
+
 class WorkMetadataTransformer:
 
     def __init__(self, config: WorkConfig, analysis: WorkAnalysis):
@@ -42,28 +141,91 @@ class WorkMetadataTransformer:
 
         # dts:passage: to be added downstream; @id: set dynamically based on request data
 
+    # EXTRACTION SCHEMA: teiHeader data required for DTS metadata, as {field: (path relative to tei:teiHeader, name of
+    # the method that converts the selected nodes to plain data, or None for a list of strings)}; paths are written
+    # as XPaths, but may only consist of child steps with simple attribute predicates (see compile_header_schema),
+    # optionally followed by text() or an attribute
+    header_schema = {
+        'title': ('tei:fileDesc/tei:titleStmt/tei:title[@type = "short"]/text()', None),
+        'alt_title': ('tei:fileDesc/tei:titleStmt/tei:title[@type = "main"]/text()', None),  # or short title here?
+        'authors': ('tei:fileDesc/tei:titleStmt/tei:author/tei:persName', 'format_person_names'),
+        'author_surnames': ('tei:fileDesc/tei:titleStmt/tei:author/tei:persName/tei:surname/text()', None),
+        'scholarly_editors': ('tei:fileDesc/tei:titleStmt/tei:editor[contains(@role, "#scholarly")]/tei:persName',
+                              'format_person_names'),
+        'technical_editors': ('tei:fileDesc/tei:titleStmt/tei:editor[contains(@role, "#technical")]/tei:persName',
+                              'format_person_names'),
+        'digitized_date_ranges': ('tei:fileDesc/tei:editionStmt/tei:edition/tei:date[@type = "summaryDigitizedEd"]',
+                                  'make_first_date_range'),
+        'digitized_dates': ('tei:fileDesc/tei:editionStmt/tei:edition/tei:date[@type = "digitizedEd"]/text()', None),
+        'digitized_whens': ('tei:fileDesc/tei:editionStmt/tei:edition/'
+                            'tei:date[@type = "digitizedEd" or @type = "summaryDigitizedEd"]/@when', None),
+        'version': ('tei:fileDesc/tei:editionStmt/tei:edition/@n', None),
+        'series_volume': ('tei:fileDesc/tei:seriesStmt/tei:biblScope[@unit = "volume"]/@n', None),
+        'series_titles': ('tei:fileDesc/tei:seriesStmt/tei:title[@level = "s"]', 'make_series_titles'),
+        'source_title': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/tei:title[@type = "main"]/text()',
+                         None),
+        # TODO publishers of thisEd? (so far, publisher[@n = "firstEd"] was used for both thisEd and firstEd)
+        'source_publishers': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/'
+                              'tei:imprint/tei:publisher[@n = "firstEd"]/tei:persName', 'format_person_names'),
+        'source_extents': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/tei:extent', 'make_extents'),
+        'source_languages': ('tei:profileDesc/tei:langUsage/tei:language/@ident', None),
+        'source_this_date_ranges': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/'
+                                    'tei:imprint/tei:date[@type = "summaryThisEd"]', 'make_first_date_range'),
+        'source_first_date_ranges': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/'
+                                     'tei:imprint/tei:date[@type = "summaryFirstEd"]', 'make_first_date_range'),
+        'source_this_dates': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/'
+                              'tei:imprint/tei:date[@type = "thisEd"]/@when', None),
+        'source_first_dates': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/'
+                               'tei:imprint/tei:date[@type = "firstEd"]/@when', None),
+        'source_this_places': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/'
+                               'tei:imprint/tei:pubPlace[@role = "thisEd"]', 'make_place_names'),
+        'source_first_places': ('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/'
+                                'tei:imprint/tei:pubPlace[@role = "firstEd"]', 'make_place_names'),
+        'source_repositories': ('tei:fileDesc/tei:sourceDesc/tei:msDesc/tei:msIdentifier', 'make_repositories'),
+    }
+    compiled_header_schema = compile_header_schema(header_schema)
+
+    def extract_header(self, tei_header: etree._Element):
+        """
+        Extracts all data required for DTS metadata from a teiHeader (see header_schema) in a single walk over the
+        relevant parts of the header, as plain (i.e., JSON-like) data. Results are cached by a digest of the header
+        (see header_cache), and must thus not be modified by callers.
+        """
+        cache_key = hashlib.blake2b(etree.tostring(tei_header), digest_size=16).digest()
+        with header_cache_lock:
+            if cache_key in header_cache:
+                header_cache.move_to_end(cache_key)
+                return header_cache[cache_key]
+        values = extract_header_values(tei_header, self.compiled_header_schema)
+        header = {}
+        for field, (path, converter) in self.header_schema.items():
+            if converter:
+                header[field] = getattr(self, converter)(values.get(field, []))
+            else:
+                header[field] = [str(value) for value in values.get(field, [])]
+        with header_cache_lock:
+            header_cache[cache_key] = header
+            while len(header_cache) > header_cache_size:
+                header_cache.popitem(last=False)
+        return header
+
     def make_resource_metadata(self, tei_header: etree._Element, config, wid: str):
         """Translates data from the teiHeader of a work to DTS+DC metadata for a DTS textual Resource"""
+        header = self.extract_header(tei_header)
 
         # 1.) gather metadata
         # a) digital edition
         id = id_server + '/texts/' + config.get_wid()
         # TODO @id shouldn't be the same as the @id of the parent collection, but sth more specific
-        title = tei_header.xpath('tei:fileDesc/tei:titleStmt/tei:title[@type = "short"]/text()', namespaces=xml_ns)[0]
-        alt_title = tei_header.xpath('tei:fileDesc/tei:titleStmt/tei:title[@type = "main"]/text()', namespaces=xml_ns)[0]  # or short title here?
-        author = '; '.join(self.format_person_names(tei_header.xpath('tei:fileDesc/tei:titleStmt/tei:author/tei:persName',
-                                                      namespaces=xml_ns), reverse=False))
-        scholarly_editors = self.format_person_names(tei_header.xpath('tei:fileDesc/tei:titleStmt/' +
-                                                                 'tei:editor[contains(@role, "#scholarly")]/tei:persName',
-                                                                 namespaces=xml_ns))
-        technical_editors = self.format_person_names(tei_header.xpath('tei:fileDesc/tei:titleStmt/' +
-                                                                 'tei:editor[contains(@role, "#technical")]/tei:persName',
-                                                                 namespaces=xml_ns))
+        title = header['title'][0]
+        alt_title = header['alt_title'][0]
+        author = '; '.join(header['authors'])
+        scholarly_editors = list(header['scholarly_editors'])
+        technical_editors = list(header['technical_editors'])
         editors = list(set(scholarly_editors + technical_editors))
-        pub_date = self.get_publish_date(tei_header)
-        version = tei_header.xpath('tei:fileDesc/tei:editionStmt/tei:edition/@n', namespaces=xml_ns)[0]
-        series_volume = tei_header.xpath('tei:fileDesc/tei:seriesStmt/tei:biblScope[@unit = "volume"]/@n',
-                                         namespaces=xml_ns)[0]
+        pub_date = self.get_publish_date(header)
+        version = header['version'][0]
+        series_volume = header['series_volume'][0]
         rights_holder = {
             '@id': 'https://id.salamanca.school',
             'name': {
@@ -71,30 +233,16 @@ class WorkMetadataTransformer:
                 '@value': 'The School of Salamanca'
             }
         }  # TODO provisional values
-        bibliographic_citation = self.make_bibliographic_citations(tei_header, wid)
+        bibliographic_citation = self.make_bibliographic_citations(header, wid)
 
         # b) print source
-        source_title = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/tei:title[@type = "main"]/text()',
-                                        namespaces=xml_ns)[0]
-        source_publishers = self.format_person_names(self.get_source_publishers(tei_header), reverse=False)
-        source_extents = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/tei:extent',
-                                          namespaces=xml_ns)
-        source_extents_i18n = []
-        for extent in source_extents:
-            if exists(extent, '@xml:lang'):
-                extent_i18n = {
-                    '@language': extent.xpath('@xml:lang', namespaces=xml_ns)[0],
-                    '@value': extent.xpath('text()')[0]
-                }
-                source_extents_i18n.append(extent_i18n)
-            else:
-                source_extents_i18n.append(extent.xpath('text()')[0])
-        source_lang = []
-        for lang in tei_header.xpath('tei:profileDesc/tei:langUsage/tei:language/@ident', namespaces=xml_ns):
-            source_lang.append(lang)
-        source_pub_date = self.get_source_publish_date(tei_header)
-        source_pub_place = self.get_source_publish_place(tei_header)
-        source_repositories = self.get_source_repositories(tei_header)
+        source_title = header['source_title'][0]
+        source_publishers = list(header['source_publishers'])
+        source_extents_i18n = deepcopy(header['source_extents'])
+        source_lang = list(header['source_languages'])
+        source_pub_date = self.get_source_publish_date(header)
+        source_pub_place = self.get_source_publish_place(header)
+        source_repositories = deepcopy(header['source_repositories'])
 
         # c) other dts metadata
         total_items = 0 # TODO
@@ -174,40 +322,79 @@ class WorkMetadataTransformer:
         work (see make_work_collection_metadata)."""
         pass
 
-    # UTIL FUNCTIONS FOR EXTRACTION OF METADATA
-
-    def make_bibliographic_citations(self, tei_header: etree._Element, wid: str):
-        author_surname = tei_header.xpath('tei:fileDesc/tei:titleStmt/tei:author/tei:persName/tei:surname/text()',
-                                          namespaces=xml_ns)[0]
-        title = tei_header.xpath('tei:fileDesc/tei:titleStmt/tei:title[@type = "short"]/text()', namespaces=xml_ns)[0]
-        publish_year = tei_header.xpath('tei:fileDesc/tei:editionStmt/tei:edition/' +
-                                        'tei:date[@type = "digitizedEd" or @type = "summaryDigitizedEd"]/@when',
-                                        namespaces=xml_ns)[0][:4]  # getting year only
-        source_this_publish_year = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                                 'tei:imprint/tei:date[@type = "thisEd"]/@when', namespaces=xml_ns)
-        source_first_publish_year = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                                'tei:imprint/tei:date[@type = "firstEd"]/@when', namespaces=xml_ns)
+    def make_bibliographic_citations(self, header: dict, wid: str):
+        author_surname = header['author_surnames'][0]
+        title = header['title'][0]
+        publish_year = header['digitized_whens'][0][:4]  # getting year only
         # assuming here that work_multivolume also have a date[@type = "firstEd|thisEd"], additional to their summary...Ed
-        source_publish_year = source_first_publish_year[0]
-        if len(source_this_publish_year):
-            source_publish_year = source_this_publish_year[0]
+        source_publish_year = header['source_first_dates'][0]
+        if len(header['source_this_dates']):
+            source_publish_year = header['source_this_dates'][0]
         link = id_server + '/texts/' + wid
         bibliographic_citations = []
-        for series_title in tei_header.xpath('tei:fileDesc/tei:seriesStmt/tei:title[@level = "s"]', namespaces=xml_ns):
-            lang = series_title.xpath('@xml:lang', namespaces=xml_ns)[0]
+        for lang, series_title in header['series_titles']:
             citation = author_surname + ', ' + title + '(' + publish_year + '[' + source_publish_year + ']), ' \
-                       + series_title.text + ' <' + link + '>'
+                       + series_title + ' <' + link + '>'
             citation_obj = {'@language': lang, '@value': citation}
             bibliographic_citations.append(citation_obj)
         return bibliographic_citations
 
-    def get_source_repositories(self, tei_header: etree._Element):
+    def get_publish_date(self, header: dict):
+        if len(header['digitized_date_ranges']):
+            return deepcopy(header['digitized_date_ranges'][0])
+        else:
+            return header['digitized_dates'][0]
+
+    def get_source_publish_date(self, header: dict):
+        if len(header['source_this_date_ranges']):
+            return deepcopy(header['source_this_date_ranges'][0])
+        elif len(header['source_first_date_ranges']):
+            return deepcopy(header['source_first_date_ranges'][0])
+        if len(header['source_this_dates']):
+            return int(header['source_this_dates'][0][:4]) # assuming format like yyyy-mm-dd
+        else:
+            return int(header['source_first_dates'][0][:4])
+
+    def get_source_publish_place(self, header: dict):
+        if len(header['source_this_places']):
+            return header['source_this_places'][0]
+        else:
+            return header['source_first_places'][0]
+
+    # CONVERTERS FOR header_schema
+
+    def make_first_date_range(self, dates: list):
+        # only the first date (range) is relevant
+        if len(dates):
+            return [self.get_publish_date_range(dates[0])]
+        return []
+
+    def make_series_titles(self, series_titles: list):
+        return [(str(series_title.xpath('@xml:lang', namespaces=xml_ns)[0]), series_title.text)
+                for series_title in series_titles]
+
+    def make_extents(self, source_extents: list):
+        source_extents_i18n = []
+        for extent in source_extents:
+            if exists(extent, '@xml:lang'):
+                extent_i18n = {
+                    '@language': str(extent.xpath('@xml:lang', namespaces=xml_ns)[0]),
+                    '@value': str(extent.xpath('text()')[0])
+                }
+                source_extents_i18n.append(extent_i18n)
+            else:
+                source_extents_i18n.append(str(extent.xpath('text()')[0]))
+        return source_extents_i18n
+
+    def make_place_names(self, places: list):
+        return [self.get_place_name(place) for place in places]
+
+    def make_repositories(self, ms_identifiers: list):
         repositories = []
-        for ms_identifier in tei_header.xpath('/tei:TEI/tei:teiHeader/tei:fileDesc/tei:sourceDesc/' +
-                                              'tei:msDesc/tei:msIdentifier', namespaces=xml_ns):
-            lang = ms_identifier.xpath('tei:repository/@xml:lang', namespaces=xml_ns)[0]
-            name = ms_identifier.xpath('tei:repository/text()', namespaces=xml_ns)[0]
-            link = ms_identifier.xpath('tei:idno[@type = "catlink"]/text()', namespaces=xml_ns)[0]
+        for ms_identifier in ms_identifiers:
+            lang = str(ms_identifier.xpath('tei:repository/@xml:lang', namespaces=xml_ns)[0])
+            name = str(ms_identifier.xpath('tei:repository/text()', namespaces=xml_ns)[0])
+            link = str(ms_identifier.xpath('tei:idno[@type = "catlink"]/text()', namespaces=xml_ns)[0])
             repo = {
                 'owner': {'@language': lang, '@value': name}, # TODO lod ID
                 'link': link
@@ -215,33 +402,7 @@ class WorkMetadataTransformer:
             repositories.append(repo)
         return repositories
 
-    def get_publish_date(self, tei_header: etree._Element):
-        range = tei_header.xpath('tei:fileDesc/tei:editionStmt/tei:edition/tei:date[@type = "summaryDigitizedEd"]',
-                                 namespaces=xml_ns)
-        date = tei_header.xpath('tei:fileDesc/tei:editionStmt/tei:edition/tei:date[@type = "digitizedEd"]/text()',
-                                namespaces=xml_ns)
-        if len(range):
-            return self.get_publish_date_range(range[0])
-        else:
-            return date[0]
-
-    def get_source_publish_date(self, tei_header: etree._Element):
-        this_range = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                      'tei:imprint/tei:date[@type = "summaryThisEd"]', namespaces=xml_ns)
-        first_range = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                       'tei:imprint/tei:date[@type = "summaryFirstEd"]', namespaces=xml_ns)
-        this_date = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                     'tei:imprint/tei:date[@type = "thisEd"]/@when', namespaces=xml_ns)
-        first_date = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                      'tei:imprint/tei:date[@type = "firstEd"]/@when', namespaces=xml_ns)
-        if len(this_range):
-            return self.get_publish_date_range(this_range[0])
-        elif len(first_range):
-            return self.get_publish_date_range(first_range[0])
-        if len(this_date):
-            return int(this_date[0][:4]) # assuming format like yyyy-mm-dd
-        else:
-            return int(first_date[0][:4])
+    # UTIL FUNCTIONS
 
     def get_publish_date_range(self, date: etree._Element):
         if exists(date, '@from'):
@@ -250,29 +411,7 @@ class WorkMetadataTransformer:
                 date['to'] = date.xpath('@to')[0]
             return date
         else:
-            return date.xpath('text()')[0]
-
-    def get_source_publishers(self, tei_header: etree._Element):
-        this_publishers = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                           'tei:imprint/tei:publisher[@n = "firstEd"]/tei:persName',
-                                           namespaces=xml_ns)
-        first_publishers = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                            'tei:imprint/tei:publisher[@n = "firstEd"]/tei:persName',
-                                            namespaces=xml_ns)
-        if len(this_publishers):
-            return this_publishers
-        else:
-            return first_publishers
-
-    def get_source_publish_place(self, tei_header: etree._Element):
-        this_place = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                      'tei:imprint/tei:pubPlace[@role = "thisEd"]', namespaces=xml_ns)
-        first_place = tei_header.xpath('tei:fileDesc/tei:sourceDesc/tei:biblStruct/tei:monogr/' +
-                                       'tei:imprint/tei:pubPlace[@role = "firstEd"]', namespaces=xml_ns)
-        if len(this_place):
-            return self.get_place_name(this_place[0])
-        else:
-            return self.get_place_name(first_place[0])
+            return str(date.xpath('text()')[0])
 
     def get_place_name(self, place_name: etree._Element):
         if exists(place_name, '@key'):
@@ -290,10 +429,10 @@ class WorkMetadataTransformer:
         for person in person_names:
             name = ''
             if exists(person, '@key'):
-                name = person.xpath('@key')[0]
+                name = str(person.xpath('@key')[0])
             elif exists(person, 'tei:surname and tei:forename'):
-                surname = person.xpath('tei:surname/text()', namespaces=xml_ns)[0]
-                forename = person.xpath('tei:forename/text()', namespaces=xml_ns)[0]
+                surname = str(person.xpath('tei:surname/text()', namespaces=xml_ns)[0])
+                forename = str(person.xpath('tei:forename/text()', namespaces=xml_ns)[0])
                 name_link = ''
                 if exists(person, 'tei:nameLink'):
                     name_link += ' ' + person.xpath('tei:nameLink/text()', namespaces=xml_ns)[0]
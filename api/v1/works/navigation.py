@@ -0,0 +1,79 @@
+from lxml import etree
+from array import array
+
+
+class NavigationIndex:
+    """
+    A compact representation of the citetrail tree of a work, derived from the enriched node index. Nodes are
+    stored in document order, and the children of each node are stored in a single array (with a start offset per
+    node), so that children and descendants queries take time proportional to the size of their result and never
+    touch passage content.
+    """
+
+    def __init__(self, enriched_index: etree._Element):
+        """
+        :param enriched_index: the flat sal_index as produced by WorkFactory.enrich_index()
+        """
+        self.refs = []  # citetrails in document order
+        self.cite_types = []
+        self.levels = array('H')
+        self.parents = array('i')  # position of the citetrail parent, or -1 for top-level nodes
+        self.positions = {}  # citetrail -> position
+        cite_types = {}  # for sharing equal cite type strings between nodes
+        for node in enriched_index.iter('sal_node'):
+            citetrail = node.get('citetrail')
+            self.positions[citetrail] = len(self.refs)
+            self.refs.append(citetrail)
+            cite_type = node.get('citeType')
+            self.cite_types.append(cite_types.setdefault(cite_type, cite_type))
+            self.levels.append(int(node.get('level')))
+            parent = node.get('citetrailParent')
+            # since parents precede their children in document order, they have already been registered
+            self.parents.append(self.positions.get(parent, -1) if parent else -1)
+
+        # children of node i are self.children[self.child_offsets[i]:self.child_offsets[i+1]], and top-level nodes are
+        # self.children[self.child_offsets[-2]:self.child_offsets[-1]] (i.e., the "root" is the last offset entry)
+        counts = [0] * (len(self.refs) + 1)
+        for parent in self.parents:
+            counts[parent] += 1
+        self.child_offsets = array('I', [0])
+        for count in counts:
+            self.child_offsets.append(self.child_offsets[-1] + count)
+        self.children = array('I', [0] * len(self.refs))
+        filled = list(self.child_offsets[:-1])
+        for position, parent in enumerate(self.parents):
+            self.children[filled[parent]] = position
+            filled[parent] += 1
+
+    def get_position(self, ref: str):
+        return self.positions.get(ref)
+
+    def get_children(self, position: int):
+        """Gets the positions of the children of the node at position, or of the top-level nodes if position is -1."""
+        if position < 0:
+            position = len(self.refs)
+        return self.children[self.child_offsets[position]:self.child_offsets[position + 1]]
+
+    def get_descendants(self, position: int, depth: int):
+        """Gets the positions of all descendants of the node at position (or of the root, if position is -1) up to
+        depth levels below that node, in document order."""
+        descendants = []
+        if depth < 1:
+            return descendants
+        for child in self.get_children(position):
+            descendants.append(child)
+            descendants.extend(self.get_descendants(child, depth - 1))
+        return descendants
+
+    def get_parent_ref(self, position: int):
+        parent = self.parents[position]
+        if parent >= 0:
+            return self.refs[parent]
+
+    def get_cite_depth(self):
+        return max(self.levels) if len(self.levels) else 0
+
+    def make_member(self, position: int):
+        return {'dts:ref': self.refs[position],
+                'dts:level': self.levels[position],
+                'dts:citeType': self.cite_types[position]}
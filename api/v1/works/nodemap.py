@@ -0,0 +1,155 @@
+"""
+Persisted node mappings of a work: a compact, sorted binary file that maps xml:id to citetrail/passagetrail and
+citetrail to xml:id, and that is read through mmap, so that other processes and later requests can resolve
+references into a work without re-indexing it.
+
+File layout (all integers unsigned 32-bit little endian):
+    header:        magic (8 bytes), number of nodes N
+    records:       N x (xml:id offset, citetrail offset, passagetrail offset), sorted by xml:id
+    citetrails:    N x record number, sorted by citetrail
+    strings:       length-prefixed UTF-8 strings, referred to by their offset relative to the start of this section
+Strings are compared bytewise, which for UTF-8 is equivalent to comparing code points.
+"""
+
+import mmap
+import os
+import struct
+import threading
+from api.v1.works.config import works_data_path
+
+
+magic = b'SALNMAP1'
+header_struct = struct.Struct('<8sI')
+record_struct = struct.Struct('<III')
+uint_struct = struct.Struct('<I')
+
+
+def get_node_map_path(wid: str) -> str:
+    return os.path.join(works_data_path, wid + '.map')
+
+
+def write_node_map(path: str, node_mappings: dict):
+    """Writes node mappings (of the form {xml:id: {'citetrail': ..., 'passagetrail': ...}}, see
+    WorkConfig.node_mappings) to a node map file. The file is replaced atomically."""
+    strings = bytearray()
+    string_offsets = {}
+
+    def put_string(value: bytes) -> int:
+        if value not in string_offsets:
+            string_offsets[value] = len(strings)
+            strings.extend(uint_struct.pack(len(value)) + value)
+        return string_offsets[value]
+
+    xml_ids = sorted((xml_id.encode('UTF-8') for xml_id in node_mappings))
+    citetrails = []
+    records = bytearray()
+    for xml_id in xml_ids:
+        mapping = node_mappings[xml_id.decode('UTF-8')]
+        citetrail = (mapping.get('citetrail') or '').encode('UTF-8')
+        passagetrail = (mapping.get('passagetrail') or '').encode('UTF-8')
+        citetrails.append(citetrail)
+        records.extend(record_struct.pack(put_string(xml_id), put_string(citetrail), put_string(passagetrail)))
+    citetrail_index = bytearray()
+    for record_n in sorted(range(len(xml_ids)), key=lambda n: citetrails[n]):
+        citetrail_index.extend(uint_struct.pack(record_n))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(tmp_path, 'wb') as fo:
+        fo.write(header_struct.pack(magic, len(xml_ids)))
+        fo.write(records)
+        fo.write(citetrail_index)
+        fo.write(strings)
+    os.replace(tmp_path, path)
+
+
+class NodeMap:
+    """Read-only, memory-mapped view of a node map file (see write_node_map)."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as fi:
+            self.buffer = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, self.count = header_struct.unpack_from(self.buffer, 0)
+        if file_magic != magic:
+            raise ValueError('Not a node map file: ' + path)
+        self.records_start = header_struct.size
+        self.citetrails_start = self.records_start + self.count * record_struct.size
+        self.strings_start = self.citetrails_start + self.count * uint_struct.size
+
+    def read_string(self, offset: int) -> bytes:
+        start = self.strings_start + offset
+        length = uint_struct.unpack_from(self.buffer, start)[0]
+        return self.buffer[start + uint_struct.size:start + uint_struct.size + length]
+
+    def read_record(self, record_n: int):
+        return record_struct.unpack_from(self.buffer, self.records_start + record_n * record_struct.size)
+
+    def find_record(self, xml_id: str):
+        """Binary search for the record of xml_id, returns the record or None."""
+        key = xml_id.encode('UTF-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self.read_record(middle)
+            value = self.read_string(record[0])
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return record
+        return None
+
+    def get_citetrail(self, xml_id: str):
+        record = self.find_record(xml_id)
+        if record:
+            return self.read_string(record[1]).decode('UTF-8') or None
+
+    def get_passagetrail(self, xml_id: str):
+        record = self.find_record(xml_id)
+        if record:
+            return self.read_string(record[2]).decode('UTF-8') or None
+
+    def get_xml_id(self, citetrail: str):
+        """Binary search in the citetrail index, returns the xml:id of the node with the citetrail or None."""
+        key = citetrail.encode('UTF-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record_n = uint_struct.unpack_from(self.buffer, self.citetrails_start + middle * uint_struct.size)[0]
+            record = self.read_record(record_n)
+            value = self.read_string(record[1])
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return self.read_string(record[0]).decode('UTF-8')
+        return None
+
+    def close(self):
+        self.buffer.close()
+
+
+# open node maps, by work id: (file modification time, NodeMap)
+node_maps = {}
+node_maps_lock = threading.Lock()
+
+
+def get_node_map(wid: str) -> NodeMap:
+    """Gets the (memory-mapped) node map of a work, or None if the work has not been indexed yet. Maps are reopened
+    if their file has been replaced in the meantime (e.g., by another process)."""
+    path = get_node_map_path(wid)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with node_maps_lock:
+        cached = node_maps.get(wid)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        node_map = NodeMap(path)
+        # the previously opened map is not closed explicitly, since it might still be in use by other threads; its
+        # mapping is released when it is garbage-collected
+        node_maps[wid] = (mtime, node_map)
+        return node_map
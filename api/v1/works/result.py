@@ -0,0 +1,128 @@
+from collections import OrderedDict
+import threading
+from api.results import JSONResult, hold_result, get_held_result
+from api.v1.works.navigation import NavigationIndex
+from api.v1.works.metadata import context
+from api.v1.works.config import id_server, passage_cache_size
+
+
+# passage formats that can be requested for single passages, and their media types
+document_formats = {
+    'html': 'text/html',
+    'txt_edit': 'text/plain',
+    'txt_orig': 'text/plain',
+    'tei': 'application/tei+xml'
+}
+
+# hot passages (see WorkResult.get_passage), by (etag of the result, ref, format), in order of their last use; the
+# passages of results that have been replaced are not requested anymore, and thus are evicted first
+passages = OrderedDict()
+passages_lock = threading.Lock()
+
+
+class WorkResult(JSONResult):
+    """
+    The result of a work transformation: work metadata and passages (see factory.transform), together with the
+    indexes required for answering DTS queries about the work after the transformation has finished.
+    """
+
+    def __init__(self, wid: str, data: dict, navigation: NavigationIndex):
+        super().__init__(data, 'work_passages')
+        self.wid = wid
+        self.navigation = navigation
+
+    def get_passage(self, ref: str, fmt: str) -> bytes:
+        """
+        Gets a passage in one of the document_formats, from the cache of hot passages (which are kept decoded, and
+        encoded as response bodies) if possible, otherwise from the result buffer (see read_passage).
+        :return: the UTF-8 encoded passage, or None if there is no passage ref or if it has no content in format fmt
+        """
+        key = (self.etag, ref, fmt)
+        with passages_lock:
+            if key in passages:
+                passages.move_to_end(key)
+                return passages[key]
+        passage = self.read_passage(ref, fmt)
+        with passages_lock:
+            passages[key] = passage
+            while len(passages) > passage_cache_size:
+                passages.popitem(last=False)
+        return passage
+
+    def read_passage(self, ref: str, fmt: str) -> bytes:
+        """
+        Reads a passage in one of the document_formats directly from the result buffer (via its offset index).
+        Use get_passage() for cached access.
+        :return: the UTF-8 encoded passage, or None if there is no passage ref or if it has no content in format fmt
+        """
+        position = self.refs.get(ref)
+        if position is None:
+            return None
+        value = self.get_item_value(position, fmt)
+        if value is None:
+            return None
+        return value.encode('UTF-8')
+
+
+# the navigation indexes of the most recent results of all works, by work id; they are small (a few dozen bytes per
+# passage), so that they are kept for all works, and navigation requests are answered even after the results
+# themselves have been evicted (in which case document requests are answered with 404 until the work is transformed
+# again)
+navigations = {}
+# serializes changes of the current results of works (see put_work_result and replace_work_result)
+work_results_lock = threading.Lock()
+
+
+def put_work_result(result: WorkResult):
+    """Makes result the current result of its work. Work results are held in the shared result store (see
+    results.hold_result), so that they are evicted together with the results of tasks and docs."""
+    with work_results_lock:
+        navigations[result.wid] = result.navigation
+        hold_result(('work', result.wid), result)
+
+
+def replace_work_result(current: WorkResult, result: WorkResult) -> bool:
+    """Makes result (e.g., a patched copy of current) the current result of its work, unless current is not the
+    current result anymore (since the work has been transformed anew, or its result has been evicted, meanwhile).
+    :return: True if result has been put, False otherwise
+    """
+    with work_results_lock:
+        if get_held_result(('work', result.wid)) is not current:
+            return False
+        navigations[result.wid] = result.navigation
+        hold_result(('work', result.wid), result)
+    return True
+
+
+def get_work_result(wid: str) -> WorkResult:
+    """:return: the current result of work wid, or None if it has not been transformed or if it has been evicted"""
+    return get_held_result(('work', wid))
+
+
+def get_work_navigation(wid: str) -> NavigationIndex:
+    """:return: the navigation index of the current result of work wid, or None if it has not been transformed"""
+    return navigations.get(wid)
+
+
+def make_navigation(wid: str, index: NavigationIndex, ref: str, level: int) -> dict:
+    """
+    Makes a DTS navigation object for work wid listing the passages up to level levels below the passage ref (or
+    below the root of the work, if ref is None).
+    :return: the navigation object, or None if there is no passage ref
+    """
+    position = -1
+    if ref:
+        position = index.get_position(ref)
+        if position is None:
+            return None
+    navigation = {
+        '@context': context,
+        '@id': id_server + '/texts/' + wid + ('/navigation?ref=' + ref if ref else '/navigation'),
+        'dts:citeDepth': index.get_cite_depth(),
+        'dts:level': index.levels[position] if ref else 0,
+        'member': [index.make_member(d) for d in index.get_descendants(position, level)]
+    }
+    if ref:
+        navigation['dts:passage'] = ref
+        navigation['dts:parent'] = index.get_parent_ref(position)
+    return navigation
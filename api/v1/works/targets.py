@@ -0,0 +1,94 @@
+import re
+from api.v1.xutils import get_target_node
+from api.v1.errors import TEIMarkupError
+from api.v1.works.config import WorkConfig, id_server
+from api.v1.works.corpus import make_cross_work_uri
+
+
+class TargetResolver:
+    """
+    Resolves @target values (of tei:ref etc.) of a work to URIs. Schemes and prefixDefs are compiled only once per
+    work, and each distinct target is resolved only once, since resolution does not depend on the referring node.
+    Requires that citetrails (and the facs index) of the work are complete, i.e. that the work has been indexed.
+    """
+
+    work_scheme = re.compile(r'(work:(W[A-z0-9.:_\-]+))?#(.*)')  # TODO is this failsafe?
+    facs_scheme = re.compile(r'facs:((W[0-9]+)[A-z0-9.:#_\-]+)')
+    generic_scheme = re.compile(r'(\S+):([A-z0-9.:#_\-]+)')
+
+    def __init__(self, config: WorkConfig):
+        self.config = config
+        self.reset()
+
+    def reset(self):
+        self.prefix_defs = {}  # prefix -> (compiled matchPattern, replacement), compiled on first use
+        self.resolved = {}  # target -> (uri, (work id, xml:id) if target is a node in another work, else None)
+
+    def resolve(self, node, target: str):
+        """
+        Resolves a single target.
+        :param node: the referring node (only used for finding the targeted node in the tree when target is
+        resolved for the first time)
+        :return: a tuple (uri, cross_work_target), where cross_work_target is a tuple (work id, xml:id) if target
+        refers to a node in another work, or None otherwise
+        """
+        if target not in self.resolved:
+            self.resolved[target] = self.resolve_uncached(node, target)
+        return self.resolved[target]
+
+    def resolve_uncached(self, node, target: str):
+        if target.startswith('#'):
+            # target is some node in the current work
+            if len(get_target_node(node, id=target[1:])) == 1:
+                return self.make_citetrail_uri(target[1:]), None
+            return target, None
+        work_match = self.work_scheme.match(target)
+        if work_match:
+            # target is something like "work:W...#..."
+            target_work_id, anchor_id = work_match.group(2), work_match.group(3)
+            if target_work_id and target_work_id != self.config.wid:
+                # target is a node in another work: its citetrail is looked up in the corpus registry (if the other
+                # work hasn't been indexed yet, this refers to the complete work)
+                return make_cross_work_uri(target_work_id, anchor_id), (target_work_id, anchor_id)
+            elif anchor_id:
+                # target is just a link to a fragment anchor, so targetWorkId = currentWork
+                return self.make_citetrail_uri(anchor_id), None
+            return target, None
+        facs_match = self.facs_scheme.match(target)
+        if facs_match:
+            # target is a facs string
+            if facs_match.group(2) != self.config.wid:
+                raise TEIMarkupError('@target refers to @facs from a different work than the current one')
+            facs_mapping = self.config.get_facs_mapping(target)
+            if facs_mapping:
+                return self.make_citetrail_uri(facs_mapping['id']), None
+            return target, None
+        generic_match = self.generic_scheme.match(target)
+        if generic_match:
+            # use the general replacement mechanism as defined by the teiHeader's prefixDef
+            prefix_def = self.get_prefix_def(generic_match.group(1))
+            value = generic_match.group(2)
+            if prefix_def and prefix_def[0].match(value):
+                return prefix_def[0].sub(prefix_def[1], value), None
+        return target, None
+
+    def get_prefix_def(self, prefix: str):
+        if prefix not in self.prefix_defs:
+            prefix_def = self.config.get_prefix_defs().get(prefix)
+            if prefix_def:
+                # prefixDef/@replacementPattern refers to groups as $1, $2, ...
+                replacement = re.sub(r'\$(\d)', r'\\\1', prefix_def['replacementPattern'])
+                self.prefix_defs[prefix] = (re.compile(prefix_def['matchPattern']), replacement)
+            else:
+                self.prefix_defs[prefix] = None
+        return self.prefix_defs[prefix]
+
+    def make_citetrail_uri(self, xml_id: str) -> str:
+        """
+        Tries to derive the citetrail URI for a node from its @xml:id. Works only if the node/@xml:id is in work
+        "config.wid"; returns the empty string otherwise.
+        """
+        citetrail = self.config.get_citetrail_mapping(xml_id)
+        if citetrail:
+            return id_server + '/texts/' + self.config.wid + ':' + citetrail
+        return ''
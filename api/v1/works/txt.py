@@ -2,15 +2,44 @@ from lxml import etree
 import re
 from api.v1.xutils import flatten, is_element, exists, get_xml_id, is_text_node
 from api.v1.errors import TEIUnkownElementError
-from api.v1.works.config import WorkConfig, tei_text_elements
+from api.v1.works.config import WorkConfig, tei_text_elements, id_server
 #from api.v1.works.analysis import WorkAnalysis
 
 
+# marks the point at which a bounded rendering (see WorkTXTTransformer.dispatch_bounded) has stopped; cannot occur in XML
+truncation_mark = '\x00'
+
+note_placeholder_regex = re.compile(r'\{%note:([^%]+)%\}')
+
+
+def resolve_note_placeholders(text: str, notes: dict, how: str) -> str:
+    """
+    Replaces the {%note:<xml:id>%} placeholders in the txt of a passage with the already rendered notes.
+    :param notes: {xml:id: (txt of the note in the same mode as text, citetrail URI of the note)}
+    :param how: 'inline' (the note's txt) or 'link' (the note's citetrail URI, in curly brackets)
+    Placeholders for unknown notes are left as they are.
+    """
+    def replace(match):
+        note = notes.get(match.group(1))
+        if note is None:
+            return match.group(0)
+        elif how == 'inline':
+            return note[0]
+        else:
+            return '{' + note[1] + '}'
+    return note_placeholder_regex.sub(replace, text)
+
+
 class WorkTXTTransformer:
 
     def __init__(self, config: WorkConfig, analysis):
         self.config = config
         self.analysis = analysis
+        self.reset()
+
+    def reset(self):
+        self.note_placeholders = None  # xml:ids of the notes for which placeholders are made (see dispatch_passage)
+        self.budget = None  # number of characters still to be rendered in bounded mode, None if not bounded
 
     def dispatch(self, node, mode):
         if is_element(node):
@@ -29,15 +58,40 @@ class WorkTXTTransformer:
             return ''
         # omit comments and processing instructions
 
+    def dispatch_bounded(self, node, mode, budget: int):
+        """
+        Renders node like dispatch(), but stops the traversal as soon as (at least) budget characters of text have
+        been produced, so that only a prefix of the text is rendered.
+        :return: a tuple (text, complete), where text is an exact prefix of the text produced by dispatch(), and
+        complete is True if text is the whole text
+        """
+        self.budget = budget
+        try:
+            text = self.dispatch(node, mode) or ''
+        finally:
+            self.budget = None
+        mark = text.find(truncation_mark)
+        if mark >= 0:
+            return text[:mark], False
+        return text, True
+
     def passthru(self, node, mode):
         if len(node.xpath('node()')) > 0:
             children = []
             for child in node.xpath('node()'):
+                if self.budget is not None and self.budget <= 0:
+                    # bounded mode: skip all remaining nodes, marking the point up to which the text is complete
+                    # (anything that ancestors append after this mark is discarded by dispatch_bounded)
+                    children.append(truncation_mark)
+                    break
                 if is_element(child):
                     if self.analysis.is_basic_node(child) and self.analysis.is_marginal_node(child):
                         id = get_xml_id(child)
                         children.append('{%note:' + id + '%}')
-                        # placeholder for marginal note in main text: those must be reinserted later if necessary
+                        if self.note_placeholders is not None:
+                            self.note_placeholders.append(id)
+                        # placeholder for marginal note in main text: those are resolved after rendering, if configured
+                        # (see config.txt_note_placeholders)
                         # TODO: use citetrail rather than xml:id? make sure that placeholders are excluded from searching/indexing
                     elif not self.analysis.is_structural_node(child):
                         # makes sure that structural elements yield only headings, not their nested content
@@ -48,8 +102,27 @@ class WorkTXTTransformer:
         else:
             return ''
 
+    def dispatch_passage(self, node, mode):
+        """
+        Renders the txt of a passage like dispatch(), and collects the marginal notes for which placeholders are made
+        in it (other calls, e.g. for teasers or for the html of a passage, do not collect them).
+        :return: a tuple (text, xml:ids of the notes for which placeholders have been made)
+        """
+        outer = self.note_placeholders
+        self.note_placeholders = []
+        try:
+            return self.dispatch(node, mode), self.note_placeholders
+        finally:
+            self.note_placeholders = outer
+
+    def make_note_uri(self, citetrail):
+        return id_server + '/texts/' + self.config.wid + ':' + citetrail
+
     def transform_text_node(self, node, mode):
-        return re.sub(r'\s+', ' ', str(node))
+        text = re.sub(r'\s+', ' ', str(node))
+        if self.budget is not None:
+            self.budget -= len(text)
+        return text
 
     # ELEMENT FUNCTIONS
 
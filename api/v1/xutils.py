@@ -1,5 +1,11 @@
 from lxml import etree
+import os
 import re
+import threading
+import zlib
+from copy import deepcopy
+from urllib.parse import urlparse
+from api.v1.errors import XIncludeError
 
 # NAMESPACES
 
@@ -77,22 +83,203 @@ get_target_node = etree.XPath('ancestor::tei:TEI/tei:text//*[@xml:id = $id]', na
 
 
 def safe_xinclude(tree: etree._ElementTree):
-    """Tries to prevent problems with the lxml xinclude function, where unexpanded nodes sometimes still stick
-    in the tree after xinclusion."""
-    tree.xinclude()
-    return etree.fromstring(etree.tostring(tree.getroot()))
-    # converting to string seems to resolve duplicate/unexpanded nodes
+    """Expands the xi:include elements in a tree (in place), and returns the tree's root. Unlike lxml's xinclude(),
+    which sometimes left unexpanded nodes in the tree (and thus required a serialization round trip), this replaces
+    each xi:include by copies of the (cached) included nodes, see resolve_xincludes()."""
+    root = tree.getroot()
+    resolve_xincludes(root)
+    return root
+
+
+# XINCLUDE
+
+xinclude_parser = etree.XMLParser(attribute_defaults=False, no_network=False, ns_clean=True, remove_blank_text=False,
+                                  remove_comments=False, remove_pis=False, compact=False, collect_ids=True,
+                                  resolve_entities=False, huge_tree=False)
+xi_include = '{' + basic_ns['xi'] + '}include'
+xi_fallback = '{' + basic_ns['xi'] + '}fallback'
+xml_base = '{' + basic_ns['xml'] + '}base'
+xpointer_element_regex = re.compile(r'^element\(([^/()]+)\)$')
+xpointer_id_regex = re.compile(r'^xpointer\(id\([\'"]([^\'"]+)[\'"]\)\)$')
+
+# included files, by absolute path and parse type: ({path: mtime} of the file and all files it includes, content),
+# where content is the root element (with all xi:includes expanded) for parse="xml", or a string for parse="text"
+included_files = {}
+included_files_lock = threading.Lock()
+
+
+def resolve_xincludes(root: etree._Element, including=()):
+    """
+    Replaces all xi:include elements below (and including) root by the nodes they refer to, as lxml's
+    xinclude() does (including xml:base fixup for files from other directories). Included files are parsed only once
+    (per modification time), and only copies of their nodes are inserted into the tree.
+    :param including: absolute paths of the files that are currently being included (for detecting cycles)
+    :return: {path: mtime} of all included files
+    """
+    dependencies = {}
+    includes = [include for include in root.iter(xi_include)
+                if next(include.iterancestors(xi_include), None) is None]  # those within xi:fallback come later
+    for include in includes:
+        href = include.get('href')
+        base = include.base or ''
+        if base.startswith('file:'):
+            base = urlparse(base).path
+        path = os.path.abspath(os.path.join(os.path.dirname(base), href)) if href else os.path.abspath(base)
+        parse = include.get('parse', 'xml')
+        try:
+            content, content_dependencies = get_included_file(path, parse, including)
+            if parse == 'text':
+                items = [content]
+            else:
+                items = select_xpointer(content, include.get('xpointer'))
+                # as libxml2, make included elements refer to their original location if it is another directory
+                relative_path = os.path.relpath(path, os.path.dirname(os.path.abspath(base)))
+                if os.path.dirname(relative_path):
+                    for item in items:
+                        if isinstance(item.tag, str) and item.get(xml_base) is None:
+                            item.set(xml_base, relative_path.replace(os.sep, '/'))
+            dependencies.update(content_dependencies)
+            replace_node(include, items)
+        except (OSError, etree.XMLSyntaxError, XIncludeError) as e:
+            fallback = include.find(xi_fallback)
+            if fallback is None:
+                raise XIncludeError('Could not include ' + path + ': ' + str(e))
+            items = ([fallback.text] if fallback.text else []) + \
+                    [item for child in fallback for item in ([child, child.tail] if child.tail else [child])]
+            for child in fallback:
+                child.tail = None
+            replace_node(include, items)
+            for item in items:
+                if not isinstance(item, str):
+                    dependencies.update(resolve_xincludes(item, including))
+    return dependencies
+
+
+def get_included_file(path: str, parse: str, including=()):
+    """Gets the (cached) content of an included file, see included_files."""
+    if path in including:
+        raise XIncludeError('Recursive inclusion of ' + path)
+    with included_files_lock:
+        cached = included_files.get((path, parse))
+    if cached and all(os.stat(dependency).st_mtime_ns == mtime for dependency, mtime in cached[0].items()):
+        return cached[1], cached[0]
+    dependencies = {path: os.stat(path).st_mtime_ns}
+    if parse == 'text':
+        with open(path, encoding='UTF-8') as fi:
+            content = fi.read()
+    else:
+        content = etree.parse(path, xinclude_parser).getroot()
+        dependencies.update(resolve_xincludes(content, including + (path,)))
+    with included_files_lock:
+        included_files[(path, parse)] = (dependencies, content)
+    return content, dependencies
+
+
+def select_xpointer(root: etree._Element, xpointer):
+    """Gets copies of the nodes of an included document that are referred to by xpointer: the whole document
+    (including comments and processing instructions outside of the root element) if there is no xpointer, otherwise
+    the element with the xml:id given as shorthand pointer, element(...) or xpointer(id(...))."""
+    if not xpointer:
+        nodes = list(reversed(list(root.itersiblings(preceding=True)))) + [root] + list(root.itersiblings())
+    else:
+        match = xpointer_element_regex.match(xpointer) or xpointer_id_regex.match(xpointer)
+        xml_id = match.group(1) if match else xpointer
+        nodes = get_node_by_xmlid(root, xmlid=xml_id)
+        if not nodes:
+            raise XIncludeError('Could not resolve xpointer ' + xpointer)
+        nodes = nodes[:1]
+    copies = []
+    for node in nodes:
+        node_copy = deepcopy(node)
+        node_copy.tail = None
+        copies.append(node_copy)
+    return copies
+
+
+def replace_node(node: etree._Element, items: list):
+    """Replaces node (but not its tail) by items, which may be nodes or strings."""
+    parent = node.getparent()
+    if parent is None:
+        raise XIncludeError('Cannot replace the root element ' + str(node.tag) + ' of a document')
+    tail = node.tail
+    previous = node.getprevious()
+    index = parent.index(node)
+    node.tail = None
+    parent.remove(node)
+
+    def add_text(text):
+        if previous is None:
+            parent.text = (parent.text or '') + text
+        else:
+            previous.tail = (previous.tail or '') + text
+
+    for item in items:
+        if isinstance(item, str):
+            add_text(item)
+        else:
+            parent.insert(index, item)
+            index += 1
+            previous = item
+    if tail:
+        add_text(tail)
 
 
 get_node_by_xmlid = etree.XPath('//*[@xml:id = $xmlid]', namespaces=xml_ns)
 
 
+# content codings of request bodies that can be decoded while parsing (see feed_parser)
+supported_content_encodings = ('identity', 'gzip', 'x-gzip')
+
+
+def feed_parser(stream, parser: etree.XMLParser, content_encoding=None, copy_to=None, chunk_size=1024 * 1024):
+    """
+    Parses an XML document from a binary stream (e.g., the body of a request, while it is being received) chunk by
+    chunk, so that the complete document never needs to be held in memory as bytes.
+    :param content_encoding: the content coding of the stream (one of supported_content_encodings, or None)
+    :param copy_to: a binary file to which the (decoded) document is copied, if given
+    :return: the root element of the document
+    """
+    decompressor = None
+    if content_encoding and content_encoding.lower() in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding and content_encoding.lower() != 'identity':
+        raise ValueError('Unsupported content coding: ' + content_encoding)
+
+    def feed(data):
+        if data:
+            if copy_to is not None:
+                copy_to.write(data)
+            parser.feed(data)
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        feed(decompressor.decompress(chunk) if decompressor else chunk)
+    if decompressor:
+        feed(decompressor.flush())
+    return parser.close()
+
+
 def wrap_in_dts_fragment(content):
+    """Wraps content (an element, a string, or a - possibly nested - list of elements and strings, as returned by
+    the transformers' dispatch methods) in a dts:fragment element."""
     dts_fragment = etree.Element('{' + dts_ns['dts'] + '}' + 'fragment', nsmap=dts_ns)
     if isinstance(content, etree._Element):
         dts_fragment.append(content)
     elif isinstance(content, str):
         dts_fragment.text = content
+    elif isinstance(content, list):
+        preceding_elem = None
+        for part in flatten(content):
+            if isinstance(part, etree._Element):
+                dts_fragment.append(part)
+                preceding_elem = part
+            elif isinstance(part, str):
+                if preceding_elem is None:
+                    dts_fragment.text = (dts_fragment.text or '') + part
+                else:
+                    preceding_elem.tail = (preceding_elem.tail or '') + part
     return dts_fragment
 
 
@@ -0,0 +1,147 @@
+"""
+Completion webhooks: clients may pass a callback URL when submitting a task (see tasks.async_api), to which a
+compact completion notice is POSTed once the task has finished, so that they do not need to poll for the result.
+Notices are delivered in the background, with retries (and exponential backoff) if the callback cannot be reached.
+Since the server makes these requests on behalf of clients, callbacks must not point to internal hosts (see
+resolve_callback).
+"""
+
+import http.client
+import ipaddress
+import json
+import logging
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+logger = logging.getLogger(__name__)
+
+# number of delivery attempts for a notice, seconds to wait before the first retry (doubled for each further retry),
+# and timeout (in seconds) of a single delivery attempt
+webhook_attempts = 5
+webhook_backoff = 1
+webhook_timeout = 10
+# host names (as given in callback URLs) that may be called back even though they resolve to loopback, private,
+# link-local, or other non-public addresses, e.g. {'harvester.internal'}
+webhook_allowed_hosts = set()
+
+
+def is_public_address(address: str) -> bool:
+    # (IPv6 addresses of getaddrinfo might have a scope id, e.g. 'fe80::1%eth0')
+    ip = ipaddress.ip_address(address.split('%')[0])
+    return ip.is_global and not ip.is_multicast
+
+
+def resolve_callback(url: str) -> str:
+    """Resolves the host of a callback URL.
+    :return: the address to which notices are to be delivered (see post_notice, which connects to this address rather
+    than resolving the host anew, so that the host cannot be re-pointed to an internal address meanwhile)
+    :raises ValueError: if url is not an http(s) URL, or if its host resolves to an address that is not public (unless
+    the host is in webhook_allowed_hosts)
+    :raises OSError: if the host cannot be resolved
+    """
+    parsed = urlsplit(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError('not an http(s) URL: ' + url)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    addresses = [info[4][0] for info in socket.getaddrinfo(parsed.hostname, port, type=socket.SOCK_STREAM)]
+    if parsed.hostname not in webhook_allowed_hosts and not all(is_public_address(a) for a in addresses):
+        raise ValueError('host of ' + url + ' is not public')
+    return addresses[0]
+
+
+class CheckedHTTPConnection(http.client.HTTPConnection):
+    """Connects to an address that has been checked by resolve_callback, rather than resolving the host anew (the
+    Host header still names the host)."""
+
+    def __init__(self, host: str, port: int, address: str, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class CheckedHTTPSConnection(http.client.HTTPSConnection):
+    """Like CheckedHTTPConnection, for https: the certificate is still checked against the host name."""
+
+    def __init__(self, host: str, port: int, address: str, **kwargs):
+        self.ssl_context = ssl.create_default_context()
+        super().__init__(host, port, context=self.ssl_context, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+
+def is_valid_callback(url: str) -> bool:
+    try:
+        resolve_callback(url)
+    except (ValueError, OSError, UnicodeError):
+        return False
+    return True
+
+
+def post_notice(url: str, notice: dict):
+    """Makes a single attempt to POST notice to url. Redirects are not followed, since they might point to internal
+    hosts.
+    :return: True if the notice has been delivered, None if it has been rejected (client errors other than 408/429,
+    redirects, or callbacks that are not allowed anymore), or False if the attempt should be retried
+    """
+    try:
+        address = resolve_callback(url)
+    except (ValueError, UnicodeError) as e:
+        logger.warning('Webhook %s is not allowed: %s', url, e)
+        return None
+    except OSError as e:
+        logger.warning('Webhook %s could not be resolved: %s', url, e)
+        return False
+    parsed = urlsplit(url)
+    connection_class = CheckedHTTPSConnection if parsed.scheme == 'https' else CheckedHTTPConnection
+    connection = connection_class(parsed.hostname, parsed.port, address, timeout=webhook_timeout)
+    try:
+        connection.request('POST', (parsed.path or '/') + ('?' + parsed.query if parsed.query else ''),
+                           body=json.dumps(notice).encode('UTF-8'), headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+    except (http.client.HTTPException, OSError) as e:
+        logger.warning('Webhook %s could not be reached: %s', url, e)
+        return False
+    finally:
+        connection.close()
+    if 200 <= response.status < 300:
+        return True
+    logger.warning('Webhook %s answered with status %s', url, response.status)
+    if response.status >= 500 or response.status in (408, 429):
+        return False
+    return None
+
+
+def deliver_notice(url: str, notice: dict, status: dict):
+    """Delivers notice to url, retrying with exponential backoff. Progress is recorded in status (attempts,
+    delivered)."""
+    delay = webhook_backoff
+    for attempt in range(1, webhook_attempts + 1):
+        status['attempts'] = attempt
+        delivered = post_notice(url, notice)
+        if delivered is not False:
+            status['delivered'] = bool(delivered)
+            return
+        if attempt < webhook_attempts:
+            time.sleep(delay)
+            delay *= 2
+    status['delivered'] = False
+
+
+def send_notice(url: str, notice: dict) -> dict:
+    """Delivers notice to url in a background thread.
+    :return: the delivery status, which is updated as the delivery proceeds
+    """
+    status = {'url': url, 'attempts': 0, 'delivered': None}
+    thread = threading.Thread(target=deliver_notice, args=(url, notice, status), daemon=True)
+    thread.start()
+    return status
@@ -0,0 +1,129 @@
+"""
+Helpers for code that runs within tasks (such as the factories): progress reports, cooperative abort checks, and the
+worker processes of tasks. This module does not depend on Flask, so that the factories, as well as the fork server
+and the worker processes, can import it without loading the web stack (see tasks.py for the task registry and routes).
+"""
+
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
+from datetime import datetime
+
+
+# maximum number of worker processes of all tasks together (see reserve_workers); tasks that cannot get at least two of
+# them do their work sequentially
+max_worker_processes = 8
+# interval (in seconds) in which tasks waiting for worker processes check whether they have to be aborted
+worker_check_interval = 0.5
+# start method of worker processes (see make_worker_pool): 'forkserver' forks them from a server process that has
+# loaded (and warmed up) worker_preload_modules once, 'fork' forks them from the (multithreaded) app process itself,
+# and 'spawn' starts each of them from scratch
+worker_start_method = 'forkserver'
+# modules that are loaded by the fork server before it forks any worker processes
+worker_preload_modules = ['api.v1.preload']
+
+# number of worker processes currently reserved by tasks
+reserved_workers = 0
+reserved_workers_lock = threading.Lock()
+
+# the task run by the current thread, if any (see report_progress and check_abort); set by tasks.async_api
+current_task = threading.local()
+
+
+class TaskAborted(Exception):
+    """Raised (see check_abort) in a task that has been cancelled or that has exceeded its deadline."""
+
+    def __init__(self, message: str, cancelled: bool):
+        super().__init__(message)
+        self.cancelled = cancelled
+
+
+def report_progress(stage: str):
+    """Records that the task run by the current thread has reached some stage (e.g., 'indexing'), and notifies
+    clients listening to the task's events. Does nothing if the current thread does not run a task."""
+    task = getattr(current_task, 'task', None)
+    if task is None:
+        return
+    with task['changed']:
+        task['progress'].append({'stage': stage, 'timestamp': datetime.timestamp(datetime.utcnow())})
+        task['changed'].notify_all()
+
+
+def check_abort():
+    """Raises TaskAborted if the task run by the current thread has been cancelled (see tasks.GetTaskStatus.delete)
+    or has exceeded its deadline. Long-running loops of the factories call this regularly, so that aborted tasks stop
+    cooperatively. Does nothing if the current thread does not run a task."""
+    task = getattr(current_task, 'task', None)
+    if task is None:
+        return
+    if task['cancelled'].is_set():
+        raise TaskAborted('cancelled', True)
+    if time.time() > task['deadline']:
+        raise TaskAborted('deadline exceeded', False)
+
+
+def detach_task():
+    """Initializer for worker processes, which must not inherit the task of the thread by which they were forked."""
+    current_task.task = None
+
+
+def reserve_workers(wanted: int) -> int:
+    """Reserves up to wanted worker processes (of max_worker_processes) for the current task. Reserved processes must
+    be given back with release_workers() once the task does not need them anymore.
+    :return: the number of reserved processes, which may be less than wanted (or 0)
+    """
+    global reserved_workers
+    with reserved_workers_lock:
+        count = max(min(wanted, max_worker_processes - reserved_workers), 0)
+        reserved_workers += count
+        return count
+
+
+def release_workers(count: int):
+    global reserved_workers
+    with reserved_workers_lock:
+        reserved_workers -= count
+
+
+def make_worker_pool(processes: int, initializer=detach_task) -> multiprocessing.pool.Pool:
+    """
+    Creates a pool of worker processes for a single task (see run_in_workers). With the 'forkserver' start method,
+    the workers of all pools are forked from a single server process which has loaded worker_preload_modules, so that
+    they share the imported modules and warmed-up state with the server copy-on-write, rather than each setting them
+    up by itself.
+    """
+    context = multiprocessing.get_context(worker_start_method)
+    if worker_start_method == 'forkserver':
+        # only effective before the fork server has been started (i.e., when the first pool is created)
+        context.set_forkserver_preload(worker_preload_modules)
+    return context.Pool(processes, initializer=initializer)
+
+
+def run_in_workers(function, arguments: list, processes: int, time_limit: float, initializer=detach_task) -> list:
+    """
+    Calls function(*args) for each args in arguments, in a pool of worker processes that belongs to the current task
+    alone (the processes should have been reserved with reserve_workers). If the task is aborted meanwhile (see
+    check_abort), or if the workers exceed time_limit seconds, the pool is terminated (so that its processes do not
+    continue to occupy CPUs, while the workers of other tasks are not affected) and TaskAborted is raised.
+    :return: the results, in the order of arguments
+    """
+    pool = make_worker_pool(processes, initializer)
+    try:
+        end = time.time() + time_limit
+        async_results = [pool.apply_async(function, args) for args in arguments]
+        for async_result in async_results:
+            while not async_result.ready():
+                async_result.wait(worker_check_interval)
+                check_abort()
+                if time.time() > end:
+                    raise TaskAborted('worker processes exceeded the time limit of ' + str(time_limit) + 's', False)
+        results = [async_result.get() for async_result in async_results]
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results
@@ -3,6 +3,10 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 
 class Config:
+    # set up and warm up the factories for works when the app is created (see api.v1.works.factory.warm_up), rather
+    # than on the first request
+    WARM_UP_FACTORIES = True
+
     @staticmethod
     def init_app(app):
         pass
@@ -15,10 +19,12 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     DEBUG = True
     TESTING = True
+    WARM_UP_FACTORIES = False
 
 
 class ProductionConfig:
     DEBUG = False
+    WARM_UP_FACTORIES = True
 
 
 config = {
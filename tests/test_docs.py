@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+from lxml import etree
+
+from api import results, workers
+from api.v1.docs import factory as doc_factory
+from api.v1.docs.config import DocConfig
+from api.v1.docs.factory import GuidelinesFactory, ProjectmembersFactory
+from api.v1.xutils import xml_ns
+
+
+guidelines = b'''<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader/><text><body>
+    <div xml:id="d1"><head xml:id="h1">Heading</head><p xml:id="p1">Text</p>
+        <div xml:id="d11"><p xml:id="p11">Text</p><list xml:id="l11"><item><p>Not basic</p></item></list></div>
+    </div>
+    <div><p xml:id="p2">Parent without id</p><div xml:id="d21"><p xml:id="p21">Text</p></div></div>
+    <div xml:id="d3"><ab><p xml:id="p3">Wrapped</p></ab></div>
+</body></text></TEI>'''
+
+projectmembers = b'''<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader/><text><body>
+    <listPerson xml:id="team"><head xml:id="team-head">Team</head>
+        <person xml:id="pm1"><persName>A</persName></person><person xml:id="pm2"><persName>B</persName></person>
+        <org xml:id="org1"><orgName>C</orgName></org></listPerson>
+    <listPerson xml:id="former"><person xml:id="pm3"><persName>D</persName></person></listPerson>
+</body></text></TEI>'''
+
+
+class StructuralIndexTestCase(unittest.TestCase):
+
+    def test_citetrails_and_levels(self):
+        factory = GuidelinesFactory(DocConfig('guidelines'))
+        index = factory.make_structural_index(etree.fromstring(guidelines))
+        nodes = {node.get('id'): (node.get('citetrail'), node.get('level')) for node in index.iter('sal_node')}
+        self.assertEqual(nodes, {'d1': ('1', '1'), 'h1': ('1.1', '2'), 'p1': ('1.2', '2'), 'd11': ('1.3', '2'),
+                                 'p11': ('1.3.1', '3'), 'l11': ('1.3.2', '3'), 'p2': ('2.1', '2'),
+                                 'd21': ('2.2', '2'), 'p21': ('2.2.1', '3'), 'd3': ('3', '1'), 'p3': ('3.1', '2')})
+        self.assertEqual(factory.config.get_citetrail_mapping('p21'), '2.2.1')
+        self.assertEqual(factory.config.get_cite_depth(), 3)
+
+    def test_projectmembers_citetrails_are_unique(self):
+        factory = ProjectmembersFactory(DocConfig('projectmembers'))
+        index = factory.make_structural_index(etree.fromstring(projectmembers))
+        nodes = {node.get('id'): node.get('citetrail') for node in index.iter('sal_node')}
+        self.assertEqual(nodes, {'team': '1', 'team-head': '1.1', 'pm1': '1.2', 'pm2': '1.3', 'org1': '1.4',
+                                 'former': '2', 'pm3': '2.1'})
+
+
+class DocTestCase(unittest.TestCase):
+    """Processes docs from a temporary docs directory."""
+
+    def setUp(self):
+        self.docs_path = tempfile.mkdtemp()
+        self.tei_docs_path = doc_factory.tei_docs_path
+        doc_factory.tei_docs_path = self.docs_path
+        doc_factory.docs.clear()
+
+    def tearDown(self):
+        doc_factory.tei_docs_path = self.tei_docs_path
+        doc_factory.docs.clear()
+        shutil.rmtree(self.docs_path)
+
+    def write_doc(self, filename: str, content: bytes):
+        """Writes a doc file, with a modification time later than that of the file it replaces (if any), since the
+        file might be rewritten within the resolution of the file system's timestamps."""
+        path = os.path.join(self.docs_path, filename + '.xml')
+        mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        with open(path, 'wb') as fo:
+            fo.write(content)
+        if mtime is not None:
+            os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+
+class DocCacheTestCase(DocTestCase):
+
+    def test_changed_doc_is_loaded_anew(self):
+        self.write_doc('works-general', guidelines)
+        factory, tei_root, structural_index = doc_factory.get_doc('guidelines', 'works-general')
+        self.assertIs(doc_factory.get_doc('guidelines', 'works-general')[1], tei_root)
+        self.write_doc('works-general', guidelines.replace(b'Parent without id', b'Changed text'))
+        factory, changed_root, structural_index = doc_factory.get_doc('guidelines', 'works-general')
+        self.assertIsNot(changed_root, tei_root)
+        self.assertEqual(changed_root.xpath('//tei:p[@xml:id = "p2"]/text()', namespaces=xml_ns), ['Changed text'])
+        self.assertEqual(len(list(structural_index.iter('sal_node'))), 11)
+
+
+class DocRenderTestCase(DocTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write_doc('works-general', guidelines)
+        doc_factory.fragments.clear()
+        self.settings = doc_factory.render_processes, doc_factory.render_chunk_min_size, doc_factory.run_in_workers, \
+            workers.worker_start_method, GuidelinesFactory.render_fragments
+        self.rendered = []
+        self.worker_runs = []
+        render_fragments, run_in_workers = self.settings[4], self.settings[2]
+
+        def count_renderings(factory, node):
+            self.rendered.append(node.get('{http://www.w3.org/XML/1998/namespace}id'))
+            return render_fragments(factory, node)
+
+        def count_worker_runs(function, arguments, *args, **kwargs):
+            self.worker_runs.append(len(arguments))
+            return run_in_workers(function, arguments, *args, **kwargs)
+
+        GuidelinesFactory.render_fragments = count_renderings
+        doc_factory.run_in_workers = count_worker_runs
+
+    def tearDown(self):
+        doc_factory.render_processes, doc_factory.render_chunk_min_size, doc_factory.run_in_workers, \
+            workers.worker_start_method, GuidelinesFactory.render_fragments = self.settings
+        results.release_result(('doc', 'guidelines'))
+        doc_factory.fragments.clear()
+        super().tearDown()
+
+    def transform(self) -> dict:
+        return {passage['id']: passage for passage in doc_factory.transform('guidelines', None).load()['doc_passages']}
+
+    def test_fragments(self):
+        passages = self.transform()
+        fragment = '<dts:fragment xmlns:dts="https://w3id.org/dts/api#">{}</dts:fragment>'
+        self.assertEqual(passages['p2']['html'], fragment.format('<p id="2.1">Parent without id</p>'))
+        self.assertEqual(passages['p2']['txt'], fragment.format('Parent without id'))
+        self.assertEqual(passages['l11']['html'], fragment.format('<ul id="1.3.2"><li><p>Not basic</p></li></ul>'))
+        self.assertNotIn('html', passages['d1'])
+        self.assertEqual(sorted(self.rendered), ['h1', 'l11', 'p1', 'p11', 'p2', 'p21', 'p3'])
+
+    def test_result_is_held(self):
+        result = doc_factory.transform('guidelines', None)
+        self.assertIs(results.get_held_result(('doc', 'guidelines')), result)
+        self.assertIs(doc_factory.transform('guidelines', None), result)
+        # the result is made anew once the doc has changed, and only changed nodes are rendered again
+        self.rendered.clear()
+        self.write_doc('works-general', guidelines.replace(b'Parent without id', b'Changed text'))
+        changed = doc_factory.transform('guidelines', None)
+        self.assertIsNot(changed, result)
+        self.assertIs(results.get_held_result(('doc', 'guidelines')), changed)
+        self.assertEqual(self.rendered, ['p2'])
+
+    def test_sharded_rendering_equals_sequential_rendering(self):
+        doc_factory.render_processes = 1
+        sequential = self.transform()
+        self.assertEqual(self.worker_runs, [])
+        results.release_result(('doc', 'guidelines'))
+        doc_factory.fragments.clear()
+        # (forked from this process, the workers read the doc from the temporary docs directory as well)
+        doc_factory.render_processes, doc_factory.render_chunk_min_size = 2, 1
+        workers.worker_start_method = 'fork'
+        self.assertEqual(self.transform(), sequential)
+        self.assertEqual(self.worker_runs, [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
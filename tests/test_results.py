@@ -0,0 +1,323 @@
+import bisect
+import gzip
+import json
+import os
+import unittest
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from api import results
+from api.results import JSONResult
+
+
+def make_request(query_string: str = '', headers: dict = None) -> Request:
+    return Request(EnvironBuilder(query_string=query_string, headers=headers).get_environ())
+
+
+def get_body(response) -> bytes:
+    return b''.join(response.iter_encoded())
+
+
+def make_data(count: int = 5) -> dict:
+    return {'doc_id': 'test',
+            'passages': [{'@id': 'p' + str(i), 'n': i, 'html': '<p>Passage ' + str(i) + ' ſ</p>',
+                          'txt': 'Passage ' + str(i) + ' "quoted"'}
+                         for i in range(count)]}
+
+
+class PaginationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_data()
+        self.result = JSONResult(self.data, 'passages')
+
+    def get_page(self, query_string: str) -> dict:
+        return json.loads(get_body(self.result.make_response(make_request(query_string))))
+
+    def test_complete_result(self):
+        self.assertEqual(json.loads(get_body(self.result.make_response(make_request()))), self.data)
+        self.assertEqual(self.result.load(), self.data)
+
+    def test_offset_and_limit(self):
+        page = self.get_page('offset=1&limit=2')
+        self.assertEqual(page['totalItems'], 5)
+        self.assertEqual((page['offset'], page['limit']), (1, 2))
+        self.assertEqual(page['passages'], self.data['passages'][1:3])
+
+    def test_limit_beyond_end(self):
+        self.assertEqual(self.get_page('offset=3&limit=10')['passages'], self.data['passages'][3:])
+        self.assertEqual(self.get_page('offset=10')['passages'], [])
+
+    def test_ref_range(self):
+        page = self.get_page('start=p1&end=p3')
+        self.assertEqual(page['totalItems'], 3)
+        self.assertEqual(page['passages'], self.data['passages'][1:4])
+        self.assertEqual(self.get_page('start=p1&end=p3&offset=1&limit=1')['passages'], [self.data['passages'][2]])
+
+    def test_fields(self):
+        page = self.get_page('fields=txt,missing')
+        self.assertEqual(page['passages'], [{'@id': p['@id'], 'txt': p['txt']} for p in self.data['passages']])
+
+    def test_item_value(self):
+        self.assertEqual(self.result.get_item_value(2, 'html'), self.data['passages'][2]['html'])
+        self.assertIsNone(self.result.get_item_value(2, 'missing'))
+
+    def test_unknown_ref(self):
+        with self.assertRaises(HTTPException) as context:
+            self.get_page('start=unknown')
+        self.assertEqual(context.exception.code, 404)
+
+    def test_invalid_offset(self):
+        with self.assertRaises(HTTPException) as context:
+            self.get_page('offset=-1')
+        self.assertEqual(context.exception.code, 400)
+
+
+class ContentNegotiationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # small blocks, so that the result consists of many independently compressed blocks
+        self.block_size = results.block_size
+        results.block_size = 100
+        self.data = make_data(50)
+        self.result = JSONResult(self.data, 'passages')
+        self.body = json.dumps(self.data, ensure_ascii=False).encode('UTF-8')
+
+    def tearDown(self):
+        results.block_size = self.block_size
+
+    def get(self, headers: dict):
+        response = self.result.make_response(make_request(headers=headers))
+        return response, get_body(response)
+
+    def test_gzip(self):
+        response, body = self.get({'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.vary)
+        self.assertEqual(gzip.decompress(body), self.body)
+        self.assertEqual(response.content_length, len(body))
+
+    def test_identity(self):
+        for headers in ({}, {'Accept-Encoding': 'br'}, {'Accept-Encoding': 'gzip;q=0'}):
+            response, body = self.get(headers)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(body, self.body)
+            self.assertEqual(response.content_length, len(self.body))
+
+    def test_blocks(self):
+        self.assertGreater(len(self.result.buffer.block_starts), 10)
+        for position, passage in enumerate(self.data['passages']):
+            self.assertEqual(json.loads(self.result.get_item_bytes(position)), passage)
+        self.assertEqual(self.result.buffer.read(95, 1234), self.body[95:1234])
+
+    def test_single_copy(self):
+        # only the compressed stream is kept, which is served as it is to clients accepting gzip
+        compressed = self.get({'Accept-Encoding': 'gzip'})[1]
+        self.assertEqual(self.result.get_size(), len(compressed) + self.result.index_size)
+        self.assertLess(len(compressed), len(self.body))
+
+    def test_identity_range(self):
+        response, body = self.get({'Range': 'bytes=1000-1499'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.body[1000:1500])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 1000-1499/' + str(len(self.body)))
+
+    def test_gzip_range(self):
+        complete = self.get({'Accept-Encoding': 'gzip'})[1]
+        response, body = self.get({'Accept-Encoding': 'gzip', 'Range': 'bytes=10-'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, complete[10:])
+
+    def test_conditional(self):
+        for headers in ({}, {'Accept-Encoding': 'gzip'}):
+            etag = self.get(headers)[0].headers['ETag']
+            headers['If-None-Match'] = etag
+            self.assertEqual(self.get(headers)[0].status_code, 304)
+        self.assertNotEqual(self.get({})[0].headers['ETag'], self.get({'Accept-Encoding': 'gzip'})[0].headers['ETag'])
+
+
+class ResultStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.results_budget = results.results_budget
+        self.results = [JSONResult(make_data(20), 'passages') for i in range(3)]
+        self.size = self.results[0].get_size()
+        # room for two of the results
+        results.results_budget = 2 * self.size + self.size // 2
+        self.evicted = []
+
+    def tearDown(self):
+        for key in list(results.held_results):
+            if key[0] == 'test':
+                results.release_result(key)
+        results.results_budget = self.results_budget
+
+    def hold(self, name, result):
+        results.hold_result(('test', name), result, self.evicted.append)
+
+    def test_least_recently_used_are_evicted(self):
+        metrics = dict(results.result_metrics)
+        self.hold('a', self.results[0])
+        self.hold('b', self.results[1])
+        self.assertIs(results.get_held_result(('test', 'a')), self.results[0])
+        self.hold('c', self.results[2])
+        self.assertEqual(self.evicted, [('test', 'b')])
+        self.assertIsNone(results.get_held_result(('test', 'b')))
+        self.assertEqual(results.result_metrics['evicted_by_size'], metrics['evicted_by_size'] + 1)
+        self.assertEqual(results.result_metrics['evicted_bytes'],
+                         metrics['evicted_bytes'] + self.results[1].get_size())
+        self.assertEqual(results.result_metrics['results_bytes'],
+                         metrics['results_bytes'] + self.results[0].get_size() + self.results[2].get_size())
+
+    def test_result_held_under_several_keys(self):
+        metrics = dict(results.result_metrics)
+        self.hold('a', self.results[0])
+        self.hold('b', self.results[0])
+        self.assertEqual(results.result_metrics['results_bytes'], metrics['results_bytes'] + self.size)
+        results.release_result(('test', 'a'))
+        self.assertIs(results.get_held_result(('test', 'b')), self.results[0])
+        self.assertEqual(results.result_metrics['results_bytes'], metrics['results_bytes'] + self.size)
+        results.release_result(('test', 'b'))
+        self.assertEqual(results.result_metrics['results_bytes'], metrics['results_bytes'])
+
+    def test_replaced_result_is_released(self):
+        metrics = dict(results.result_metrics)
+        self.hold('a', self.results[0])
+        self.hold('a', self.results[1])
+        self.assertIs(results.get_held_result(('test', 'a')), self.results[1])
+        self.assertEqual(results.result_metrics['results_bytes'],
+                         metrics['results_bytes'] + self.results[1].get_size())
+        self.assertEqual(self.evicted, [])
+
+    def test_callback_may_use_store(self):
+        # callbacks are called outside of the store's lock
+        def on_evict(key):
+            self.evicted.append(results.get_held_result(('test', 'c')))
+        results.hold_result(('test', 'a'), self.results[0], on_evict)
+        self.hold('b', self.results[1])
+        self.hold('c', self.results[2])
+        self.assertEqual(self.evicted, [self.results[2]])
+
+
+class SpillTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = results.block_size, results.spill_threshold
+        results.block_size, results.spill_threshold = 100, 1000
+        self.data = make_data(200)
+        self.body = json.dumps(self.data, ensure_ascii=False).encode('UTF-8')
+
+    def tearDown(self):
+        results.block_size, results.spill_threshold = self.settings
+
+    def test_spills_while_building(self):
+        buffer = results.CompressedBuffer()
+        for i in range(100):
+            buffer.write(self.body[i * 100:(i + 1) * 100])
+            buffer.end_block()
+            if buffer.path:
+                break
+        # the stream is written to the file before the buffer is complete, and is not kept in memory
+        self.assertTrue(buffer.path)
+        self.assertLess(buffer.tell(), len(self.body))
+        self.assertIsNone(buffer.data)
+        buffer.stream.flush()
+        self.assertGreater(os.path.getsize(buffer.path), results.spill_threshold)
+        buffer.write(self.body[buffer.tell():])
+        buffer.close()
+        self.assertEqual(buffer.read(0, buffer.length), self.body)
+        buffer.discard()
+
+    def test_ranges_of_spilled_result(self):
+        result = JSONResult(self.data, 'passages')
+        self.assertTrue(result.buffer.path)
+        self.assertEqual(result.get_disk_size(), os.path.getsize(result.buffer.path))
+        for headers in ({}, {'Accept-Encoding': 'gzip'}):
+            complete = get_body(result.make_response(make_request(headers=headers)))
+            headers['Range'] = 'bytes=1500-2999'
+            response = result.make_response(make_request(headers=headers))
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(get_body(response), complete[1500:3000])
+            response.close()
+        self.assertEqual(gzip.decompress(complete), self.body)
+        self.assertEqual(json.loads(result.get_item_bytes(150)), self.data['passages'][150])
+        result.discard()
+
+    def test_file_is_removed_on_release(self):
+        result = JSONResult(self.data, 'passages')
+        path = result.buffer.path
+        results.hold_result(('test', 'a'), result)
+        results.hold_result(('test', 'b'), result)
+        results.release_result(('test', 'a'))
+        self.assertTrue(os.path.exists(path))
+        results.release_result(('test', 'b'))
+        self.assertFalse(os.path.exists(path))
+        # the result can still be served (e.g., to requests that got hold of it before it was released)
+        response = result.make_response(make_request(headers={'Accept-Encoding': 'gzip'}))
+        self.assertEqual(gzip.decompress(get_body(response)), self.body)
+        self.assertEqual(result.load(), self.data)
+
+
+class PatchItemsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.block_size = results.block_size
+        results.block_size = 200
+        self.data = make_data(50)
+        self.result = JSONResult(self.data, 'passages')
+
+    def tearDown(self):
+        results.block_size = self.block_size
+
+    def patch(self, result, positions):
+        items = {}
+        for position in positions:
+            item = dict(self.data['passages'][position])
+            item['html'] = '<p>Patched passage ' + str(position) + ' ſ' + 'x' * position + '</p>'
+            items[position] = item
+            self.data['passages'][position] = item
+        return result.patch_items(items)
+
+    def test_patched_result(self):
+        patched = self.patch(self.result, [3, 4, 30])
+        self.assertEqual(patched.load(), self.data)
+        self.assertNotEqual(patched.etag, self.result.etag)
+        for position, passage in enumerate(self.data['passages']):
+            self.assertEqual(json.loads(patched.get_item_bytes(position)), passage)
+            self.assertEqual(patched.get_item_value(position, 'html'), passage['html'])
+        # the gzip stream (including its CRC) is valid
+        body = get_body(patched.make_response(make_request(headers={'Accept-Encoding': 'gzip'})))
+        self.assertEqual(json.loads(gzip.decompress(body)), self.data)
+        # the original result is not affected
+        self.assertEqual(self.result.load()['passages'][3], make_data(50)['passages'][3])
+
+    def test_only_patched_blocks_are_compressed_anew(self):
+        patched = self.patch(self.result, [30])
+        source, target = self.result.buffer, patched.buffer
+        self.assertEqual(len(target.block_starts), len(source.block_starts))
+        changed = [index for index in range(len(source.block_starts))
+                   if source.data[source.block_offsets[index]:source.block_offsets[index + 1]]
+                   != target.data[target.block_offsets[index]:target.block_offsets[index + 1]]]
+        self.assertEqual(changed, [bisect.bisect_right(source.block_starts, self.result.item_bounds[60]) - 1])
+
+    def test_patch_spilled_result(self):
+        spill_threshold = results.spill_threshold
+        results.spill_threshold = 500
+        try:
+            result = JSONResult(self.data, 'passages')
+            patched = self.patch(result, [0, 49])
+        finally:
+            results.spill_threshold = spill_threshold
+        self.assertTrue(patched.buffer.path)
+        self.assertEqual(patched.load(), self.data)
+        result.discard()
+        patched.discard()
+
+    def test_fields_must_be_kept(self):
+        with self.assertRaises(ValueError):
+            self.result.patch_items({1: {'@id': 'p1', 'html': ''}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from flask import Blueprint
+
+from api import create_api_app
+from api.tasks import async_api
+from api.workers import report_progress, check_abort, TaskAborted
+
+
+# a task that runs until it is released (or aborted), for observing tasks while they are running
+test_bp = Blueprint('test_tasks', __name__)
+release = threading.Event()
+aborted = threading.Event()
+
+
+@test_bp.route('/task', methods=['POST'])
+@async_api
+def run_task():
+    report_progress('started')
+    try:
+        while not release.wait(0.05):
+            check_abort()
+    except TaskAborted:
+        aborted.set()
+        raise
+    report_progress('released')
+    return {'done': True}
+
+
+def parse_events(stream: bytes) -> list:
+    """Parses a Server-Sent Events stream into a list of (event, data) tuples, skipping comments."""
+    events = []
+    for block in stream.decode('UTF-8').split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.split('\n') if line and not line.startswith(':'))
+        if lines:
+            events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+class TaskTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_api_app('testing')
+        cls.app.register_blueprint(test_bp, url_prefix='/test')
+
+    def setUp(self):
+        release.clear()
+        aborted.clear()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        release.set()
+
+    def start_task(self) -> str:
+        response = self.client.post('/test/task')
+        self.assertEqual(response.status_code, 202)
+        return response.headers['Location']
+
+    def test_long_polling_times_out_while_running(self):
+        location = self.start_task()
+        start = time.time()
+        response = self.client.get(location + '?wait=1')
+        self.assertEqual(response.status_code, 202)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_long_polling_returns_on_completion(self):
+        location = self.start_task()
+        threading.Timer(0.3, release.set).start()
+        start = time.time()
+        response = self.client.get(location + '?wait=30')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'done': True})
+        self.assertLess(time.time() - start, 10)
+
+    def test_event_stream(self):
+        location = self.start_task()
+        response = self.client.get(location + '/events', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        # the first event is sent while the task is still running
+        self.assertEqual(parse_events(next(chunks))[0][1]['stage'], 'started')
+        release.set()
+        events = parse_events(b''.join(chunks))
+        self.assertEqual([event for event, data in events], ['progress', 'complete'])
+        self.assertEqual(events[0][1]['stage'], 'released')
+        self.assertEqual(events[1][1]['status'], 'finished')
+        # (the test client makes the Location header absolute)
+        self.assertTrue(location.endswith(events[1][1]['location']))
+        response.close()
+
+
+    def test_cancel(self):
+        location = self.start_task()
+        self.assertEqual(self.client.delete(location).status_code, 204)
+        self.assertTrue(aborted.wait(5))
+        self.assertEqual(self.client.get(location).status_code, 404)
+        self.assertEqual(self.client.delete(location).status_code, 404)
+
+    def test_deadline(self):
+        response = self.client.post('/test/task?deadline=1')
+        response = self.client.get(response.headers['Location'] + '?wait=10')
+        self.assertEqual(response.status_code, 504)
+        self.assertTrue(aborted.is_set())
+
+
+class WorkerModuleTestCase(unittest.TestCase):
+
+    def import_in_subprocess(self, module: str) -> list:
+        """Imports a module in a fresh interpreter.
+        :return: the web stack modules that have been loaded with it
+        """
+        code = 'import sys, ' + module + '; ' \
+               'print(sorted(m for m in ("flask", "flask_restplus") if m in sys.modules))'
+        output = subprocess.check_output([sys.executable, '-c', code], env=os.environ,
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return json.loads(output.decode().strip().splitlines()[-1].replace("'", '"'))
+
+    def test_factories_do_not_import_flask(self):
+        # the factories (as loaded by the fork server, see workers.py) must not depend on the web stack
+        self.assertEqual(self.import_in_subprocess('api.v1.works.factory, api.v1.docs.factory, api.workers'), [])
+
+    def test_preload_does_not_import_flask(self):
+        self.assertEqual(self.import_in_subprocess('api.v1.preload'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from api import webhooks
+from api.webhooks import is_valid_callback, deliver_notice
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    """Stands in for a client's callback: records the notices it receives, and answers with the queued statuses."""
+
+    def do_POST(self):
+        self.server.notices.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        if 300 <= status < 400:
+            self.send_header('Location', 'http://127.0.0.1:' + str(self.server.server_port) + '/redirected')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), CallbackHandler)
+        self.server.notices = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:' + str(self.server.server_port) + '/notify?client=1'
+        self.settings = webhooks.webhook_allowed_hosts, webhooks.webhook_backoff
+        # (the stand-in runs on the loopback interface, which callbacks may only reach if allowed explicitly)
+        webhooks.webhook_allowed_hosts, webhooks.webhook_backoff = {'127.0.0.1'}, 0.01
+
+    def tearDown(self):
+        webhooks.webhook_allowed_hosts, webhooks.webhook_backoff = self.settings
+        self.server.shutdown()
+        self.server.server_close()
+
+    def deliver(self, *statuses) -> dict:
+        self.server.statuses.extend(statuses)
+        status = {}
+        deliver_notice(self.url, {'task': 'abc'}, status)
+        return status
+
+    def test_delivery(self):
+        self.assertEqual(self.deliver(), {'attempts': 1, 'delivered': True})
+        self.assertEqual(self.server.notices, [{'task': 'abc'}])
+
+    def test_retry_on_server_errors_and_throttling(self):
+        self.assertEqual(self.deliver(503, 429, 500, 200), {'attempts': 4, 'delivered': True})
+        self.assertEqual(len(self.server.notices), 4)
+
+    def test_no_retry_on_client_errors(self):
+        self.assertEqual(self.deliver(404), {'attempts': 1, 'delivered': False})
+        self.assertEqual(len(self.server.notices), 1)
+
+    def test_redirect_is_not_followed(self):
+        self.assertEqual(self.deliver(302), {'attempts': 1, 'delivered': False})
+        self.assertEqual(len(self.server.notices), 1)
+
+    def test_https_connects_to_checked_address(self):
+        wrapped = []
+
+        class Context:
+            def wrap_socket(self, sock, server_hostname):
+                wrapped.append((sock.getpeername(), server_hostname))
+                return sock
+
+        connection = webhooks.CheckedHTTPSConnection('callback.example.org', self.server.server_port, '127.0.0.1')
+        connection.ssl_context = Context()
+        connection.connect()
+        connection.close()
+        self.assertEqual(wrapped, [(('127.0.0.1', self.server.server_port), 'callback.example.org')])
+
+    def test_internal_hosts_are_rejected(self):
+        webhooks.webhook_allowed_hosts = set()
+        for url in (self.url, 'http://localhost/', 'http://169.254.169.254/latest/meta-data', 'http://10.0.0.1/',
+                    'http://[::1]/', 'http://[::ffff:127.0.0.1]/', 'http://0.0.0.0/', 'ftp://93.184.216.34/'):
+            self.assertFalse(is_valid_callback(url), url)
+        self.assertTrue(is_valid_callback('https://93.184.216.34/notify'))
+        # (also at delivery time, e.g. if the host has been re-pointed to an internal address meanwhile)
+        self.assertEqual(self.deliver(), {'attempts': 1, 'delivered': False})
+        self.assertEqual(self.server.notices, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
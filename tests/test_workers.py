@@ -0,0 +1,84 @@
+import threading
+import time
+import unittest
+
+from api import workers
+from api.workers import current_task, TaskAborted, check_abort, reserve_workers, release_workers, run_in_workers
+
+
+def make_task(deadline: float = 60) -> dict:
+    """Makes a task as registered by tasks.async_api, as far as the helpers in workers.py are concerned."""
+    return {'cancelled': threading.Event(),
+            'deadline': time.time() + deadline,
+            'progress': [],
+            'changed': threading.Condition()}
+
+
+def run_as_task(task: dict, function, *args):
+    """Runs function(*args) as the task run by the current thread.
+    :return: the result of the function, or the exception raised by it
+    """
+    current_task.task = task
+    try:
+        return function(*args)
+    except Exception as e:
+        return e
+    finally:
+        current_task.task = None
+
+
+class WorkersTestCase(unittest.TestCase):
+
+    def test_results_in_order(self):
+        self.assertEqual(run_in_workers(divmod, [(7, 2), (9, 4), (1, 1)], 2, 60), [(3, 1), (2, 1), (1, 0)])
+
+    def test_worker_exception(self):
+        with self.assertRaises(ZeroDivisionError):
+            run_in_workers(divmod, [(1, 0)], 2, 60)
+
+    def test_cancel_does_not_affect_other_tasks(self):
+        cancelled_task, other_task = make_task(), make_task()
+        results = {}
+
+        def run(name, task, duration):
+            results[name] = run_as_task(task, run_in_workers, time.sleep, [(duration,), (duration,)], 2, 60)
+
+        threads = [threading.Thread(target=run, args=('cancelled', cancelled_task, 30)),
+                   threading.Thread(target=run, args=('other', other_task, 2))]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        start = time.time()
+        cancelled_task['cancelled'].set()
+        threads[0].join()
+        self.assertLess(time.time() - start, 5)
+        self.assertIsInstance(results['cancelled'], TaskAborted)
+        self.assertTrue(results['cancelled'].cancelled)
+        threads[1].join()
+        self.assertEqual(results['other'], [None, None])
+
+    def test_time_limit(self):
+        result = run_as_task(make_task(), run_in_workers, time.sleep, [(30,)], 1, 1)
+        self.assertIsInstance(result, TaskAborted)
+        self.assertFalse(result.cancelled)
+
+    def test_deadline(self):
+        task = make_task(deadline=-1)
+        self.assertIsInstance(run_as_task(task, check_abort), TaskAborted)
+
+    def test_reserve_workers(self):
+        available = workers.max_worker_processes - workers.reserved_workers
+        first = reserve_workers(available - 1)
+        second = reserve_workers(4)
+        try:
+            self.assertEqual(first, available - 1)
+            self.assertEqual(second, 1)
+            self.assertEqual(reserve_workers(1), 0)
+        finally:
+            release_workers(first)
+            release_workers(second)
+        self.assertEqual(workers.max_worker_processes - workers.reserved_workers, available)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,489 @@
+import base64
+import gc
+import glob
+import gzip
+import http.client
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+from lxml import etree
+from urllib.parse import urlsplit
+from werkzeug.serving import make_server
+
+from api import create_api_app, results
+from api.v1.works import corpus, factory, metadata, nodemap
+from api.v1.works import config as work_config
+from api.v1.works.htmlwriter import HTMLElement, make_dts_fragment_html
+from api.v1.xutils import make_dts_fragment_string, normalize_space, xml_ns
+from api.v1.works import result as work_result
+from api.v1.errors import TEIMarkupError
+
+
+works_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'in', 'svsal-tei', 'works')
+
+
+def read_work(wid: str) -> bytes:
+    with open(os.path.join(works_path, wid + '.xml'), 'rb') as fi:
+        return fi.read()
+
+
+class WorkTestCase(unittest.TestCase):
+    """Transforms works with node maps and cross-work links in a temporary data directory."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_path = tempfile.mkdtemp()
+        cls.works_data_path = nodemap.works_data_path
+        nodemap.works_data_path = corpus.works_data_path = cls.data_path
+
+    @classmethod
+    def tearDownClass(cls):
+        nodemap.works_data_path = corpus.works_data_path = cls.works_data_path
+        shutil.rmtree(cls.data_path)
+
+    def transform(self, wid: str):
+        return factory.transform(wid, read_work(wid))
+
+
+class WorkResultTestCase(WorkTestCase):
+
+    def test_passage(self):
+        result = self.transform('W0099')
+        data = result.load()
+        for passage in data['work_passages']:
+            for fmt in work_result.document_formats:
+                expected = passage.get(fmt)
+                self.assertEqual(result.get_passage(passage['@id'], fmt),
+                                 expected.encode('UTF-8') if expected is not None else None)
+        self.assertIsNone(result.get_passage('unknown', 'html'))
+
+    def test_passage_cache(self):
+        result = self.transform('W0099')
+        ref = [passage['@id'] for passage in result.load()['work_passages'] if passage.get('html')][-1]
+        passage = result.get_passage(ref, 'html')
+        self.assertTrue(passage)
+        self.assertIs(result.get_passage(ref, 'html'), passage)
+        # passages of a newer result of the same work are not taken from the older one's cache entries
+        newer = self.transform('W0099')
+        self.assertEqual(newer.get_passage(ref, 'html'), passage)
+        self.assertIsNot(newer.get_passage(ref, 'html'), passage)
+
+    def test_result_is_freed_without_gc(self):
+        result = self.transform('W0099')
+        result.get_passage(result.load()['work_passages'][-1]['@id'], 'html')
+        reference = weakref.ref(result)
+        gc.disable()
+        try:
+            del result
+            self.assertIsNone(reference())
+        finally:
+            gc.enable()
+
+
+class WorkRegistryTestCase(WorkTestCase):
+
+    def setUp(self):
+        self.client = create_api_app('testing').test_client()
+
+    def tearDown(self):
+        results.release_result(('work', 'W0099'))
+        work_result.navigations.pop('W0099', None)
+
+    def test_navigation_survives_eviction(self):
+        result = self.transform('W0099')
+        ref = [passage['@id'] for passage in result.load()['work_passages'] if passage.get('html')][-1]
+        work_result.put_work_result(result)
+        navigation = self.client.get('/v1/texts/W0099/navigation').json
+        self.assertTrue(navigation['member'])
+        self.assertEqual(self.client.get('/v1/texts/W0099/document?ref=' + ref).status_code, 200)
+        # evicted from the result store, e.g. for the results of other tasks
+        results.release_result(('work', 'W0099'), evicted=True)
+        self.assertEqual(self.client.get('/v1/texts/W0099/navigation').json, navigation)
+        self.assertEqual(self.client.get('/v1/texts/W0099/document?ref=' + ref).status_code, 404)
+
+
+class WorkUploadTestCase(WorkTestCase):
+    """Uploads works to a server that runs in a thread of its own (rather than through the test client, which makes
+    the complete request body available regardless of when it is read)."""
+
+    def setUp(self):
+        self.server = make_server('127.0.0.1', 0, create_api_app('testing'), threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        results.release_result(('work', 'W0099'))
+        work_result.navigations.pop('W0099', None)
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=60)
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            connection.close()
+
+    def test_large_gzip_body(self):
+        # a few MB of incompressible data (in a comment after the root element), so that the body is still being
+        # received when the request has been accepted
+        padding = base64.b64encode(os.urandom(3 * 1024 * 1024))
+        body = gzip.compress(read_work('W0099') + b'\n<!-- ' + padding + b' -->\n')
+        self.assertGreater(len(body), 3 * 1024 * 1024)
+        status, headers, _ = self.request('POST', '/v1/texts/W0099', body, {'Content-Encoding': 'gzip'})
+        self.assertEqual(status, 202)
+        location = urlsplit(headers['Location']).path
+        status, _, data = self.request('GET', location + '?wait=60')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(gzip.decompress(data) if data[:2] == b'\x1f\x8b' else data),
+                         self.transform('W0099').load())
+
+    def test_invalid_body(self):
+        status, _, _ = self.request('POST', '/v1/texts/W0099', b'<TEI><teiHeader>', {})
+        self.assertEqual(status, 400)
+        status, _, _ = self.request('POST', '/v1/texts/W0099', b'no gzip', {'Content-Encoding': 'gzip'})
+        self.assertEqual(status, 400)
+
+    def test_client_disconnect(self):
+        spools = set(glob.glob(os.path.join(tempfile.gettempdir(), 'work-*.xml')))
+        factory.idle_factories.clear()
+        tei = read_work('W0099')
+        with socket.create_connection(('127.0.0.1', self.server.server_port)) as connection:
+            connection.sendall(b'POST /v1/texts/W0099 HTTP/1.1\r\nHost: localhost\r\n'
+                               b'Content-Length: ' + str(len(tei)).encode() + b'\r\n\r\n' + tei[:len(tei) // 2])
+        # the factory is given back to the pool, and the partially spooled dataset is removed
+        deadline = time.time() + 10
+        while not factory.idle_factories and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(factory.idle_factories), 1)
+        self.assertEqual(set(glob.glob(os.path.join(tempfile.gettempdir(), 'work-*.xml'))), spools)
+
+
+class FactoryReuseTestCase(WorkTestCase):
+
+    def setUp(self):
+        # (W0099 links to W0001, whose node map must thus be the same for all transformations of W0099)
+        self.transform('W0001')
+        factory.idle_factories.clear()
+
+    def test_reused_factory_gives_same_output(self):
+        fresh = self.transform('W0099').load()
+        reused = factory.idle_factories[-1]
+        self.transform('W0001')
+        self.assertIs(factory.idle_factories[-1], reused)
+        self.assertEqual(self.transform('W0099').load(), fresh)
+
+    def test_failed_factory_is_reused(self):
+        fresh = self.transform('W0099').load()
+        reused = factory.idle_factories[-1]
+        tei = read_work('W0099')
+        with self.assertRaises(etree.XMLSyntaxError):
+            factory.transform('W0099', tei[:len(tei) // 2])
+        # the factory is not dropped, but gets a new parser
+        self.assertEqual(factory.idle_factories, [reused])
+        self.assertEqual(self.transform('W0099').load(), fresh)
+
+
+class ParallelIndexTestCase(WorkTestCase):
+
+    def setUp(self):
+        # (W0099 links to W0001, whose node map must thus be the same for all transformations of W0099)
+        self.transform('W0001')
+        self.settings = factory.index_processes, factory.index_chunk_min_size, factory.run_in_workers
+        self.worker_runs = []
+
+        def run_in_workers(function, arguments, *args, **kwargs):
+            self.worker_runs.append(len(arguments))
+            return self.settings[2](function, arguments, *args, **kwargs)
+
+        factory.run_in_workers = run_in_workers
+
+    def tearDown(self):
+        factory.index_processes, factory.index_chunk_min_size, factory.run_in_workers = self.settings
+
+    def test_parallel_index_equals_sequential_index(self):
+        factory.index_processes = 1
+        sequential = self.transform('W0099').load()
+        factory.index_processes, factory.index_chunk_min_size = 2, 1
+        self.assertEqual(self.transform('W0099').load(), sequential)
+        self.assertEqual(self.worker_runs, [2])
+
+    def test_small_work_is_indexed_sequentially(self):
+        factory.index_processes, factory.index_chunk_min_size = 2, 10 ** 9
+        self.transform('W0099')
+        self.assertEqual(self.worker_runs, [])
+
+
+class WorkConfigTestCase(unittest.TestCase):
+
+    def test_data_path_does_not_depend_on_working_directory(self):
+        code = 'from api.v1.works.config import works_data_path; print(works_data_path)'
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+        paths = [subprocess.check_output([sys.executable, '-c', code], cwd=cwd, env=env)
+                 for cwd in (root, tempfile.gettempdir())]
+        self.assertEqual(paths[0], paths[1])
+        self.assertEqual(paths[0].decode().strip(), os.path.join(root, 'data', 'works'))
+
+
+class CorpusTestCase(WorkTestCase):
+
+    def setUp(self):
+        # a data directory of its own, in which no work has been indexed yet
+        nodemap.works_data_path = corpus.works_data_path = tempfile.mkdtemp(dir=self.data_path)
+
+    def tearDown(self):
+        nodemap.works_data_path = corpus.works_data_path = self.data_path
+        results.release_result(('work', 'W0099'))
+        results.release_result(('work', 'W0001'))
+
+    def test_links_are_refreshed(self):
+        # W0099 links to W0001#x1, which cannot be resolved to a passage before W0001 has been indexed
+        result = self.transform('W0099')
+        work_result.put_work_result(result)
+        links = corpus.get_cross_work_links('W0099')
+        self.assertEqual([link[:2] for passage_links in links.values() for link in passage_links], [['W0001', 'x1']])
+        self.assertEqual(corpus.get_linking_works('W0001'), ['W0099'])
+        work_result.put_work_result(self.transform('W0001'))
+        corpus.refresh_linking_works('W0001')
+        refreshed = work_result.get_work_result('W0099')
+        self.assertIsNot(refreshed, result)
+        # the same as if W0099 had been transformed after W0001
+        self.assertEqual(refreshed.load(), self.transform('W0099').load())
+        self.assertNotEqual(refreshed.load(), result.load())
+        self.assertEqual(corpus.get_stale_links('W0099', 'W0001'), {})
+
+    def test_newer_result_is_not_replaced(self):
+        work_result.put_work_result(self.transform('W0099'))
+        work_result.put_work_result(self.transform('W0001'))
+        older = work_result.get_work_result('W0099')
+        links = corpus.get_cross_work_links('W0099')
+        newer = self.transform('W0099')
+        patch_items = older.patch_items
+
+        def finish_upload(items):
+            # W0099 has been transformed anew (after W0001) while the older result is being patched
+            work_result.put_work_result(newer)
+            return patch_items(items)
+
+        older.patch_items = finish_upload
+        corpus.put_cross_work_links('W0099', links)
+        corpus.refresh_linking_works('W0001')
+        self.assertIs(work_result.get_work_result('W0099'), newer)
+        self.assertEqual(corpus.get_cross_work_links('W0099'), links)
+
+    def test_link_split_by_page_break(self):
+        page_break = b'<pb n="9" facs="facs:W0099-0009" xml:id="pb9"/>'
+        tei = read_work('W0099').replace(b'<ref target="work:W0001#x1">alt</ref>',
+                                         b'<ref target="work:W0001#x1">a' + page_break + b'lt</ref>')
+        factory.transform('W0099', tei)
+        anchors = [link[3] for passage_links in corpus.get_cross_work_links('W0099').values()
+                   for link in passage_links]
+        self.assertEqual(anchors, [2])
+
+
+class HTMLSerializationTestCase(WorkTestCase):
+
+    def tearDown(self):
+        factory.html_serialization = work_config.html_serialization
+        factory.idle_factories.clear()
+
+    def transform_with(self, html_serialization: str, wid: str) -> dict:
+        factory.html_serialization = html_serialization
+        factory.idle_factories.clear()
+        return self.transform(wid).load()
+
+    def test_modes_give_same_output(self):
+        for wid in ('W0001', 'W0099'):
+            self.assertEqual(self.transform_with('string', wid), self.transform_with('lxml', wid))
+
+    def test_fragment_of_list(self):
+        def make(make_element):
+            emphasis = make_element('em')
+            emphasis.text = 'b & c'
+            span = make_element('span')
+            span.set('class', '"quoted"')
+            return ['a < ', [emphasis, ' d', None], span, 'e']
+        expected = make_dts_fragment_string(make(etree.Element)).decode('UTF-8')
+        self.assertIn('<em>b &amp; c</em> d<span class="&quot;quoted&quot;"/>e', expected)
+        self.assertEqual(make_dts_fragment_html(make(HTMLElement)), expected)
+        for content in ([], None, ''):
+            self.assertEqual(make_dts_fragment_html(content), make_dts_fragment_string(content).decode('UTF-8'))
+
+
+class NotePlaceholderTestCase(WorkTestCase):
+
+    def setUp(self):
+        self.factory = factory.acquire_factory()
+        self.tei_root = etree.fromstring(read_work('W0099'))
+        factory.make_factory('W0099', self.tei_root, self.factory)
+        self.paragraph = self.tei_root.xpath('//*[@xml:id = "p1"]')[0]
+
+    def tearDown(self):
+        factory.release_factory(self.factory)
+
+    def test_placeholders_are_collected_per_passage(self):
+        transformer = self.factory.txt_transformer
+        # rendering outside of passages (e.g., teasers or the html of a passage) does not collect any placeholders
+        text = transformer.dispatch(self.paragraph, 'edit')
+        self.assertIn('{%note:n1%}', text)
+        self.assertIsNone(transformer.note_placeholders)
+        self.assertEqual(transformer.dispatch_passage(self.paragraph, 'edit'), (text, ['n1']))
+        self.assertEqual(transformer.dispatch_passage(self.paragraph, 'orig')[1], ['n1'])
+        self.assertIsNone(transformer.note_placeholders)
+
+
+class HeaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.transformer = metadata.WorkMetadataTransformer(None, None)
+        metadata.header_cache.clear()
+
+    def get_header(self, wid: str) -> etree._Element:
+        return etree.fromstring(read_work(wid)).xpath('tei:teiHeader', namespaces=xml_ns)[0]
+
+    def test_walk_selects_same_nodes_as_xpaths(self):
+        # the paths of the header schema are XPaths, which select the same nodes as the single walk
+        for wid in ('W0001', 'W0099'):
+            tei_header = self.get_header(wid)
+            values = metadata.extract_header_values(tei_header, self.transformer.compiled_header_schema)
+            for field, (path, converter) in self.transformer.header_schema.items():
+                expected = tei_header.xpath(path, namespaces=xml_ns)
+                self.assertEqual(values.get(field, []), expected if converter else [str(v) for v in expected])
+            self.assertTrue(any(values.values()))
+
+    def test_cache_by_content(self):
+        header = self.transformer.extract_header(self.get_header('W0099'))
+        # identical headers (parsed anew, e.g. of another volume) share the cached data, changed headers do not
+        self.assertIs(self.transformer.extract_header(self.get_header('W0099')), header)
+        changed = self.get_header('W0099')
+        changed.xpath('tei:fileDesc/tei:editionStmt/tei:edition', namespaces=xml_ns)[0].set('n', '9.9.9')
+        self.assertEqual(self.transformer.extract_header(changed)['version'], ['9.9.9'])
+        self.assertNotEqual(header['version'], ['9.9.9'])
+        self.assertEqual(len(metadata.header_cache), 2)
+
+    def test_unsupported_path(self):
+        with self.assertRaises(ValueError):
+            metadata.compile_header_schema({'title': ('tei:fileDesc//tei:title/text()', None)})
+
+
+class FacsTestCase(WorkTestCase):
+
+    def setUp(self):
+        self.tei_root = etree.fromstring(read_work('W0099'))
+        work_factory = factory.WorkFactory(work_config.WorkConfig('W0099'))
+        self.factory = factory.make_factory('W0099', self.tei_root, work_factory)
+
+    def test_facs_to_uri(self):
+        html_transformer = self.factory.html_transformer
+        self.assertEqual(html_transformer.facs_to_uri('facs:W0017-0005'),
+                         work_config.image_server + '/iiif/image/W0017!W0017-0005/full/full/0/default.jpg')
+        self.assertEqual(html_transformer.facs_to_uri('facs:W0013-B-0012 facs:W0013-B-0013'),
+                         work_config.image_server + '/iiif/image/W0013!B!W0013-B-0012/full/full/0/default.jpg')
+        with self.assertRaises(TEIMarkupError):
+            html_transformer.facs_to_uri('facs:W17-5')
+
+    def test_facs_index(self):
+        self.factory.make_facs_index(self.tei_root)
+        mapping = self.factory.config.get_facs_mapping('facs:W0099-0002')
+        self.assertEqual(mapping['id'], 'pb2')
+        self.assertEqual(mapping['image'], self.factory.html_transformer.facs_to_uri('facs:W0099-0002'))
+        # image URIs are taken from the index, and derived from @facs for pages that have not been indexed
+        self.factory.config.put_facs_mapping('facs:W0099-0002', 'pb2', 'p2', 'https://example.org/image')
+        self.assertEqual(self.factory.html_transformer.get_image_uri('facs:W0099-0002'), 'https://example.org/image')
+        self.assertEqual(self.factory.html_transformer.get_image_uri('facs:W0099-A-0009'),
+                         work_config.image_server + '/iiif/image/W0099!A!W0099-A-0009/full/full/0/default.jpg')
+
+    def test_facs_links(self):
+        passages = {passage['@id']: passage.get('html') or ''
+                    for passage in self.transform('W0099').load()['work_passages']}
+        # facs: targets link to the citetrail of the page, and page breaks link to the page image
+        self.assertIn('href="' + work_config.id_server + '/texts/W0099:p2"', passages['1.1'])
+        self.assertIn('href="' + work_config.image_server + '/iiif/image/W0099!W0099-0004/full/full/0/default.jpg"',
+                      passages['2.1'])
+
+
+class TargetResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tei_root = etree.fromstring(read_work('W0099'))
+        work_factory = factory.WorkFactory(work_config.WorkConfig('W0099'))
+        self.factory = factory.make_factory('W0099', self.tei_root, work_factory)
+        self.resolver = self.factory.html_transformer.target_resolver
+        self.node = self.tei_root.xpath('//tei:p[@xml:id = "p1"]', namespaces=xml_ns)[0]
+
+    def test_prefix_defs(self):
+        # (the prefixDef of W0099 replaces "(.+)" with "https://example.org/cit/$1")
+        self.assertEqual(self.resolver.resolve(self.node, 'cit:abc'), ('https://example.org/cit/abc', None))
+        self.factory.config.set_prefix_def(etree.fromstring(
+            '<prefixDef ident="bib" matchPattern="([a-z]+)-([0-9]+)" replacementPattern="https://example.org/$2/$1"/>'))
+        self.assertEqual(self.resolver.resolve(self.node, 'bib:vitoria-1557'),
+                         ('https://example.org/1557/vitoria', None))
+        # values that do not match the pattern, and unknown prefixes, are not replaced
+        self.assertEqual(self.resolver.resolve(self.node, 'bib:1557'), ('bib:1557', None))
+        self.assertEqual(self.resolver.resolve(self.node, 'foo:bar'), ('foo:bar', None))
+
+    def test_memoization(self):
+        calls = []
+        resolve_uncached = self.resolver.resolve_uncached
+
+        def count_calls(node, target):
+            calls.append(target)
+            return resolve_uncached(node, target)
+
+        self.resolver.resolve_uncached = count_calls
+        resolved = self.resolver.resolve(self.node, 'cit:abc')
+        self.assertIs(self.resolver.resolve(self.node, 'cit:abc'), resolved)
+        self.assertEqual(self.resolver.resolve(self.node, 'work:W0001#x1')[1], ('W0001', 'x1'))
+        self.resolver.resolve(self.node, 'work:W0001#x1')
+        self.assertEqual(calls, ['cit:abc', 'work:W0001#x1'])
+        # targets are resolved anew for the next work
+        self.resolver.reset()
+        self.resolver.resolve(self.node, 'cit:abc')
+        self.assertEqual(calls, ['cit:abc', 'work:W0001#x1', 'cit:abc'])
+
+
+class TeaserTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tei_root = etree.fromstring(read_work('W0099'))
+        work_factory = factory.WorkFactory(work_config.WorkConfig('W0099'))
+        self.factory = factory.make_factory('W0099', self.tei_root, work_factory)
+
+    def make_full_teaser(self, elem) -> str:
+        """Makes a teaser from the full text of elem, as make_node_teaser did before rendering only prefixes."""
+        text = self.factory.txt_transformer.dispatch(elem, 'edit')
+        normalized_text = normalize_space(re.sub(r'\{.*?\}', '', re.sub(r'\[.*?\]', '', text)))
+        if len(normalized_text) > work_config.teaser_length:
+            return '"' + normalize_space(normalized_text[:work_config.teaser_length]) + '…"'
+        return '"' + normalized_text + '"'
+
+    def test_same_teasers_as_full_text(self):
+        text = self.tei_root.xpath('tei:text', namespaces=xml_ns)[0]
+        for elem in text.iter('{*}p', '{*}head', '{*}div', '{*}list', '{*}item', '{*}note'):
+            self.assertEqual(self.factory.analysis.make_node_teaser(elem), self.make_full_teaser(elem))
+
+    def test_brackets_beyond_prefix(self):
+        # bracketed parts that are still open at the end of the first prefixes (or start after them)
+        long_text = ' '.join('word' + str(i) for i in range(100))
+        for content in ('short [' + long_text + '] rest of the text ' + long_text,
+                        'short <hi>{' + long_text + '</hi> }' + long_text,
+                        long_text[:110] + ' [x] ' + long_text,
+                        '[' + long_text + ']',
+                        'short'):
+            elem = etree.fromstring('<p xmlns="http://www.tei-c.org/ns/1.0">' + content + '</p>')
+            self.assertEqual(self.factory.analysis.make_node_teaser(elem), self.make_full_teaser(elem))
+
+
+if __name__ == '__main__':
+    unittest.main()
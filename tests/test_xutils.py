@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+from lxml import etree
+
+from api.v1 import xutils
+from api.v1.errors import XIncludeError
+from api.v1.xutils import resolve_xincludes, xinclude_parser
+
+
+xi = 'xmlns:xi="http://www.w3.org/2001/XInclude"'
+
+
+class XIncludeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        xutils.included_files.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name: str, content: str):
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='UTF-8') as fo:
+            fo.write(content)
+        return path
+
+    def assert_same_as_lxml(self, name: str):
+        path = os.path.join(self.path, name)
+        tree = etree.parse(path, xinclude_parser)
+        tree.xinclude()
+        root = etree.parse(path, xinclude_parser).getroot()
+        resolve_xincludes(root)
+        # (lxml keeps namespace declarations of included elements that are redundant in the including document, which
+        # canonicalization drops)
+        self.assertEqual(etree.tostring(root, method='c14n'), etree.tostring(tree.getroot(), method='c14n'))
+
+    def test_nested(self):
+        self.write('main.xml', '<doc ' + xi + '>a<xi:include href="part.xml"/>b</doc>')
+        self.write('part.xml', '<!-- part --><part ' + xi + '>c<xi:include href="leaf.xml"/>d</part>')
+        self.write('leaf.xml', '<leaf>e</leaf>')
+        self.assert_same_as_lxml('main.xml')
+
+    def test_xpointer(self):
+        self.write('main.xml', '<doc ' + xi + '><xi:include href="part.xml" xpointer="p2"/>'
+                               '<xi:include href="part.xml" xpointer="element(p1)"/></doc>')
+        self.write('part.xml', '<part><p xml:id="p1">one</p>tail<p xml:id="p2">two</p></part>')
+        self.assert_same_as_lxml('main.xml')
+
+    def test_fallback(self):
+        self.write('main.xml', '<doc ' + xi + '>a<xi:include href="missing.xml"><xi:fallback>b<c/>d'
+                               '<xi:include href="part.xml"/></xi:fallback></xi:include>e</doc>')
+        self.write('part.xml', '<part/>')
+        self.assert_same_as_lxml('main.xml')
+
+    def test_text(self):
+        self.write('main.xml', '<doc ' + xi + '>a<xi:include href="part.txt" parse="text"/>b</doc>')
+        self.write('part.txt', 'some <text> & more')
+        self.assert_same_as_lxml('main.xml')
+
+    def test_xml_base(self):
+        self.write('main.xml', '<doc ' + xi + '><xi:include href="sub/part.xml"/></doc>')
+        self.write('sub/part.xml', '<part ' + xi + '><xi:include href="leaf.xml"/></part>')
+        self.write('sub/leaf.xml', '<leaf/>')
+        self.assert_same_as_lxml('main.xml')
+
+    def test_cycle(self):
+        self.write('main.xml', '<doc ' + xi + '><xi:include href="part.xml"/></doc>')
+        self.write('part.xml', '<part ' + xi + '><xi:include href="main.xml"/></part>')
+        with self.assertRaises(XIncludeError):
+            resolve_xincludes(etree.parse(os.path.join(self.path, 'main.xml'), xinclude_parser).getroot())
+
+    def test_changed_file_is_included_anew(self):
+        main = self.write('main.xml', '<doc ' + xi + '><xi:include href="part.xml"/></doc>')
+        part = self.write('part.xml', '<part>old</part>')
+        root = etree.parse(main, xinclude_parser).getroot()
+        dependencies = resolve_xincludes(root)
+        self.assertEqual(root.findtext('part'), 'old')
+        self.assertEqual(set(dependencies), {part})
+        self.write('part.xml', '<part>new</part>')
+        # (the file might have been rewritten within the resolution of the file system's timestamps)
+        os.utime(part, ns=(dependencies[part] + 10 ** 9, dependencies[part] + 10 ** 9))
+        root = etree.parse(main, xinclude_parser).getroot()
+        resolve_xincludes(root)
+        self.assertEqual(root.findtext('part'), 'new')
+
+    def test_include_as_root(self):
+        self.write('main.xml', '<xi:include ' + xi + ' href="part.xml"/>')
+        self.write('part.xml', '<part/>')
+        with self.assertRaisesRegex(XIncludeError, 'root element'):
+            resolve_xincludes(etree.parse(os.path.join(self.path, 'main.xml'), xinclude_parser).getroot())
+
+
+if __name__ == '__main__':
+    unittest.main()